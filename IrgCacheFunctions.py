@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+"""IrgCacheFunctions.py - Caching of values computed from the contents of files"""
+
+import sys, os, copy, threading, sqlite3, collections, atexit
+import cPickle as pickle
+
+import IrgGdalFunctions
+
+
+class FileResultCache(object):
+    """Caches results computed from a file, keyed on the absolute path, size and modification time.
+
+       There is an in-memory LRU layer and an optional SQLite file which can be shared
+       between processes.  An entry is evicted as soon as the file it came from changes."""
+
+    def __init__(self, maxEntries=4096, dbPath=None):
+        self.maxEntries = maxEntries
+        self.dbPath     = None
+        self._entries   = collections.OrderedDict() # (namespace, path) -> (size, mtime, value)
+        self._lock      = threading.Lock()
+
+        # Counters
+        self.hits      = 0 # Includes disk hits
+        self.diskHits  = 0
+        self.misses    = 0
+        self.evictions = 0 # Entries removed because their file changed
+        self._savedCounters = {} # Counters already added to the totals in the disk layer
+
+        if dbPath:
+            self.setDatabase(dbPath)
+
+    def setDatabase(self, dbPath):
+        """Enables the on-disk store at this path, None disables it"""
+        if dbPath:
+            dbPath = os.path.abspath(dbPath)
+            connection = self._connect(dbPath)
+            connection.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, path TEXT, size INTEGER, '
+                               'mtime REAL, value BLOB, PRIMARY KEY (namespace, path))')
+            connection.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+            connection.commit()
+            connection.close()
+        self.dbPath = dbPath
+
+    def _connect(self, dbPath):
+        """Opens a new connection, each call gets its own so threads and processes can share the file"""
+        return sqlite3.connect(dbPath, timeout=60)
+
+    def get(self, namespace, filePath, function, *args, **kwargs):
+        """Returns function(*args, **kwargs), computing it only if there is no valid entry for filePath"""
+
+        try:
+            fileStat = os.stat(filePath)
+        except OSError: # Missing file, let the function report the error
+            return function(*args, **kwargs)
+
+        key   = (namespace, os.path.abspath(filePath))
+        size  = fileStat.st_size
+        mtime = fileStat.st_mtime
+
+        # Check the memory layer
+        isStale = False
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if (entry[0] == size) and (entry[1] == mtime):
+                    self._entries[key] = entry # Move to the most recently used position
+                    self.hits += 1
+                    return copy.deepcopy(entry[2])
+                isStale = True # File has changed
+
+        # Check the disk layer
+        if self.dbPath:
+            found, value, isStaleOnDisk = self._readDisk(key, size, mtime)
+            isStale = isStale or isStaleOnDisk
+            if found:
+                self._store(key, size, mtime, value)
+                with self._lock:
+                    self.hits     += 1
+                    self.diskHits += 1
+                return copy.deepcopy(value)
+
+        # Not found, compute and store the value
+        with self._lock:
+            self.misses += 1
+            if isStale:
+                self.evictions += 1
+        value = function(*args, **kwargs)
+        self._store(key, size, mtime, value)
+        if self.dbPath:
+            self._writeDisk(key, size, mtime, value)
+        return copy.deepcopy(value)
+
+    def _store(self, key, size, mtime, value):
+        """Adds an entry to the memory layer, dropping the least recently used ones"""
+        with self._lock:
+            self._entries[key] = (size, mtime, value)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def _readDisk(self, key, size, mtime):
+        """Returns (found, value, isStale) for the disk layer, removing the entry if it is stale"""
+        connection = self._connect(self.dbPath)
+        try:
+            row = connection.execute('SELECT size, mtime, value FROM cache WHERE namespace=? AND path=?',
+                                     key).fetchone()
+            if row is None:
+                return (False, None, False)
+            if (row[0] == size) and (row[1] == mtime):
+                return (True, pickle.loads(str(row[2])), False)
+            connection.execute('DELETE FROM cache WHERE namespace=? AND path=?', key)
+            connection.commit()
+            return (False, None, True)
+        finally:
+            connection.close()
+
+    def _writeDisk(self, key, size, mtime, value):
+        """Writes an entry to the disk layer"""
+        blob = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        connection = self._connect(self.dbPath)
+        try:
+            connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                               (key[0], key[1], size, mtime, blob))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def clear(self):
+        """Removes all entries from both layers and resets the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.diskHits = self.misses = self.evictions = 0
+        if self.dbPath:
+            connection = self._connect(self.dbPath)
+            connection.execute('DELETE FROM cache')
+            connection.execute('DELETE FROM stats')
+            connection.commit()
+            connection.close()
+
+    def getStats(self):
+        """Returns a dictionary with the hit/miss counters"""
+        with self._lock:
+            return {'hits'     : self.hits,
+                    'disk_hits': self.diskHits,
+                    'misses'   : self.misses,
+                    'evictions': self.evictions,
+                    'entries'  : len(self._entries)}
+
+    def saveStats(self):
+        """Adds the counters of this process to the totals kept in the disk layer"""
+        if not self.dbPath:
+            return
+        with self._lock:
+            counters = {'hits': self.hits, 'disk_hits': self.diskHits,
+                        'misses': self.misses, 'evictions': self.evictions}
+            changes  = dict([(name, counters[name] - self._savedCounters.get(name, 0)) for name in counters])
+            self._savedCounters = counters
+        connection = self._connect(self.dbPath)
+        try:
+            for (name, change) in changes.items():
+                connection.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+                connection.execute('UPDATE stats SET value = value + ? WHERE name = ?', (change, name))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def getDatabaseStats(self):
+        """Returns the counters summed over all the processes which used the disk layer,
+           or None without a disk layer"""
+        if not self.dbPath:
+            return None
+        self.saveStats()
+        connection = self._connect(self.dbPath)
+        try:
+            stats = dict([('hits', 0), ('disk_hits', 0), ('misses', 0), ('evictions', 0)])
+            stats.update(dict(connection.execute('SELECT name, value FROM stats').fetchall()))
+            return stats
+        finally:
+            connection.close()
+
+
+# One cache is shared by all the functions in this process.
+# - Set IRG_CACHE_DB to share results between processes and between runs.
+# - Set IRG_CACHE_DISABLE to turn caching off.
+CACHE_DB_ENV  = 'IRG_CACHE_DB'
+_cache        = FileResultCache(dbPath=os.environ.get(CACHE_DB_ENV, None))
+_cacheEnabled = ('IRG_CACHE_DISABLE' not in os.environ)
+
+def _saveStatsAtExit():
+    try:
+        _cache.saveStats()
+    except sqlite3.Error: # The counters are not worth failing a run for
+        pass
+atexit.register(_saveStatsAtExit) # So the parent process can print the totals
+
+def getCache():
+    """Returns the cache shared by all the functions in this process"""
+    return _cache
+
+def setCacheEnabled(enabled):
+    """Turns caching of file results on or off"""
+    global _cacheEnabled
+    _cacheEnabled = enabled
+
+def setCacheDatabase(dbPath):
+    """Sets the SQLite file used to share results between processes"""
+    _cache.setDatabase(dbPath)
+
+def setDefaultCacheDatabase(dbPath):
+    """Uses dbPath to share results between processes unless IRG_CACHE_DB is already set.
+       Scripts started from this process inherit it through the environment."""
+    if not os.environ.get(CACHE_DB_ENV):
+        os.environ[CACHE_DB_ENV] = os.path.abspath(dbPath)
+    setCacheDatabase(os.environ[CACHE_DB_ENV])
+
+def getCacheStats():
+    """Returns the hit/miss counters of the shared cache"""
+    return _cache.getStats()
+
+def printCacheStats():
+    """Prints the hit/miss counters of the shared cache, and the totals of all the
+       processes sharing its database if there is one"""
+    stats = _cache.getStats()
+    print('File cache: %d hits (%d from disk), %d misses, %d stale entries evicted'
+          % (stats['hits'], stats['disk_hits'], stats['misses'], stats['evictions']))
+    stats = _cache.getDatabaseStats()
+    if stats:
+        print('File cache, all processes using %s: %d hits (%d from disk), %d misses, %d stale entries evicted'
+              % (_cache.dbPath, stats['hits'], stats['disk_hits'], stats['misses'], stats['evictions']))
+
+
+def cacheFileResult(namespace):
+    """Decorator for functions whose first argument is a file path and whose result only depends on that file"""
+
+    def decorator(function):
+        def wrapper(filePath, *args, **kwargs):
+            if not _cacheEnabled:
+                return function(filePath, *args, **kwargs)
+            # Other arguments and the metadata backend are part of the namespace so different calls don't collide
+            fullNamespace = namespace + '@' + IrgGdalFunctions.getMetadataBackend()
+            if args or kwargs:
+                fullNamespace += repr((args, sorted(kwargs.items())))
+            return _cache.get(fullNamespace, filePath, function, filePath, *args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__  = function.__doc__
+        wrapper.uncached = function # Allow callers to skip the cache
+        return wrapper
+    return decorator
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+"""IrgCatalogFunctions.py - Footprint catalogs for large collections of georeferenced images"""
+
+import sys, os, math, json
+
+import IrgGeoFunctions
+
+# File types which are added to a catalog by default
+CATALOG_EXTENSIONS = ['.cub', '.tif', '.tiff']
+
+
+def splitLonRange(minLon, maxLon):
+    """Splits a longitude range into one or two (min, max) ranges inside [-180, 180]"""
+
+    if maxLon - minLon >= 360.0:
+        return [(-180.0, 180.0)]
+
+    # Shift the range so that it starts in [-180, 180)
+    shift  = (math.fmod(minLon + 180.0, 360.0) + 360.0) % 360.0 - 180.0 - minLon
+    minLon += shift
+    maxLon += shift
+    if maxLon > 180.0: # Crosses the antimeridian
+        return [(minLon, 180.0), (-180.0, maxLon - 360.0)]
+    return [(minLon, maxLon)]
+
+def boundsOverlap(boundsA, boundsB):
+    """Returns True if two (minLon, maxLon, minLat, maxLat) boxes overlap, handling longitude wrap"""
+
+    if (boundsA[2] > boundsB[3]) or (boundsB[2] > boundsA[3]):
+        return False
+    for (minA, maxA) in splitLonRange(boundsA[0], boundsA[1]):
+        for (minB, maxB) in splitLonRange(boundsB[0], boundsB[1]):
+            if (minA <= maxB) and (minB <= maxA):
+                return True
+    return False
+
+
+def findCatalogFiles(rootFolder, extensions=CATALOG_EXTENSIONS):
+    """Returns all the files below a folder with one of the extensions"""
+
+    filePaths = []
+    for (folder, subFolders, fileNames) in os.walk(rootFolder):
+        subFolders.sort()
+        for name in sorted(fileNames):
+            if os.path.splitext(name)[1].lower() in extensions:
+                filePaths.append(os.path.abspath(os.path.join(folder, name)))
+    return filePaths
+
+
+class FootprintCatalog(object):
+    """A list of image footprints with a grid index for region and overlap queries.
+
+       Each entry is a dictionary with the path, size, mtime and bounds
+       (minLon, maxLon, minLat, maxLat) of one image."""
+
+    def __init__(self, entries=[], cellSize=2.0):
+        self.entries  = list(entries)
+        self.cellSize = cellSize
+        self._grid    = None
+
+    def save(self, catalogPath):
+        """Writes the catalog to a JSON file, replacing any existing file in one step"""
+        tempPath = catalogPath + '.tmp'
+        f = open(tempPath, 'w')
+        json.dump({'cell_size': self.cellSize, 'entries': self.entries}, f)
+        f.close()
+        os.rename(tempPath, catalogPath)
+
+    def _getCells(self, bounds):
+        """Returns the grid cells a footprint touches"""
+        size = self.cellSize
+        numCols = int(math.ceil(360.0 / size))
+        rowStart = int(math.floor((max(bounds[2], -90.0) + 90.0) / size))
+        rowStop  = int(math.floor((min(bounds[3],  90.0) + 90.0) / size))
+        cells = []
+        for (minLon, maxLon) in splitLonRange(bounds[0], bounds[1]):
+            colStart = int(math.floor((minLon + 180.0) / size))
+            colStop  = min(int(math.floor((maxLon + 180.0) / size)), numCols-1)
+            for r in range(rowStart, rowStop+1):
+                for c in range(colStart, colStop+1):
+                    cells.append((r, c))
+        return cells
+
+    def buildIndex(self):
+        """Builds the grid index, this is done automatically by the queries"""
+        self._grid = {}
+        for (i, entry) in enumerate(self.entries):
+            if entry['bounds'] is None:
+                continue
+            for cell in self._getCells(entry['bounds']):
+                self._grid.setdefault(cell, []).append(i)
+
+    def queryRegion(self, bounds):
+        """Returns the paths of all images overlapping a (minLon, maxLon, minLat, maxLat) region"""
+        if self._grid is None:
+            self.buildIndex()
+        candidates = set()
+        for cell in self._getCells(bounds):
+            candidates.update(self._grid.get(cell, []))
+        return [self.entries[i]['path'] for i in sorted(candidates)
+                if boundsOverlap(self.entries[i]['bounds'], bounds)]
+
+    def findOverlappingPairs(self):
+        """Returns a list of (pathA, pathB) for all pairs of overlapping images"""
+        if self._grid is None:
+            self.buildIndex()
+        pairs = set()
+        for indices in self._grid.values():
+            for a in range(0, len(indices)):
+                for b in range(a+1, len(indices)):
+                    pair = (indices[a], indices[b])
+                    if (pair not in pairs) and \
+                       boundsOverlap(self.entries[pair[0]]['bounds'], self.entries[pair[1]]['bounds']):
+                        pairs.add(pair)
+        return [(self.entries[a]['path'], self.entries[b]['path']) for (a, b) in sorted(pairs)]
+
+
+def loadFootprintCatalog(catalogPath):
+    """Reads a catalog written by FootprintCatalog.save"""
+    f = open(catalogPath, 'r')
+    data = json.load(f)
+    f.close()
+    return FootprintCatalog(data['entries'], data['cell_size'])
+
+
+def buildFootprintCatalog(rootFolder, catalogPath, numProcesses=None, extensions=CATALOG_EXTENSIONS):
+    """Creates or updates the catalog of all images below a folder.
+
+       Only files that are new or whose size or mtime changed are processed again.
+       Returns the updated FootprintCatalog, which is also written to catalogPath."""
+
+    # Reuse entries from the existing catalog
+    oldEntries = {}
+    cellSize   = 2.0
+    if os.path.exists(catalogPath):
+        oldCatalog = loadFootprintCatalog(catalogPath)
+        cellSize   = oldCatalog.cellSize
+        for entry in oldCatalog.entries:
+            oldEntries[entry['path']] = entry
+
+    entries  = []
+    newPaths = []
+    for path in findCatalogFiles(rootFolder, extensions):
+        fileStat = os.stat(path)
+        entry = {'path': path, 'size': fileStat.st_size, 'mtime': fileStat.st_mtime, 'bounds': None}
+        old = oldEntries.get(path)
+        if old and (old['bounds'] is not None) and \
+           (old['size'] == entry['size']) and (old['mtime'] == entry['mtime']):
+            entry['bounds'] = old['bounds']
+        else:
+            newPaths.append(path)
+        entries.append(entry)
+
+    print 'Computing footprints of ' + str(len(newPaths)) + ' new or changed files out of ' + str(len(entries))
+
+    # Compute the footprints that we need with a pool of processes
+    boundsList = IrgGeoFunctions.getImageBoundingBoxes(newPaths, numProcesses)
+    newBounds  = dict(zip(newPaths, boundsList))
+    for entry in entries:
+        if entry['path'] in newBounds:
+            entry['bounds'] = newBounds[entry['path']]
+
+    catalog = FootprintCatalog(entries, cellSize)
+    catalog.save(catalogPath)
+    return catalog
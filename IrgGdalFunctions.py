@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+"""IrgGdalFunctions.py - Selects how raster metadata is read (GDAL bindings or gdalinfo)"""
+
+import sys, os, subprocess
+
+# The GDAL python bindings are optional.  When they are not installed
+#  all metadata requests fall back to parsing the output of gdalinfo.
+try:
+    from osgeo import gdal, osr
+    gdal.UseExceptions()
+except ImportError:
+    gdal = None
+    osr  = None
+
+
+# Possible backends:
+# - auto     = Use the GDAL bindings if they are installed, otherwise gdalinfo.
+# - gdal     = Always use the GDAL bindings (in-process).
+# - gdalinfo = Always call the gdalinfo tool and parse its text output.
+METADATA_BACKENDS = ['auto', 'gdal', 'gdalinfo']
+
+# The default can be set from the environment so that spawned scripts pick it up.
+_metadataBackend = os.environ.get('IRG_METADATA_BACKEND', 'auto')
+
+
+def haveGdalBindings():
+    """Returns True if the GDAL python bindings could be imported"""
+    return (gdal is not None)
+
+def setMetadataBackend(name):
+    """Selects the backend used to read image metadata"""
+
+    global _metadataBackend
+    if name not in METADATA_BACKENDS:
+        raise Exception('Unknown metadata backend: ' + str(name))
+    if (name == 'gdal') and not haveGdalBindings():
+        raise Exception('The gdal metadata backend requires the GDAL python bindings!')
+    _metadataBackend = name
+
+def getMetadataBackend():
+    """Returns the backend that will actually be used, either 'gdal' or 'gdalinfo'"""
+
+    if _metadataBackend == 'auto':
+        if haveGdalBindings():
+            return 'gdal'
+        return 'gdalinfo'
+    return _metadataBackend
+
+
+def openImage(imagePath):
+    """Opens an image read-only with the GDAL bindings"""
+
+    if not haveGdalBindings():
+        raise Exception('Opening ' + imagePath + ' in-process requires the GDAL python bindings!')
+    if not os.path.exists(imagePath):
+        raise Exception('Image file ' + imagePath + ' not found!')
+
+    try:
+        dataset = gdal.Open(imagePath, gdal.GA_ReadOnly)
+    except RuntimeError, e:
+        raise Exception('GDAL failed to open image ' + imagePath + ': ' + str(e))
+    if dataset is None:
+        raise Exception('GDAL failed to open image ' + imagePath)
+    return dataset
+
+def callGdalInfo(imagePath, extraArgs=[]):
+    """Calls gdalinfo on an image and returns the text output"""
+
+    # Call command line tool silently
+    cmd = ['gdalinfo', imagePath] + extraArgs
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    textOutput, err = p.communicate()
+    return textOutput
@@ -19,9 +19,15 @@
 
 """IrgGeoFunctions.py - Functions for working with different geo-data formats"""
 
-import sys, os, glob, re, shutil, subprocess, string, time, errno
+import sys, os, glob, re, shutil, subprocess, string, time, errno, math, collections, multiprocessing, multiprocessing.pool
 import re
-import IrgIsisFunctions, IrgStringFunctions
+import IrgIsisFunctions, IrgStringFunctions, IrgGdalFunctions, IrgCacheFunctions, IrgSystemFunctions
+
+# NumPy is only needed for the in-process raster functions
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # This function is wrapped here for convenience
@@ -97,18 +103,122 @@ def parseGdalLonLatBounds(line):
     return numberSets
 
 
-# This can take a while if stats are requested
+@IrgCacheFunctions.cacheFileResult('image_geo_info')
 def getImageGeoInfo(imagePath, getStats=True):
-    """Obtains some image geo information from gdalinfo in dictionary format"""
+    """Obtains some image geo information in dictionary format"""
+
+    # Read the information in-process if we can, otherwise parse gdalinfo output.
+    if IrgGdalFunctions.getMetadataBackend() == 'gdal':
+        return getImageGeoInfoFromGdal(imagePath)
+    else:
+        return getImageGeoInfoFromGdalInfo(imagePath, getStats)
+
+
+def getImageGeoInfoFromGdal(imagePath):
+    """Obtains the getImageGeoInfo dictionary using the GDAL python bindings"""
+
+    outputDict = {}
+
+    dataset = IrgGdalFunctions.openImage(imagePath)
+
+    # Get the size in pixels
+    numCols = dataset.RasterXSize
+    numRows = dataset.RasterYSize
+    outputDict['image_size'] = (numCols, numRows)
+
+    # Get origin location and pixel size
+    geoTransform = dataset.GetGeoTransform()
+    outputDict['origin']     = [geoTransform[0], geoTransform[3]]
+    outputDict['pixel_size'] = [geoTransform[1], geoTransform[5]]
+
+    # Get bounding box in projected coordinates (gdalinfo uses the same formula)
+    minX = geoTransform[0]
+    maxY = geoTransform[3]
+    maxX = geoTransform[0] + numCols*geoTransform[1] + numRows*geoTransform[2]
+    minY = geoTransform[3] + numCols*geoTransform[4] + numRows*geoTransform[5]
+    outputDict['projection_bounds'] = (minX, maxX, minY, maxY)
+
+    # Get the projection strings
+    wkt   = dataset.GetProjectionRef()
+    proj4 = ''
+    if wkt:
+        srs = IrgGdalFunctions.osr.SpatialReference()
+        srs.ImportFromWkt(wkt)
+        proj4 = srs.ExportToProj4().strip()
+
+        # Convert the corners to lonlat in the same datum, like gdalinfo does.
+        try:
+            geogSrs = srs.CloneGeogCS()
+            # GDAL 3 follows the axis order of the authority (lat, lon) unless told otherwise
+            if hasattr(IrgGdalFunctions.osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                srs.SetAxisMappingStrategy(IrgGdalFunctions.osr.OAMS_TRADITIONAL_GIS_ORDER)
+                geogSrs.SetAxisMappingStrategy(IrgGdalFunctions.osr.OAMS_TRADITIONAL_GIS_ORDER)
+            transform = IrgGdalFunctions.osr.CoordinateTransformation(srs, geogSrs)
+            (minLon, maxLat, z) = transform.TransformPoint(minX, maxY)
+            (maxLon, minLat, z) = transform.TransformPoint(maxX, minY)
+            while (maxLon < minLon): # Get lon values in the same degree range
+                maxLon += 360.0
+            outputDict['lonlat_bounds'] = (minLon, maxLon, minLat, maxLat)
+        except Exception: # Projection could not be inverted
+            pass
+    outputDict['proj4'] = proj4
+
+    # Read in the ground control points in the same [[pixel, line], [x, y, z]] format
+    gcps = dataset.GetGCPs()
+    if gcps:
+        outputDict['GCPs'] = [[[g.GCPPixel, g.GCPLine], [g.GCPX, g.GCPY, g.GCPZ]] for g in gcps]
+
+    # Get some projection parameters
+    outputDict['standard_parallel_1'] = getGdalInfoTagValue(wkt, 'standard_parallel_1')
+    outputDict['central_meridian']    = getGdalInfoTagValue(wkt, 'central_meridian')
+    outputDict['projection']          = getProjectionTypeFromProj4(proj4)
+
+    # Extract this variable which ASP inserts into its point cloud files
+    pointOffsetText = dataset.GetMetadataItem('POINT_OFFSET') # Tag name must be synced with C++ code
+    if pointOffsetText:
+        offsetValues = pointOffsetText.split(' ')
+        outputDict['point_offset'] = (float(offsetValues[0]), float(offsetValues[1]), float(offsetValues[2]))
+
+    # List of dictionaries per band
+    outputDict['band_info'] = []
+    for b in range(1, dataset.RasterCount+1):
+        band     = dataset.GetRasterBand(b)
+        bandInfo = {}
+        bandInfo['type']   = IrgGdalFunctions.gdal.GetDataTypeName(band.DataType)
+        bandInfo['nodata'] = band.GetNoDataValue()
+        outputDict['band_info'].append(bandInfo)
+
+    dataset = None # Close the file
+    return outputDict
+
+
+def getProjectionTypeFromProj4(proj4Text):
+    """Returns the projection type name used by getImageGeoInfo"""
+
+    # TODO: Get the projection type!
+    if '+proj=eqc' in proj4Text:
+        return 'EQUIRECTANGULAR'
+    elif re.search('\+proj=stere(\s|\'|$)', proj4Text):
+        # Stereographic is only polar if it is centered on a pole, otherwise it is oblique
+        match = re.search('\+lat_0=([-+0-9.eE]+)', proj4Text)
+        if match and (abs(float(match.group(1))) == 90.0):
+            return 'POLAR STEREOGRAPHIC'
+        return 'UNKNOWN'
+    else:
+        return 'UNKNOWN'
+
+
+# This can take a while if stats are requested
+def getImageGeoInfoFromGdalInfo(imagePath, getStats=True):
+    """Obtains the getImageGeoInfo dictionary by parsing the output of gdalinfo"""
     
     outputDict = {}
     
     # Call command line tool silently
-    cmd = ['gdalinfo', imagePath, '-proj4']
+    args = ['-proj4']
     if getStats:
-        cmd.append('-stats')
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    textOutput, err = p.communicate()
+        args.append('-stats')
+    textOutput = IrgGdalFunctions.callGdalInfo(imagePath, args)
     
     # Get the size in pixels
     imageSizeLine = IrgStringFunctions.getLineAfterText(textOutput, 'Size is ')
@@ -164,13 +274,14 @@ def getImageGeoInfo(imagePath, getStats=True):
     outputDict['standard_parallel_1'] = getGdalInfoTagValue(textOutput, 'standard_parallel_1')
     outputDict['central_meridian']    = getGdalInfoTagValue(textOutput, 'central_meridian')
 
-    # TODO: Get the projection type!
-    if '+proj=eqc' in textOutput:
-        outputDict['projection'] = 'EQUIRECTANGULAR'
-    elif '+proj=ster' in textOutput:
-        outputDict['projection'] = 'POLAR STEREOGRAPHIC'
-    else:
-        outputDict['projection'] = 'UNKNOWN'
+    # Get the proj4 string, it is printed on the line after this text
+    outputDict['proj4'] = ''
+    proj4Pos = textOutput.find('PROJ.4 string is:')
+    if proj4Pos >= 0:
+        proj4Line = IrgStringFunctions.getLineAfterText(textOutput, '\n', proj4Pos)
+        outputDict['proj4'] = proj4Line.strip().strip("'").strip()
+
+    outputDict['projection'] = getProjectionTypeFromProj4(textOutput)
     
     # Extract this variable which ASP inserts into its point cloud files
     try:
@@ -181,32 +292,39 @@ def getImageGeoInfo(imagePath, getStats=True):
         pass # In most cases this line will not be present
 
     
-    if getStats: # TODO: Which fields are set by this?
+    # List of dictionaries per band
+    outputDict['band_info'] = []
 
-        # List of dictionaries per band
-        outputDict['band_info'] = []
+    # Populate band information
+    band = 1
+    while (True): # Loop until we run out of bands
+        bandString = 'Band ' + str(band) + ' Block='
+        bandLoc = textOutput.find(bandString)
+        if bandLoc < 0: # Ran out of bands
+            break
+        nextBandLoc = textOutput.find('Band ' + str(band+1) + ' Block=', bandLoc)
+        if nextBandLoc < 0:
+            nextBandLoc = len(textOutput)
     
-        # Populate band information
-        band = 1
-        while (True): # Loop until we run out of bands
-            bandString = 'Band ' + str(band) + ' Block='
-            bandLoc = textOutput.find(bandString)
-            if bandLoc < 0: # Ran out of bands
-                break
-        
-            # Found the band, read pertinent information
-            bandInfo = {}
-        
-            # Get the type string
-            bandLine = IrgStringFunctions.getLineAfterText(textOutput, bandString)
-            typePos  = bandLine.find('Type=')
-            commaPos = bandLine.find(',')
-            typeName = bandLine[typePos+5:commaPos-1]
-            bandInfo['type'] = typeName
-        
-            outputDict['band_info'] = bandInfo
-        
-            band = band + 1 # Move on to the next band
+        # Found the band, read pertinent information
+        bandInfo = {}
+    
+        # Get the type string
+        bandLine = IrgStringFunctions.getLineAfterText(textOutput, bandString)
+        typePos  = bandLine.find('Type=')
+        commaPos = bandLine.find(',')
+        typeName = bandLine[typePos+5:commaPos]
+        bandInfo['type'] = typeName
+
+        # Get the nodata value if this band has one
+        bandInfo['nodata'] = None
+        nodataPos = textOutput.find('NoData Value=', bandLoc, nextBandLoc)
+        if nodataPos >= 0:
+            bandInfo['nodata'] = IrgStringFunctions.getNumberAfterEqualSign(textOutput, nodataPos)
+    
+        outputDict['band_info'].append(bandInfo)
+    
+        band = band + 1 # Move on to the next band
         
     return outputDict
 
@@ -215,30 +333,429 @@ def doesImageHaveGeoData(imagePath):
     
     if not os.path.exists(imagePath):
         raise Exception('Image file ' + imagePath + ' not found!')
+
+    if IrgGdalFunctions.getMetadataBackend() == 'gdal':
+        dataset = IrgGdalFunctions.openImage(imagePath)
+        return bool(dataset.GetProjectionRef())
     
     # Call command line tool silently
-    cmd = ['gdalinfo', imagePath, '-proj4']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    textOutput, err = p.communicate()
+    textOutput = IrgGdalFunctions.callGdalInfo(imagePath, ['-proj4'])
     
     # For now we just do a very simple check
     if "Coordinate System is `'" in textOutput:
         return False
     else:
         return True
-    
 
 
-def getImageStats(imagePath):
-    """Obtains some image statistics from gdalinfo"""
-    
+#==================================================
+# Coordinate transforms.  These convert between pixel, projected and lonlat
+#  coordinates with numpy so that large numbers of points can be converted at once.
+# - Pixel coordinates follow the GDAL convention, (0,0) is the outer corner of the first pixel.
+
+# Ellipsoid (semi-major axis, inverse flattening) for the names proj4 may use
+PROJ4_ELLIPSOIDS = {'WGS84': (6378137.0, 298.257223563),
+                    'GRS80': (6378137.0, 298.257222101),
+                    'NAD83': (6378137.0, 298.257222101)}
+
+def parseProj4String(proj4Text):
+    """Returns a dictionary of the +key=value entries in a proj4 string"""
+    values = {}
+    for item in proj4Text.split():
+        if not item.startswith('+'):
+            continue
+        parts = item[1:].split('=', 1)
+        if len(parts) == 2:
+            values[parts[0]] = IrgStringFunctions.convertToFloatIfNumber(parts[1])
+        else:
+            values[parts[0]] = True
+    return values
+
+def getProj4Ellipsoid(proj4Values):
+    """Returns the (semi-major axis, eccentricity) from parsed proj4 values"""
+    if 'R' in proj4Values:
+        return (float(proj4Values['R']), 0.0)
+    if 'a' in proj4Values:
+        a = float(proj4Values['a'])
+        b = float(proj4Values.get('b', a))
+        if 'rf' in proj4Values:
+            b = a * (1.0 - 1.0/float(proj4Values['rf']))
+        return (a, math.sqrt(1.0 - (b*b)/(a*a)))
+    name = proj4Values.get('datum', proj4Values.get('ellps', None))
+    if name in PROJ4_ELLIPSOIDS:
+        (a, rf) = PROJ4_ELLIPSOIDS[name]
+        f = 1.0 / rf
+        return (a, math.sqrt(2*f - f*f))
+    raise Exception('Unable to determine the ellipsoid from proj4 values: ' + str(proj4Values))
+
+
+class ImageGeoTransform(object):
+    """Converts arrays of pixel, projected and lonlat coordinates for one image.
+
+       Supports the EQUIRECTANGULAR and POLAR STEREOGRAPHIC projections that
+       getImageGeoInfo recognizes.  All angles are in degrees."""
+
+    def __init__(self, geoTransform, projection, proj4Text):
+        # Affine transform in GDAL order: (originX, dX/dCol, dX/dRow, originY, dY/dCol, dY/dRow)
+        self.geoTransform = tuple([float(v) for v in geoTransform])
+        self.projection   = projection
+        self.proj4        = proj4Text
+
+        (x0, a, b, y0, d, e) = self.geoTransform
+        determinant = a*e - b*d
+        if determinant == 0:
+            raise Exception('Geotransform is not invertible: ' + str(geoTransform))
+        self._inverse = (e/determinant, -b/determinant, -d/determinant, a/determinant)
+
+        values = parseProj4String(proj4Text)
+        (self.radius, self.eccentricity) = getProj4Ellipsoid(values)
+        self.centralMeridian  = math.radians(float(values.get('lon_0', 0.0)))
+        self.latitudeOfOrigin = math.radians(float(values.get('lat_0', 0.0)))
+        self.falseEasting     = float(values.get('x_0', 0.0))
+        self.falseNorthing    = float(values.get('y_0', 0.0))
+
+        if projection == 'EQUIRECTANGULAR':
+            self.trueScaleLatitude = math.radians(float(values.get('lat_ts', 0.0)))
+        elif projection == 'POLAR STEREOGRAPHIC':
+            if abs(float(values.get('lat_0', 0.0))) != 90.0:
+                raise Exception('Stereographic projection is not polar: ' + proj4Text)
+            self.isSouth = (self.latitudeOfOrigin < 0)
+            self.trueScaleLatitude = abs(math.radians(float(values.get('lat_ts', math.degrees(self.latitudeOfOrigin)))))
+            scale = float(values.get('k', values.get('k_0', 1.0)))
+            ecc   = self.eccentricity
+            # Ratio between rho and the t function (Snyder 21-33/21-34)
+            if abs(self.trueScaleLatitude - math.pi/2) > 1e-10:
+                sinTs = math.sin(self.trueScaleLatitude)
+                mC = math.cos(self.trueScaleLatitude) / math.sqrt(1 - ecc*ecc*sinTs*sinTs)
+                self._rhoOverT = self.radius * mC / self._computeT(self.trueScaleLatitude)
+            else:
+                self._rhoOverT = (2 * self.radius * scale /
+                                  math.sqrt(math.pow(1+ecc, 1+ecc) * math.pow(1-ecc, 1-ecc)))
+        else:
+            raise Exception('Unsupported projection type: ' + str(projection))
+
+    def _computeT(self, lat):
+        """Snyder's t function for the polar stereographic projection"""
+        ecc    = self.eccentricity
+        sinLat = numpy.sin(lat)
+        return numpy.tan(math.pi/4 - lat/2) / numpy.power((1 - ecc*sinLat) / (1 + ecc*sinLat), ecc/2)
+
+    # Pixel <-> projected
+
+    def pixelToProjected(self, col, row):
+        """Returns (x, y) arrays for arrays of pixel coordinates"""
+        col = numpy.asarray(col, dtype=numpy.float64)
+        row = numpy.asarray(row, dtype=numpy.float64)
+        (x0, a, b, y0, d, e) = self.geoTransform
+        return (x0 + a*col + b*row, y0 + d*col + e*row)
+
+    def projectedToPixel(self, x, y):
+        """Returns (col, row) arrays for arrays of projected coordinates"""
+        dx = numpy.asarray(x, dtype=numpy.float64) - self.geoTransform[0]
+        dy = numpy.asarray(y, dtype=numpy.float64) - self.geoTransform[3]
+        (ia, ib, id, ie) = self._inverse
+        return (ia*dx + ib*dy, id*dx + ie*dy)
+
+    # Projected <-> lonlat
+
+    def lonLatToProjected(self, lon, lat):
+        """Returns (x, y) arrays for arrays of lon, lat in degrees"""
+        lon = numpy.radians(numpy.asarray(lon, dtype=numpy.float64))
+        lat = numpy.radians(numpy.asarray(lat, dtype=numpy.float64))
+
+        if self.projection == 'EQUIRECTANGULAR':
+            x = self.radius * (lon - self.centralMeridian) * math.cos(self.trueScaleLatitude)
+            y = self.radius * (lat - self.latitudeOfOrigin)
+            return (x + self.falseEasting, y + self.falseNorthing)
+
+        # Polar stereographic, the south case is the north case mirrored (Snyder p. 161)
+        dLon = lon - self.centralMeridian
+        if self.isSouth:
+            lat  = -lat
+            dLon = -dLon
+        rho = self._rhoOverT * self._computeT(lat)
+        x   =  rho * numpy.sin(dLon)
+        y   = -rho * numpy.cos(dLon)
+        if self.isSouth:
+            x = -x
+            y = -y
+        return (x + self.falseEasting, y + self.falseNorthing)
+
+    def projectedToLonLat(self, x, y):
+        """Returns (lon, lat) arrays in degrees for arrays of projected coordinates.
+
+           Longitudes are in the 360 degree range centered on the central meridian,
+           so a projection with lon_0=180 gives 0-360 values like the projection tools do."""
+        x = numpy.asarray(x, dtype=numpy.float64) - self.falseEasting
+        y = numpy.asarray(y, dtype=numpy.float64) - self.falseNorthing
+
+        if self.projection == 'EQUIRECTANGULAR':
+            lon = self.centralMeridian + x / (self.radius * math.cos(self.trueScaleLatitude))
+            lat = self.latitudeOfOrigin + y / self.radius
+            return (numpy.degrees(lon), numpy.degrees(lat))
+
+        if self.isSouth:
+            x = -x
+            y = -y
+        rho  = numpy.hypot(x, y)
+        t    = rho / self._rhoOverT
+        dLon = numpy.arctan2(x, -y)
+
+        # Iterate for the latitude on an ellipsoid (Snyder 7-9), one pass is exact for a sphere
+        ecc = self.eccentricity
+        lat = math.pi/2 - 2*numpy.arctan(t)
+        for i in range(0, 15):
+            sinLat = numpy.sin(lat)
+            lat = math.pi/2 - 2*numpy.arctan(t * numpy.power((1 - ecc*sinLat) / (1 + ecc*sinLat), ecc/2))
+            if ecc == 0:
+                break
+
+        if self.isSouth:
+            lat  = -lat
+            dLon = -dLon
+        lon = numpy.degrees(self.centralMeridian + dLon)
+        lon = normalizeLongitude(lon, math.degrees(self.centralMeridian))
+        return (lon, numpy.degrees(lat))
+
+    # Pixel <-> lonlat
+
+    def pixelToLonLat(self, col, row):
+        """Returns (lon, lat) arrays in degrees for arrays of pixel coordinates"""
+        (x, y) = self.pixelToProjected(col, row)
+        return self.projectedToLonLat(x, y)
+
+    def lonLatToPixel(self, lon, lat):
+        """Returns (col, row) arrays for arrays of lon, lat in degrees"""
+        (x, y) = self.lonLatToProjected(lon, lat)
+        return self.projectedToPixel(x, y)
+
+
+def getGeoTransformFromGeoInfo(geoInfo):
+    """Builds an ImageGeoTransform from a getImageGeoInfo dictionary"""
+
+    if numpy is None:
+        raise Exception('Coordinate transforms require numpy!')
+    if not geoInfo.get('proj4'):
+        raise Exception('Image has no projection information!')
+
+    (originX, originY)       = geoInfo['origin']
+    (pixelSizeX, pixelSizeY) = geoInfo['pixel_size']
+    geoTransform = (originX, pixelSizeX, 0.0, originY, 0.0, pixelSizeY)
+    return ImageGeoTransform(geoTransform, geoInfo['projection'], geoInfo['proj4'])
+
+def getImageGeoTransform(imagePath):
+    """Builds an ImageGeoTransform for a georeferenced image"""
+    return getGeoTransformFromGeoInfo(getImageGeoInfo(imagePath, False))
+
+
+class RasterBlockReader(object):
+    """Reads windows from one band of an image through an LRU cache of its internal blocks.
+
+       Useful when many nearby windows are read from the same large image, such as a DEM."""
+
+    def __init__(self, imagePath, band=1, maxBlocks=256):
+        if numpy is None:
+            raise Exception('RasterBlockReader requires numpy!')
+        self.dataset   = IrgGdalFunctions.openImage(imagePath)
+        self.band      = self.dataset.GetRasterBand(band)
+        self.nodata    = self.band.GetNoDataValue()
+        self.numCols   = self.dataset.RasterXSize
+        self.numRows   = self.dataset.RasterYSize
+        (self.blockWidth, self.blockHeight) = self.band.GetBlockSize()
+        self.maxBlocks = maxBlocks
+        self._blocks   = collections.OrderedDict()
+        self.blockReads = 0 # Number of blocks read from the file
+
+    def _getBlock(self, blockRow, blockCol):
+        """Returns one block as float64 with nodata values set to NaN"""
+        key   = (blockRow, blockCol)
+        block = self._blocks.pop(key, None)
+        if block is None:
+            x = blockCol * self.blockWidth
+            y = blockRow * self.blockHeight
+            block = self.band.ReadAsArray(x, y, min(self.blockWidth,  self.numCols - x),
+                                                min(self.blockHeight, self.numRows - y)).astype(numpy.float64)
+            if self.nodata is not None:
+                block[block == self.nodata] = numpy.nan
+            self.blockReads += 1
+            while len(self._blocks) >= self.maxBlocks:
+                self._blocks.popitem(last=False)
+        self._blocks[key] = block # Most recently used position
+        return block
+
+    def readWindow(self, x, y, width, height):
+        """Returns a (height, width) float64 array, nodata values are NaN"""
+        if (x < 0) or (y < 0) or (x+width > self.numCols) or (y+height > self.numRows):
+            raise Exception('Window is outside of the image')
+        output = numpy.empty((height, width), dtype=numpy.float64)
+        for blockRow in range(y // self.blockHeight, (y+height-1) // self.blockHeight + 1):
+            top = blockRow * self.blockHeight
+            y0  = max(y, top)
+            y1  = min(y+height, top + self.blockHeight)
+            for blockCol in range(x // self.blockWidth, (x+width-1) // self.blockWidth + 1):
+                left = blockCol * self.blockWidth
+                x0   = max(x, left)
+                x1   = min(x+width, left + self.blockWidth)
+                block = self._getBlock(blockRow, blockCol)
+                output[y0-y:y1-y, x0-x:x1-x] = block[y0-top:y1-top, x0-left:x1-left]
+        return output
+
+
+#==================================================
+# In-process statistics engine.  The raster is streamed in chunks aligned to its
+#  internal blocks and each chunk produces statistics which are merged together.
+
+class BandStatistics(object):
+    """Mergeable count/min/max/mean/variance accumulator for one band"""
+
+    def __init__(self):
+        self.count = 0
+        self.min   = None
+        self.max   = None
+        self.mean  = 0.0
+        self.m2    = 0.0 # Sum of squared differences from the mean
+
+    def addValues(self, values):
+        """Adds a numpy array of valid values"""
+        if values.size == 0:
+            return
+        other = BandStatistics()
+        values      = values.astype(numpy.float64)
+        other.count = values.size
+        other.min   = float(values.min())
+        other.max   = float(values.max())
+        other.mean  = float(values.mean())
+        other.m2    = float(numpy.square(values - other.mean).sum())
+        self.merge(other)
+
+    def merge(self, other):
+        """Combines the statistics of another accumulator into this one"""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            (self.count, self.min, self.max, self.mean, self.m2) = \
+                (other.count, other.min, other.max, other.mean, other.m2)
+            return
+        # Pairwise update of the mean and variance (Chan et al.)
+        total     = self.count + other.count
+        delta     = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / total
+        self.m2   = self.m2 + other.m2 + delta*delta * self.count * other.count / total
+        self.count = total
+        self.min   = min(self.min, other.min)
+        self.max   = max(self.max, other.max)
+
+    def getVariance(self):
+        """Population variance, the same one gdalinfo reports"""
+        if self.count == 0:
+            return None
+        return self.m2 / self.count
+
+    def getTuple(self):
+        """Returns (min, max, mean, std) like getImageStats"""
+        if self.count == 0:
+            return (None, None, None, None)
+        return (self.min, self.max, self.mean, math.sqrt(self.getVariance()))
+
+
+def getImageChunks(dataset, minChunkPixels=1024*1024):
+    """Returns a list of (x, y, width, height) chunks that line up with the image blocks"""
+
+    numCols = dataset.RasterXSize
+    numRows = dataset.RasterYSize
+    (blockWidth, blockHeight) = dataset.GetRasterBand(1).GetBlockSize()
+
+    # Small blocks (such as single-row strips) are grouped so each read is a reasonable size
+    blocksPerChunk = max(1, minChunkPixels // (blockWidth*blockHeight))
+    if blockWidth >= numCols: # Strips, stack them vertically
+        chunkWidth  = numCols
+        chunkHeight = blockHeight * blocksPerChunk
+    else: # Tiles, make a square group of them
+        side        = max(1, int(math.sqrt(blocksPerChunk)))
+        chunkWidth  = blockWidth  * side
+        chunkHeight = blockHeight * side
+
+    chunks = []
+    for y in range(0, numRows, chunkHeight):
+        for x in range(0, numCols, chunkWidth):
+            chunks.append((x, y, min(chunkWidth, numCols-x), min(chunkHeight, numRows-y)))
+    return chunks
+
+
+def computeChunkStatistics(imagePath, chunks):
+    """Returns a list of BandStatistics, one per band, for a list of chunks"""
+
+    # Each thread opens its own handle, GDAL datasets are not thread safe
+    dataset  = IrgGdalFunctions.openImage(imagePath)
+    numBands = dataset.RasterCount
+    nodataValues = [dataset.GetRasterBand(b).GetNoDataValue() for b in range(1, numBands+1)]
+
+    bandStats = [BandStatistics() for b in range(0, numBands)]
+    for (x, y, width, height) in chunks:
+        data = dataset.ReadAsArray(x, y, width, height)
+        if numBands == 1:
+            data = data.reshape((1,) + data.shape)
+        for b in range(0, numBands):
+            values = data[b]
+            valid  = numpy.ones(values.shape, dtype=bool)
+            if values.dtype.kind == 'f':
+                valid = numpy.isfinite(values)
+            if nodataValues[b] is not None:
+                valid &= (values != nodataValues[b])
+            bandStats[b].addValues(values[valid])
+
+    dataset = None # Close the file
+    return bandStats
+
+
+def computeImageStatistics(imagePath, numThreads=None, sampleStep=1):
+    """Computes a BandStatistics object for each band of an image without any external tool.
+
+       With sampleStep=k only every k-th chunk is read, giving a faster approximate answer."""
+
     if not os.path.exists(imagePath):
         raise Exception('Image file ' + imagePath + ' not found!')
+    if numpy is None:
+        raise Exception('computeImageStatistics requires numpy!')
+
+    dataset  = IrgGdalFunctions.openImage(imagePath)
+    numBands = dataset.RasterCount
+    chunks   = getImageChunks(dataset)[::max(1, sampleStep)]
+    dataset  = None
+
+    if not numThreads:
+        numThreads = IrgSystemFunctions.get_num_cpus()
+    numThreads = max(1, min(numThreads, len(chunks)))
+
+    # Deal the chunks out to the threads, each thread returns partial statistics
+    chunkLists = [chunks[i::numThreads] for i in range(0, numThreads)]
+    pool = multiprocessing.pool.ThreadPool(numThreads)
+    try:
+        partialStats = pool.map(lambda c: computeChunkStatistics(imagePath, c), chunkLists)
+    finally:
+        pool.close()
+        pool.join()
+
+    bandStats = [BandStatistics() for b in range(0, numBands)]
+    for partial in partialStats:
+        for b in range(0, numBands):
+            bandStats[b].merge(partial[b])
+    return bandStats
+
+
+def getImageStats(imagePath, numThreads=None, sampleStep=1):
+    """Obtains (min, max, mean, std) statistics for each band of an image"""
     
+    if not os.path.exists(imagePath):
+        raise Exception('Image file ' + imagePath + ' not found!')
+
+    # Compute the statistics in-process if possible, this never writes a .aux.xml file.
+    if (IrgGdalFunctions.getMetadataBackend() == 'gdal') and (numpy is not None):
+        bandStats = computeImageStatistics(imagePath, numThreads, sampleStep)
+        return [s.getTuple() for s in bandStats]
+
     # Call command line tool silently
-    cmd = ['gdalinfo', imagePath, '-stats']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    textOutput, err = p.communicate()
+    textOutput = IrgGdalFunctions.callGdalInfo(imagePath, ['-stats'])
     
     # Statistics are computed seperately for each band
     bandStats = []
@@ -265,15 +782,156 @@ def getImageStats(imagePath):
         bandStats.append( (bandMin, bandMax, bandMean, bandStd) )
             
         band = band + 1 # Move to the next band
+
+
+def readValidPixelMask(imagePath):
+    """Returns a list of rows of booleans which are True where the first band of an image has data.
+       Meant for small images such as low resolution previews."""
+
+    if not os.path.exists(imagePath):
+        raise Exception('Image file ' + imagePath + ' not found!')
+
+    # Read the pixels in-process if possible
+    if (IrgGdalFunctions.getMetadataBackend() == 'gdal') and (numpy is not None):
+        dataset = IrgGdalFunctions.openImage(imagePath)
+        band    = dataset.GetRasterBand(1)
+        values  = band.ReadAsArray()
+        valid   = numpy.ones(values.shape, dtype=bool)
+        if values.dtype.kind == 'f':
+            valid = numpy.isfinite(values)
+        if band.GetNoDataValue() is not None:
+            valid &= (values != band.GetNoDataValue())
+        dataset = None # Close the file
+        return valid.tolist()
+
+    # Otherwise convert the image to an ASCII grid and parse it
+    asciiPath = os.path.splitext(imagePath)[0] + '_mask.asc'
+    cmd = ['gdal_translate', '-q', '-b', '1', '-of', 'AAIGrid', imagePath, asciiPath]
+    if subprocess.call(cmd) != 0:
+        raise Exception('Failed to convert image ' + imagePath + ' to an ASCII grid!')
+    numCols = None
+    nodata  = None
+    mask    = []
+    f = open(asciiPath, 'r')
+    for line in f:
+        parts = line.split()
+        if not parts:
+            continue
+        key = parts[0].lower()
+        if key == 'ncols':
+            numCols = int(parts[1])
+        elif key == 'nodata_value':
+            nodata = float(parts[1])
+        elif key[0].isalpha() and (len(parts) == 2): # Other header lines
+            continue
+        else: # Rows may be split across lines
+            for v in parts:
+                if (not mask) or (len(mask[-1]) == numCols):
+                    mask.append([])
+                value = float(v)
+                mask[-1].append((value == value) and (value != nodata))
+    f.close()
+    for path in glob.glob(os.path.splitext(asciiPath)[0] + '.*'): # Also removes the .prj file
+        os.remove(path)
+    return mask
     
 
+def normalizeLongitude(lon, centerLon=0.0):
+    """Wraps longitudes in degrees into [centerLon-180, centerLon+180)"""
+    return numpy.mod(numpy.asarray(lon, dtype=numpy.float64) - centerLon + 180.0, 360.0) + centerLon - 180.0
+
+def getLonLatBoundsFromPoints(lon, lat, centerLon=0.0):
+    """Returns (minLon, maxLon, minLat, maxLat) for arrays of points in degrees.
+
+       The longitude range is the shortest one containing all the points, so it
+       handles images crossing the antimeridian.  minLon is in
+       [centerLon-180, centerLon+180) and maxLon may be past the upper end."""
+
+    lon = numpy.unique(normalizeLongitude(lon, centerLon))
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+
+    # The range is everything except the largest gap between neighboring longitudes
+    gaps     = numpy.diff(numpy.append(lon, lon[0] + 360.0))
+    gapIndex = int(numpy.argmax(gaps))
+    minLon   = float(lon[(gapIndex + 1) % len(lon)])
+    maxLon   = float(lon[gapIndex])
+    while (maxLon < minLon): # Get lon values in the same degree range
+        maxLon += 360.0
+
+    return (minLon, maxLon, float(lat.min()), float(lat.max()))
+
+
+def getImageEdgePixels(imageSize, numEdgeSamples):
+    """Returns (col, row) arrays of points evenly spaced along the outer edge of an image"""
+
+    (width, height) = (float(imageSize[0]), float(imageSize[1]))
+    steps = numpy.linspace(0.0, 1.0, numEdgeSamples)
+    cols  = numpy.concatenate([steps*width,  numpy.full(numEdgeSamples, width), steps*width,  numpy.zeros(numEdgeSamples)])
+    rows  = numpy.concatenate([numpy.zeros(numEdgeSamples), steps*height, numpy.full(numEdgeSamples, height), steps*height])
+    return (cols, rows)
+
+
+# proj4 entries which ImageGeoTransform ignores, if any of them is present the results would be wrong
+PROJ4_UNSUPPORTED_KEYS = ['to_meter', 'vto_meter', 'pm', 'axis', 'towgs84', 'nadgrids', 'geoidgrids', 'south']
+
+def getExactGeoTransform(geoInfo):
+    """Returns the ImageGeoTransform for a getImageGeoInfo dictionary, or None if it
+       can't reproduce the projection of the image exactly"""
+
+    if (numpy is None) or (not geoInfo.get('proj4')) or \
+       (geoInfo['projection'] not in ['EQUIRECTANGULAR', 'POLAR STEREOGRAPHIC']):
+        return None
+    values = parseProj4String(geoInfo['proj4'])
+    if (values.get('units', 'm') != 'm') or any([key in values for key in PROJ4_UNSUPPORTED_KEYS]):
+        return None
+    try:
+        return getGeoTransformFromGeoInfo(geoInfo)
+    except Exception: # Unknown ellipsoid or a variant of the projection we don't handle
+        return None
+
+def computeGeoTiffBoundingBox(geoInfo, numEdgeSamples=256):
+    """Computes (minLon, maxLon, minLat, maxLat) from a getImageGeoInfo dictionary.
+
+       The longitudes keep the convention of the image's projection, e.g. 0-360 for
+       a Mars product with lon_0=180, matching what geoRefTool prints.
+       Returns None if ImageGeoTransform can't handle the projection exactly."""
+
+    transform = getExactGeoTransform(geoInfo)
+    if transform is None:
+        return None
+    imageSize = geoInfo['image_size']
+
+    # Straight lines in pixel space curve in lonlat space for polar images, so sample the whole edge.
+    (cols, rows) = getImageEdgePixels(imageSize, numEdgeSamples)
+    (lon, lat)   = transform.pixelToLonLat(cols, rows)
+    centerLon    = math.degrees(transform.centralMeridian)
+    bounds = getLonLatBoundsFromPoints(lon, lat, centerLon)
+
+    # If a pole is inside the image every longitude is covered
+    if transform.projection == 'POLAR STEREOGRAPHIC':
+        (poleCol, poleRow) = transform.projectedToPixel(transform.falseEasting, transform.falseNorthing)
+        if (0 <= poleCol <= imageSize[0]) and (0 <= poleRow <= imageSize[1]):
+            (minLon, maxLon) = (centerLon - 180.0, centerLon + 180.0)
+            if transform.isSouth:
+                bounds = (minLon, maxLon, -90.0, bounds[3])
+            else:
+                bounds = (minLon, maxLon, bounds[2], 90.0)
+    return bounds
+
+
+@IrgCacheFunctions.cacheFileResult('geotiff_bounding_box')
 def getGeoTiffBoundingBox(geoTiffPath):
     """Returns (minLon, maxLon, minLat, maxLat) for a geotiff image"""
     
     if not os.path.exists(geoTiffPath):
         raise Exception('Input file does not exist: ' + geoTiffPath)
+
+    # Compute the bounds in-process if we support the projection
+    bounds = computeGeoTiffBoundingBox(getImageGeoInfo(geoTiffPath, False))
+    if bounds is not None:
+        return bounds
     
-    # Call command line tool silently
+    # Otherwise call command line tool silently
     cmd = ['geoRefTool', '--printBounds', geoTiffPath]
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
     textOutput, err = p.communicate()
@@ -304,50 +962,18 @@ def getProjectedBoundsFromIsisLabel(filePath):
         raise Exception('Error, missing label file path!')
     
     # Read all the values!
-    minX    = None
-    maxY    = None
-    pixRes  = None
-    numRows = None
-    numCols = None
-    f = open(filePath, 'r')
-    for line in f:
-        if ('UpperLeftCornerX' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            endPos = s.find('<')
-            if (endPos >= 0):
-                minX = float(s[:endPos-1])
-            else:
-                minX = float(s)
-            continue
-        if ('UpperLeftCornerY' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            endPos = s.find('<')
-            if (endPos >= 0):
-                maxY = float(s[:endPos-1])
-            else:
-                maxY = float(s)
-            continue
-        if ('PixelResolution' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            endPos = s.find('<')
-            if (endPos >= 0):
-                pixRes = float(s[:endPos-1])
-            else:
-                pixRes = float(s)
-            continue
-        if ('      Samples =' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            numCols = float(s)
-            continue
-        if ('      Lines   =' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            numRows = float(s)
-            continue
+    label   = IrgIsisFunctions.readIsisLabel(filePath)
+    minX    = IrgIsisFunctions.getPvlValue(label, 'IsisCube/Mapping/UpperLeftCornerX')
+    maxY    = IrgIsisFunctions.getPvlValue(label, 'IsisCube/Mapping/UpperLeftCornerY')
+    pixRes  = IrgIsisFunctions.getPvlValue(label, 'IsisCube/Mapping/PixelResolution')
+    numCols = IrgIsisFunctions.getPvlValue(label, 'IsisCube/Core/Dimensions/Samples')
+    numRows = IrgIsisFunctions.getPvlValue(label, 'IsisCube/Core/Dimensions/Lines')
         
-    f.close()
-    if (not minX) or (not maxY) or (not pixRes) or (not numRows) or (not numCols):
+    if (minX is None) or (maxY is None) or (not pixRes) or (not numRows) or (not numCols):
         raise Exception('Failed to find projected bounds in file ' + filePath)
 
+    (minX, maxY, pixRes) = (float(minX), float(maxY), float(pixRes))
+
     # Compute the other bounds
     maxX = minX + pixRes*numCols
     minY = maxY - pixRes*numRows
@@ -360,15 +986,12 @@ def getProjectionFromIsisLabel(filePath):
     if not os.path.exists(filePath):
         raise Exception('Error, missing label file path!')
     
-    f = open(filePath, 'r')
-    for line in f:
-        if ('MAP_PROJECTION_TYPE          =' in line) or ('ProjectionName     =' in line):
-            line = line.replace('"','') # Strip quotes
-            projType = IrgStringFunctions.getLineAfterText(line, '=').strip()
-            f.close()
-            return projType
-    f.close()
-    raise Exception('Unable to find projection type in file ' + filePath)
+    label    = IrgIsisFunctions.readIsisLabel(filePath)
+    projType = IrgIsisFunctions.getPvlValue(label, ['IMAGE_MAP_PROJECTION/MAP_PROJECTION_TYPE',
+                                                    'IsisCube/Mapping/ProjectionName'])
+    if projType is None:
+        raise Exception('Unable to find projection type in file ' + filePath)
+    return projType
 
 def getBoundingBoxFromIsisLabel(filePath):
     '''Function to read the bounding box from an ISIS label file'''
@@ -376,53 +999,23 @@ def getBoundingBoxFromIsisLabel(filePath):
     if not os.path.exists(filePath):
         raise Exception('Error, missing label file path!')
     
-    numFound = 0
-    f = open(filePath, 'r')
-    for line in f:
-        if ('MINIMUM_LATITUDE' in line) or ('MinimumLatitude' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            endPos = s.find('<')
-            if (endPos >= 0):
-                minLat = float(s[:endPos-1])
-            else:
-                minLat = float(s)
-            numFound = numFound + 1
-            continue
-        if ('MAXIMUM_LATITUDE' in line) or ('MaximumLatitude' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            endPos = s.find('<')
-            if (endPos >= 0):
-                maxLat = float(s[:endPos-1])
-            else:
-                maxLat = float(s)
-            numFound = numFound + 1
-            continue
-        if ('EASTERNMOST_LONGITUDE' in line) or ('MAXIMUM_LONGITUDE' in line)  or ('MaximumLongitude' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            endPos = s.find('<') # Check for unit name
-            if (endPos >= 0):
-                maxLon = float(s[:endPos-1])
-            else:
-                maxLon = float(s)
-            numFound = numFound + 1
-            continue
-        if ('WESTERNMOST_LONGITUDE' in line) or ('MINIMUM_LONGITUDE' in line) or ('MinimumLongitude' in line):
-            s = IrgStringFunctions.getLineAfterText(line, '=')
-            endPos = s.find('<') # Check for unit name
-            if (endPos >= 0):
-                minLon = float(s[:endPos-1])
-            else:
-                minLon = float(s)
-            numFound = numFound + 1
-            continue
-        if numFound == 4:
-            break
+    label  = IrgIsisFunctions.readIsisLabel(filePath)
+    # PDS labels have the bounds in IMAGE_MAP_PROJECTION, ISIS labels in the Mapping group
+    minLat = IrgIsisFunctions.getPvlValue(label, ['IMAGE_MAP_PROJECTION/MINIMUM_LATITUDE',
+                                                  'IsisCube/Mapping/MinimumLatitude'])
+    maxLat = IrgIsisFunctions.getPvlValue(label, ['IMAGE_MAP_PROJECTION/MAXIMUM_LATITUDE',
+                                                  'IsisCube/Mapping/MaximumLatitude'])
+    maxLon = IrgIsisFunctions.getPvlValue(label, ['IMAGE_MAP_PROJECTION/EASTERNMOST_LONGITUDE',
+                                                  'IMAGE_MAP_PROJECTION/MAXIMUM_LONGITUDE',
+                                                  'IsisCube/Mapping/MaximumLongitude'])
+    minLon = IrgIsisFunctions.getPvlValue(label, ['IMAGE_MAP_PROJECTION/WESTERNMOST_LONGITUDE',
+                                                  'IMAGE_MAP_PROJECTION/MINIMUM_LONGITUDE',
+                                                  'IsisCube/Mapping/MinimumLongitude'])
 
-    f.close()
-    if numFound < 4:
+    if (minLat is None) or (maxLat is None) or (minLon is None) or (maxLon is None):
         raise Exception('Failed to find lat/lon bounds in file ' + filePath)
 
-    return (minLon, maxLon, minLat, maxLat)
+    return (float(minLon), float(maxLon), float(minLat), float(maxLat))
 
 
 def getImageBoundingBox(filePath):
@@ -435,19 +1028,44 @@ def getImageBoundingBox(filePath):
         return getGeoTiffBoundingBox(filePath)
           
     # Any other file types will end up raising some sort of exception
+
+
+def getBoundingBoxOrNone(filePath):
+    """Calls getImageBoundingBox, printing the error and returning None if it fails"""
+    try:
+        return getImageBoundingBox(filePath)
+    except Exception, e:
+        print 'Failed to get bounding box of ' + filePath + ': ' + str(e)
+        return None
+
+def getImageBoundingBoxes(filePaths, numProcesses=None):
+    """Returns a list with the getImageBoundingBox result for each file, None for files that failed.
+
+       The files are processed by a pool of processes and only the bounds are kept in memory."""
+
+    if not numProcesses:
+        numProcesses = IrgSystemFunctions.get_num_cpus()
+    if (numProcesses <= 1) or (len(filePaths) <= 1):
+        return [getBoundingBoxOrNone(f) for f in filePaths]
+
+    pool = multiprocessing.Pool(min(numProcesses, len(filePaths)))
+    try:
+        chunkSize = max(1, min(64, len(filePaths) // (4*numProcesses)))
+        boundsList = list(pool.imap(getBoundingBoxOrNone, filePaths, chunkSize))
+    finally:
+        pool.close()
+        pool.join()
+    return boundsList
     
     
     
     
 
-def build_vrt( fullImageSize, tileLocs, tilePaths, outputPath ):
+def build_vrt( fullImageSize, tileLocs, tilePaths, outputPath, numThreads=8 ):
     """Generates a VRT file from a set of image tiles and their locations in the output image"""
 
     outputFolder = os.path.dirname(outputPath)
 
-    f = open(outputPath, 'w')
-    f.write("<VRTDataset rasterXSize=\"%i\" rasterYSize=\"%i\">\n" % (int(fullImageSize[0]),int(fullImageSize[1])) ) # Write whole image size
-
     #
     ## If a tile is missing, for example, in the case we
     ## skipped it when it does not intersect user's crop box,
@@ -465,48 +1083,56 @@ def build_vrt( fullImageSize, tileLocs, tilePaths, outputPath ):
 
     
     # Read some metadata from one of the tiles
-    gdalInfo = getImageGeoInfo(tilePaths[0])
+    # - Only the band count and type are needed so skip the statistics pass.
+    gdalInfo = getImageGeoInfo(tilePaths[0], False)
     
     num_bands = len(gdalInfo['band_info'])
     data_type = gdalInfo['band_info'][0]['type']
 
+    # Get the size of every tile once, several at a time since each one may launch a process.
+    tileSizes = [gdalInfo['image_size']]
+    if len(tilePaths) > 1:
+        pool = multiprocessing.pool.ThreadPool(max(1, min(numThreads, len(tilePaths)-1)))
+        try:
+            tileSizes += pool.map(getImageSize, tilePaths[1:])
+        finally:
+            pool.close()
+            pool.join()
+
+    # Assemble the whole file in memory and write it at once
+    lines = []
+    lines.append("<VRTDataset rasterXSize=\"%i\" rasterYSize=\"%i\">\n" % (int(fullImageSize[0]),int(fullImageSize[1])) ) # Write whole image size
+
     # This special metadata value is only used for ASP stereo point cloud files!    
     if 'point_offset' in gdalInfo:
-        f.write("  <Metadata>\n    <MDI key=\"" + 'POINT_OFFSET' + "\">" +
-                gdalInfo['point_offset'][0] + "</MDI>\n  </Metadata>\n")
-      
+        offsetText = ' '.join([repr(v) for v in gdalInfo['point_offset']])
+        lines.append("  <Metadata>\n    <MDI key=\"" + 'POINT_OFFSET' + "\">" +
+                     offsetText + "</MDI>\n  </Metadata>\n")
 
-    # Write each band
-    for b in range( 1, num_bands + 1 ):
-        f.write("  <VRTRasterBand dataType=\"%s\" band=\"%i\">\n" % (data_type, b) ) # Write band data type and index
+    # The source entries only differ by band number, so build the per-tile text once.
+    tileSources = []
+    for tile, tileLoc, imageSize in zip(tilePaths, tileLocs, tileSizes):
 
-        for tile, tileLoc in zip(tilePaths, tileLocs):
-            filename  = tile
-            
-            imageSize = getImageSize(filename) # Get the image size for this tile
+        ## Replace missing tile paths with the good tile we found earlier
+        #if not os.path.isfile(filename): filename = goodFilename
 
-            ## Replace missing tile paths with the good tile we found earlier
-            #if not os.path.isfile(filename): filename = goodFilename
+        relative = os.path.relpath(tile, outputFolder) # Relative path from the output file to the input tile
+        relative = relative.replace("%", "%%") # The band number is filled in below
+        tileSources.append(("    <SimpleSource>\n" +
+                            "       <SourceFilename relativeToVRT=\"1\">%s</SourceFilename>\n" % relative + # Write relative path
+                            "       <SourceBand>%i</SourceBand>\n" +
+                            "       <SrcRect xOff=\"%i\" yOff=\"%i\" xSize=\"%i\" ySize=\"%i\"/>\n" % (tileLoc[0], tileLoc[1], imageSize[0], imageSize[1]) + # Source ROI (entire tile)
+                            "       <DstRect xOff=\"%i\" yOff=\"%i\" xSize=\"%i\" ySize=\"%i\"/>\n" % (tileLoc[0], tileLoc[1], imageSize[0], imageSize[1]) + # Output ROI (entire tile)
+                            "    </SimpleSource>\n"))
 
-            relative = os.path.relpath(filename, outputPath) # Relative path from the output file to the input tile
-            f.write("    <SimpleSource>\n")
-            f.write("       <SourceFilename relativeToVRT=\"1\">%s</SourceFilename>\n" % relative) # Write relative path
-            f.write("       <SourceBand>%i</SourceBand>\n" % b)
-            f.write("       <SrcRect xOff=\"%i\" yOff=\"%i\" xSize=\"%i\" ySize=\"%i\"/>\n" % (tileLoc[0], tileLoc[1], imageSize[0], imageSize[1]) ) # Source ROI (entire tile)
-            f.write("       <DstRect xOff=\"%i\" yOff=\"%i\" xSize=\"%i\" ySize=\"%i\"/>\n" % (tileLoc[0], tileLoc[1], imageSize[0], imageSize[1]) ) # Output ROI (entire tile)
-            f.write("    </SimpleSource>\n")
-        f.write("  </VRTRasterBand>\n")
-    f.write("</VRTDataset>\n")
-    f.close()    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
+    # Write each band
+    for b in range( 1, num_bands + 1 ):
+        lines.append("  <VRTRasterBand dataType=\"%s\" band=\"%i\">\n" % (data_type, b) ) # Write band data type and index
+        for source in tileSources:
+            lines.append(source % b)
+        lines.append("  </VRTRasterBand>\n")
+    lines.append("</VRTDataset>\n")
 
+    f = open(outputPath, 'w')
+    f.write(''.join(lines))
+    f.close()
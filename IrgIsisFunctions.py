@@ -19,23 +19,32 @@
 
 """IrgIsisFunctions.py - Functions for working with ISIS file types"""
 
-import sys, os, re, subprocess, string, time, errno
+import sys, os, re, subprocess, string, time, errno, math, csv, tempfile, hashlib, json, fcntl, multiprocessing.pool
 
-import IrgStringFunctions, IrgFileFunctions
+import IrgStringFunctions, IrgFileFunctions, IrgGdalFunctions, IrgCacheFunctions
+
+# NumPy is only needed for reading cube pixels and batched campt queries
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # TODO: This would make more sense in IrgGeoFunctions but some functions here need it!
+@IrgCacheFunctions.cacheFileResult('image_size')
 def getImageSize(imagePath):
     """Returns the size [samples, lines] in an image"""
 
     # Make sure the input file exists
     if not os.path.exists(imagePath):
         raise Exception('Image file ' + imagePath + ' not found!')
+
+    if IrgGdalFunctions.getMetadataBackend() == 'gdal':
+        dataset = IrgGdalFunctions.openImage(imagePath)
+        return [dataset.RasterXSize, dataset.RasterYSize]
        
     # Use subprocess to suppress the command output
-    cmd = ['gdalinfo', imagePath]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    textOutput, err = p.communicate()
+    textOutput = IrgGdalFunctions.callGdalInfo(imagePath)
 
     # Extract the size from the text
     sizePos    = textOutput.find('Size is')
@@ -56,121 +65,615 @@ def isIsisFile(filePath):
     return (extension == '.cub')
 
 
-def parseHeadOutput(headText, cubePath):
-    """Parses the output from head [cube path] and returns a dictionary containing all kernels"""
+#==================================================
+# PVL label parsing (ISIS cube labels and PDS labels)
 
-    kernelDict = dict()
+def readIsisLabelText(cubePath, chunkSize=65536):
+    """Reads only the text label at the start of an ISIS cube (or a detached label file)"""
 
-    isisDataFolder = os.environ['ISIS3DATA']
-    cubeFolder     = os.path.dirname(cubePath)
+    f = open(cubePath, 'rb')
+    text = ''
+    try:
+        while True:
+            chunk = f.read(chunkSize)
+            text += chunk
+            atEnd = len(chunk) < chunkSize
+            # The label ends with a line containing only End.  Before the end of the file the line
+            #  must be complete, End at the end of a chunk may continue as End_Group or End_Object.
+            if atEnd:
+                match = re.search(r'(^|\n)End[ \t]*\r?(\n|$)', text, re.IGNORECASE)
+            else:
+                match = re.search(r'(^|\n)End[ \t]*\r?\n', text, re.IGNORECASE)
+            if match:
+                return text[:match.end()]
+            if atEnd: # Reached the end of a detached label
+                return text
+    finally:
+        f.close()
+
+
+def parsePvlScalar(text):
+    """Converts a single PVL value to int, float or string, dropping any <units>"""
+
+    text = text.strip()
+    if text.startswith('"') or text.startswith("'"):
+        return ' '.join(text[1:-1].split()) # Quoted strings may span several lines
+    unitPos = text.find('<')
+    if unitPos >= 0:
+        text = text[:unitPos].strip()
+    if re.match(r'^[+-]?\d+$', text):
+        return int(text)
+    return IrgStringFunctions.convertToFloatIfNumber(text)
+
+def parsePvlValue(text):
+    """Converts the text after the '=' of a PVL statement, (a, b) and {a, b} become lists"""
+
+    text = text.strip()
+    if text[:1] in ['(', '{']:
+        # Anything after the closing bracket is a unit for all the values, drop it.
+        closing = {'(': ')', '{': '}'}[text[0]]
+        inside  = text[1:text.rfind(closing)]
+        # Split on commas which are not inside quotes
+        items = re.findall(r'"[^"]*"[^,]*|\'[^\']*\'[^,]*|[^,]+', inside)
+        return [parsePvlScalar(i) for i in items if i.strip()]
+    return parsePvlScalar(text)
+
+def isPvlValueComplete(text):
+    """Returns False if a PVL value continues on the next line"""
+    if (text.count('"') % 2) or (text.count('(') > text.count(')')) or (text.count('{') > text.count('}')):
+        return False
+    return not (text.endswith(',') or text.endswith('-'))
+
+def addPvlEntry(section, key, value):
+    """Adds a value to a section, repeated keys are collected in a list"""
+    if key not in section:
+        section[key] = value
+        return
+    if not isinstance(section[key], PvlList):
+        section[key] = PvlList([section[key]])
+    section[key].append(value)
+
+class PvlList(list):
+    """List of the values of a key which was repeated within a section"""
+    pass
+
+
+def parsePvlLabel(labelText):
+    """Parses PVL text in one pass into nested dictionaries.
+
+       Object and Group sections become dictionaries stored under their name.
+       Values are ints, floats, strings or lists of those with units removed."""
+
+    root  = {}
+    stack = [root]
+    key   = None # Set while a value is continued over several lines
+    value = ''
+
+    for line in labelText.splitlines():
+        line = re.sub(r'/\*.*?\*/', '', line).strip() # Drop comments
+        
+        if key is not None: # Continuing a value from the previous line
+            if value.endswith('-') and (value.count('"') % 2 == 0): # ISIS breaks long words with a trailing -
+                value = value[:-1] + line
+            else:
+                value = value + ' ' + line
+            if not isPvlValueComplete(value):
+                continue
+            addPvlEntry(stack[-1], key, parsePvlValue(value))
+            key = None
+            continue
 
-    # Search each line in the folder for a required kernel file
-    
-    lastLine = ''
-    kernelsStarted = False
-    currentKernelType = 'ERROR!'
-    for line in headText.split('\n'):
-        # Append leftovers from last line and clear left/right whitespace
-        workingLine = lastLine + line.strip()
-        lastLine = ''
-
-#        print 'workingLine =' + workingLine
-
-        # Skip lines until we find the start of the kernel section
-        if (not kernelsStarted ) and (workingLine.find('Group = Kernels') < 0):
+        if not line:
+            continue
+        if line.upper() == 'END':
+            break
+        
+        parts = line.split('=', 1)
+        name  = parts[0].strip()
+        upper = name.upper()
+        if upper in ['END_OBJECT', 'END_GROUP']:
+            if len(stack) > 1:
+                stack.pop()
+            continue
+        if len(parts) < 2: # Not a statement
+            continue
+        
+        text = parts[1].strip()
+        if upper in ['OBJECT', 'GROUP']:
+            section = {}
+            addPvlEntry(stack[-1], parsePvlScalar(text), section)
+            stack.append(section)
             continue
-        kernelsStarted = True
 
-        # Quit when we reach the end of the kernel section
-        if (workingLine.find('End_Group') >= 0):
-            return kernelDict
+        if isPvlValueComplete(text):
+            addPvlEntry(stack[-1], name, parsePvlValue(text))
+        else:
+            (key, value) = (name, text)
+
+    return root
+
+
+@IrgCacheFunctions.cacheFileResult('isis_label')
+def readIsisLabel(filePath):
+    """Returns the parsed label of an ISIS cube or a detached label file"""
+
+    if not os.path.exists(filePath):
+        raise Exception('Label file ' + filePath + ' not found!')
+    return parsePvlLabel(readIsisLabelText(filePath))
+
+def getPvlValue(label, paths, default=None):
+    """Returns the value at a path such as 'IsisCube/Core/Dimensions/Samples' in a parsed label.
+       paths may also be a list of paths, the value of the first one found is returned."""
+
+    if isinstance(paths, basestring):
+        paths = [paths]
+    for path in paths:
+        value = label
+        for name in path.split('/'):
+            if (not isinstance(value, dict)) or (name not in value):
+                value = None
+                break
+            value = value[name]
+        if value is not None:
+            return value
+    return default
+
+
+#==================================================
+# Direct access to the pixels of attached-label ISIS cubes
+
+# Numpy type codes for the ISIS pixel types
+ISIS_PIXEL_TYPES = {'UnsignedByte'    : 'u1',
+                    'SignedWord'      : 'i2',
+                    'UnsignedWord'    : 'u2',
+                    'SignedInteger'   : 'i4',
+                    'UnsignedInteger' : 'u4',
+                    'Real'            : 'f4',
+                    'Double'          : 'f8'}
+
+# Raw values outside these ranges are ISIS special pixels (NULL, LRS, LIS, HIS, HRS)
+ISIS_VALID_RANGES = {'UnsignedByte' : (1, 254),
+                     'SignedWord'   : (-32752, 32767),
+                     'UnsignedWord' : (3, 65522),
+                     'Real'         : (-3.4028224522648084e+38, 3.40282346638528860e+38)} # VALID_MIN4 = 0xFF7FFFFA
+
+
+class IsisCube(object):
+    """Read-only view of the pixels in an ISIS cube backed by numpy.memmap.
+
+       Parses StartByte, Format (BandSequential or Tile), TileSamples/TileLines,
+       the pixel type, byte order, base and multiplier from the cube label."""
+
+    def __init__(self, cubePath):
+
+        if numpy is None:
+            raise Exception('IsisCube requires numpy!')
+        if not os.path.exists(cubePath):
+            raise Exception('Cube file ' + cubePath + ' not found!')
+        self.path = cubePath
+
+        label = readIsisLabel(cubePath)
+        try:
+            core = label['IsisCube']['Core']
+        except KeyError:
+            raise Exception('Unable to find the Core object in the label of ' + cubePath)
+        if '^Core' in core:
+            raise Exception('Cubes with detached data are not supported: ' + cubePath)
+
+        try:
+            self.startByte  = int(core['StartByte']) # One-based!
+            self.format     = core['Format']
+            self.numSamples = int(core['Dimensions']['Samples'])
+            self.numLines   = int(core['Dimensions']['Lines'])
+            self.numBands   = int(core['Dimensions']['Bands'])
+            self.pixelType  = core['Pixels']['Type']
+            self.byteOrder  = core['Pixels'].get('ByteOrder', 'Lsb')
+            self.base       = float(core['Pixels'].get('Base', 0.0))
+            self.multiplier = float(core['Pixels'].get('Multiplier', 1.0))
+        except KeyError, e:
+            raise Exception('Missing ' + str(e) + ' in the label of ' + cubePath)
+
+        if self.pixelType not in ISIS_PIXEL_TYPES:
+            raise Exception('Unsupported ISIS pixel type ' + str(self.pixelType) + ' in ' + cubePath)
+        byteOrderChar = '<'
+        if self.byteOrder == 'Msb':
+            byteOrderChar = '>'
+        self.dtype = numpy.dtype(byteOrderChar + ISIS_PIXEL_TYPES[self.pixelType])
+
+        # Map the pixel data, nothing is read until it is accessed
+        offset = self.startByte - 1
+        if self.format == 'BandSequential':
+            shape = (self.numBands, self.numLines, self.numSamples)
+        elif self.format == 'Tile':
+            self.tileSamples = int(core['TileSamples'])
+            self.tileLines   = int(core['TileLines'])
+            self.numTileCols = (self.numSamples + self.tileSamples - 1) // self.tileSamples
+            self.numTileRows = (self.numLines   + self.tileLines   - 1) // self.tileLines
+            shape = (self.numBands, self.numTileRows, self.numTileCols, self.tileLines, self.tileSamples)
+        else:
+            raise Exception('Unsupported ISIS cube format ' + str(self.format) + ' in ' + cubePath)
+        self.data = numpy.memmap(cubePath, dtype=self.dtype, mode='r', offset=offset, shape=shape)
+
+    def getSize(self):
+        """Returns [samples, lines] like getImageSize"""
+        return [self.numSamples, self.numLines]
+
+    def readRawWindow(self, startSample, startLine, numSamples, numLines, band=1):
+        """Returns the raw pixel values in a window as a (lines, samples) array.
+
+           Positions are zero-based.  For BandSequential cubes this is a view into the file."""
+
+        if (startSample < 0) or (startLine < 0) or (numSamples <= 0) or (numLines <= 0) or \
+           (startSample+numSamples > self.numSamples) or (startLine+numLines > self.numLines):
+            raise Exception('Window is outside of cube ' + self.path)
+        b = band - 1
+
+        if self.format == 'BandSequential':
+            return self.data[b, startLine:startLine+numLines, startSample:startSample+numSamples]
+
+        # Copy the overlapping part of each tile into the output
+        output = numpy.empty((numLines, numSamples), dtype=self.dtype)
+        stopSample = startSample + numSamples
+        stopLine   = startLine   + numLines
+        for tileRow in range(startLine // self.tileLines, (stopLine-1) // self.tileLines + 1):
+            tileTop = tileRow * self.tileLines
+            y0 = max(startLine, tileTop)
+            y1 = min(stopLine,  tileTop + self.tileLines)
+            for tileCol in range(startSample // self.tileSamples, (stopSample-1) // self.tileSamples + 1):
+                tileLeft = tileCol * self.tileSamples
+                x0 = max(startSample, tileLeft)
+                x1 = min(stopSample,  tileLeft + self.tileSamples)
+                output[y0-startLine:y1-startLine, x0-startSample:x1-startSample] = \
+                    self.data[b, tileRow, tileCol, y0-tileTop:y1-tileTop, x0-tileLeft:x1-tileLeft]
+        return output
+
+    def readWindow(self, startSample, startLine, numSamples, numLines, band=1):
+        """Returns the pixel values in a window as float32 with base/multiplier applied.
+
+           ISIS special pixels (NULL, saturated) are returned as NaN."""
+
+        raw    = self.readRawWindow(startSample, startLine, numSamples, numLines, band)
+        values = raw.astype(numpy.float32)
+        if self.pixelType in ISIS_VALID_RANGES:
+            (validMin, validMax) = ISIS_VALID_RANGES[self.pixelType]
+            values[(raw < validMin) | (raw > validMax)] = numpy.nan
+        if (self.multiplier != 1.0) or (self.base != 0.0):
+            values = values * self.multiplier + self.base
+        return values
+
+    def readBand(self, band=1):
+        """Returns a whole band as float32, see readWindow"""
+        return self.readWindow(0, 0, self.numSamples, self.numLines, band)
+
+
+# Kernel file types that may be listed in the Kernels group
+KERNEL_FILE_REGEX = re.compile(r'[$a-zA-Z0-9/._\-]*((\.tls)|(\.tpc)|(\.tf)|(\.bpc)|(\.bsp)|(\.bc)|(\.ti)|(\.tsc)|(\.cub))$')
+
+def getKernelsFromLabel(label, cubePath):
+    """Returns a dictionary of kernel type to kernel paths from a parsed cube label"""
+
+    kernelGroup = getPvlValue(label, 'IsisCube/Kernels')
+    if not isinstance(kernelGroup, dict):
+        return dict()
 
-        # Check if the current line is cut off with an append character
-        if (workingLine[-1] == '-'): # This means ISIS has done a weird truncation to the next line
-            lastLine = workingLine[:-1] # Strip trailing - and append next line to it next pass
-#            print '===   ' + lastLine
-            continue
+    isisDataFolder = os.environ['ISIS3DATA']
+    cubeFolder     = os.path.dirname(cubePath)
 
-        # Maintain the current kernel type
-        if (workingLine.find('LeapSecond') >= 0):
-            currentKernelType = 'LeapSecond'
-        elif (workingLine.find('TargetAttitudeShape') >= 0):
-            currentKernelType = 'TargetAttitudeShape'
-        elif (workingLine.find('TargetPosition') >= 0):
-            currentKernelType = 'TargetPosition'
-        elif (workingLine.find('InstrumentPointing') >= 0):
-            currentKernelType = 'InstrumentPointing'
-        elif (workingLine.find('InstrumentPosition') >= 0):
-            currentKernelType = 'InstrumentPosition'
-        elif (workingLine.find('InstrumentAddendum') >= 0):
-            currentKernelType = 'InstrumentAddendum'
-        elif (workingLine.find('Instrument') >= 0): # This must be check after the other instrument lines!
-            currentKernelType = 'Instrument'
-        elif (workingLine.find('SpacecraftClock') >= 0):
-            currentKernelType = 'SpacecraftClock'
-        elif (workingLine.find('ShapeModel') >= 0):
-            currentKernelType = 'ShapeModel'
-
-        # Now look for any kernel files on the line 
-        # TODO: This will fail if one kernel ends on a line and the next gets a continuation!
-        remainingSearchLine = workingLine
-        while (len(remainingSearchLine) > 3):
-        
-            # Look through the line for the next kernel
-            m = re.search('[$a-zA-Z0-9/._\-]*'+
-                          '((\.tls)|(\.tpc)|(\.tf)|(\.bpc)|(\.bsp)|(\.bc)|(\.tf)|(\.ti)|(\.tsc)|(\.cub))', 
-                          remainingSearchLine) 
-            
-            if not m: # Did not find a kernel
-                #print 'Failed to find kernel in line: ' + workingLine
-                break # If we did not find a match move on to the next line
-
-            # Found a kernel, handle abbreviations
-            if m.group(0)[0] == '$': # Located in ISIS data folder
-                kernelPath = os.path.join(isisDataFolder, m.group(0)[1:])
+    kernelDict = dict()
+    for kernelType, values in kernelGroup.items():
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if not isinstance(value, basestring) or not KERNEL_FILE_REGEX.match(value):
+                continue # Not a kernel file (Table, Null, quality flags, ...)
+
+            # Handle abbreviations
+            if value[0] == '$': # Located in ISIS data folder
+                kernelPath = os.path.join(isisDataFolder, value[1:])
             else: # Path relative to the file location, make it an absolute path
-                kernelPath = os.path.join(cubeFolder, m.group(0))
+                kernelPath = os.path.join(cubeFolder, value)
 
             # Handle special case where two different kinds of files are in the same category
-            if (currentKernelType == 'InstrumentPointing') and (kernelPath.find('.tf') > 0):
-                currentKernelType = 'Frame'
+            thisType = kernelType
+            if (kernelType == 'InstrumentPointing') and value.endswith('.tf'):
+                thisType = 'Frame'
 
-            # Store the kernel in the dictionary
-            if not (currentKernelType in kernelDict):
-                kernelDict[currentKernelType] = [kernelPath]
+            if not (thisType in kernelDict):
+                kernelDict[thisType] = [kernelPath]
             else:
-                kernelDict[currentKernelType].append(kernelPath)
-
-#            print 'In type: ' + currentKernelType + ' Found kernel ' + kernelPath
-
-            # Set up whatever is left of the line for more searching
-            remainingSearchLine = remainingSearchLine[m.end()+1:]
-#            print remainingSearchLine
-#            print len(remainingSearchLine)
-#            print '\n'
+                kernelDict[thisType].append(kernelPath)
 
-    # Return the list of kernels
     return kernelDict
 
 
 def getKernelsFromCube(cubePath):
     """Returns a list of all the SPICE kernels needed by a cube """
 
-    # Call head -120 on file, write to a temp file for parsing
-    cmd = ['head', '-120', cubePath]
-    #print cmd
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    outputText, err = p.communicate()
-    
-    # Parse output looking for all the kernel files
-    #print 'Looking for source frame file...'
-    kernelList = parseHeadOutput(outputText, cubePath)
+    # Parse the label looking for all the kernel files
+    kernelList = getKernelsFromLabel(readIsisLabel(cubePath), cubePath)
     if not kernelList:
         raise Exception('Unable to find any kernel files in ' + cubePath)
 
     return kernelList # Success!
 
 
+def getKernelSetForCubes(cubePaths):
+    """Returns a sorted list of (kernelPath, sizeInBytes) with every kernel needed by any of the cubes.
+
+       Each kernel only appears once no matter how many cubes use it.  Missing kernels have size None."""
+
+    kernelSizes = {}
+    for cubePath in cubePaths:
+        for kernelPaths in getKernelsFromCube(cubePath).values():
+            for kernelPath in kernelPaths:
+                kernelPath = os.path.normpath(kernelPath)
+                if kernelPath in kernelSizes:
+                    continue
+                try:
+                    kernelSizes[kernelPath] = os.path.getsize(kernelPath)
+                except OSError:
+                    kernelSizes[kernelPath] = None
+    return sorted(kernelSizes.items())
+
+
+def getFileChecksum(path, blockSize=4*1024*1024):
+    """Returns the md5 hex digest of a file"""
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    while True:
+        block = f.read(blockSize)
+        if not block:
+            break
+        md5.update(block)
+    f.close()
+    return md5.hexdigest()
+
+def copyFileWithChecksum(sourcePath, outputPath, blockSize=4*1024*1024):
+    """Copies a file and returns the md5 hex digest of the data, computed while copying"""
+    try:
+        os.makedirs(os.path.dirname(outputPath))
+    except OSError as e:
+        if e.errno != errno.EEXIST: # Another thread may have created it
+            raise
+    tempPath = outputPath + '.partial'
+    md5 = hashlib.md5()
+    inFile  = open(sourcePath, 'rb')
+    outFile = open(tempPath, 'wb')
+    while True:
+        block = inFile.read(blockSize)
+        if not block:
+            break
+        md5.update(block)
+        outFile.write(block)
+    inFile.close()
+    outFile.close()
+    os.rename(tempPath, outputPath) # Never leave a partial file at the final path
+    return md5.hexdigest()
+
+
+def stageKernels(kernelPaths, scratchFolder, numThreads=4):
+    """Copies kernels into a node-local scratch folder and returns a dictionary of original path -> local path.
+
+       Kernels copied by an earlier call (or another process on the same node) are reused if the
+       source size and mtime are unchanged and the local copy still has the size and mtime recorded
+       in the manifest.  Local copies are only checksummed when their size or mtime changed.
+       A lock file makes sure only one process per node copies at a time."""
+
+    IrgFileFunctions.createFolder(scratchFolder)
+    manifestPath = os.path.join(scratchFolder, 'kernel_manifest.json')
+
+    def loadManifest():
+        # The manifest is always replaced in one step so it can be read without the lock
+        if not os.path.exists(manifestPath):
+            return {}
+        f = open(manifestPath, 'r')
+        manifest = json.load(f)
+        f.close()
+        return manifest
+
+    def localCopyMatches(entry, sourceStat, localPath, checkMd5):
+        """Returns True if the manifest entry describes the current source and local copy"""
+        if (not entry) or (entry['size'] != sourceStat.st_size) or (entry['mtime'] != sourceStat.st_mtime):
+            return False
+        if not os.path.exists(localPath):
+            return False
+        localStat = os.stat(localPath)
+        if localStat.st_size != entry['size']:
+            return False
+        if localStat.st_mtime == entry.get('local_mtime'):
+            return True
+        return checkMd5 and (getFileChecksum(localPath) == entry['md5'])
+
+    # Check the sources up front so a missing kernel gets a clear error
+    pathMap     = {}
+    sourceStats = {}
+    missing     = []
+    for kernelPath in kernelPaths:
+        kernelPath = os.path.normpath(kernelPath)
+        pathMap[kernelPath] = os.path.join(scratchFolder, 'kernels', kernelPath.lstrip(os.sep))
+        try:
+            sourceStats[kernelPath] = os.stat(kernelPath)
+        except OSError:
+            missing.append(kernelPath)
+    if missing:
+        raise Exception('Kernel files not found: ' + ', '.join(missing))
+
+    # Without the lock, find the kernels whose local copies can't be trusted
+    manifest   = loadManifest()
+    refreshed  = {} # Local copies whose mtime changed but whose checksum still matches
+    candidates = []
+    for (kernelPath, localPath) in pathMap.items():
+        entry = manifest.get(kernelPath)
+        if localCopyMatches(entry, sourceStats[kernelPath], localPath, checkMd5=True):
+            if entry.get('local_mtime') != os.path.getmtime(localPath):
+                refreshed[kernelPath] = os.path.getmtime(localPath)
+            continue
+        candidates.append(kernelPath)
+
+    if (not candidates) and (not refreshed):
+        return pathMap
+
+    lockFile = open(os.path.join(scratchFolder, 'kernel_manifest.lock'), 'w')
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    try:
+        # Another process may have staged some of the kernels while we were checking
+        manifest = loadManifest()
+        toCopy   = []
+        for kernelPath in candidates:
+            if not localCopyMatches(manifest.get(kernelPath), sourceStats[kernelPath],
+                                    pathMap[kernelPath], checkMd5=False):
+                toCopy.append((kernelPath, pathMap[kernelPath], sourceStats[kernelPath]))
+        for (kernelPath, localMtime) in refreshed.items():
+            if kernelPath in manifest:
+                manifest[kernelPath]['local_mtime'] = localMtime
+
+        if toCopy:
+            print 'Staging ' + str(len(toCopy)) + ' of ' + str(len(pathMap)) + ' kernels to ' + scratchFolder
+
+            def copyOne(item):
+                (kernelPath, localPath, sourceStat) = item
+                return (kernelPath, copyFileWithChecksum(kernelPath, localPath), sourceStat)
+
+            pool = multiprocessing.pool.ThreadPool(max(1, min(numThreads, len(toCopy))))
+            try:
+                results = pool.map(copyOne, toCopy)
+            finally:
+                pool.close()
+                pool.join()
+
+            for (kernelPath, md5, sourceStat) in results:
+                localPath = pathMap[kernelPath]
+                manifest[kernelPath] = {'size' : sourceStat.st_size, 'mtime'      : sourceStat.st_mtime,
+                                        'md5'  : md5,                'local'      : localPath,
+                                        'local_mtime': os.path.getmtime(localPath)}
+
+        # Write the manifest in one step
+        f = open(manifestPath + '.tmp', 'w')
+        json.dump(manifest, f)
+        f.close()
+        os.rename(manifestPath + '.tmp', manifestPath)
+    finally:
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+        lockFile.close()
+
+    return pathMap
+
+
+def rewriteKernelPaths(kernelDict, pathMap):
+    """Replaces kernel paths in a getKernelsFromCube dictionary with their staged copies"""
+    output = dict()
+    for (kernelType, kernelPaths) in kernelDict.items():
+        output[kernelType] = [pathMap.get(os.path.normpath(p), p) for p in kernelPaths]
+    return output
+
+
+# The spiceinit parameter for each kernel type in a getKernelsFromCube dictionary
+SPICEINIT_KERNEL_PARAMETERS = {'LeapSecond'         : 'lsk',  'TargetAttitudeShape': 'pck',
+                               'TargetPosition'     : 'tspk', 'InstrumentPointing' : 'ck',
+                               'Frame'              : 'fk',   'Instrument'         : 'ik',
+                               'SpacecraftClock'    : 'sclk', 'InstrumentPosition' : 'spk',
+                               'InstrumentAddendum' : 'iak',  'ShapeModel'         : 'model',
+                               'Extra'              : 'extra'}
+
+def getSpiceinitKernelArgs(kernelDict):
+    """Returns spiceinit arguments which load exactly the kernels in a getKernelsFromCube dictionary"""
+    args = []
+    for kernelType in sorted(kernelDict.keys()):
+        if kernelType not in SPICEINIT_KERNEL_PARAMETERS:
+            raise Exception('No spiceinit parameter for kernel type ' + kernelType)
+        args.append(SPICEINIT_KERNEL_PARAMETERS[kernelType] + '=(' + ','.join(kernelDict[kernelType]) + ')')
+        if kernelType == 'ShapeModel':
+            args.append('shape=user')
+    return args
+
+
+
+
+
+def getPixelLocsInCube(cubePath, samples, lines):
+    """Returns the ground locations of many (sample, line) pixels using a single campt call.
+
+       Pixel positions are one-based like in ISIS.  The output dictionary contains numpy arrays:
+        gcc    = N x 3 BodyFixedCoordinate in meters
+        lat    = PlanetocentricLatitude in degrees
+        lon    = PositiveEast180Longitude in degrees
+        radius = LocalRadius in meters
+       Points which campt could not compute are set to NaN."""
+
+    if numpy is None:
+        raise Exception('getPixelLocsInCube requires numpy!')
+
+    # Make sure the input file exists
+    if not os.path.exists(cubePath):
+        raise Exception('Cube file ' + cubePath + ' not found!')
+
+    samples = numpy.atleast_1d(numpy.asarray(samples, dtype=numpy.float64))
+    lines   = numpy.atleast_1d(numpy.asarray(lines,   dtype=numpy.float64))
+    numPoints = len(samples)
+
+    # Each call gets its own folder so concurrent calls do not collide
+    tempFolder = tempfile.mkdtemp(prefix='campt_')
+    try:
+        # Write all the points to a coordinate list
+        coordListPath = os.path.join(tempFolder, 'coords.csv')
+        outputPath    = os.path.join(tempFolder, 'campt.csv')
+        f = open(coordListPath, 'w')
+        f.write(''.join(['%r,%r\n' % (s, l) for (s, l) in zip(samples, lines)]))
+        f.close()
+
+        # Use subprocess to suppress the command output
+        cmd = ['campt', 'from=' + cubePath, 'usecoordlist=true', 'coordlist=' + coordListPath,
+               'coordtype=image', 'format=flat', 'allowoutside=true', 'to=' + outputPath]
+        FNULL = open(os.devnull, 'w')
+        returnCode = subprocess.call(cmd, stdout=FNULL, stderr=subprocess.STDOUT)
+        FNULL.close()
+
+        if returnCode != 0:
+            raise Exception('campt failed with return code ' + str(returnCode) + ' for cube ' + cubePath)
+        if not os.path.exists(outputPath):
+            raise Exception('campt failed to create output file ' + outputPath)
+        f = open(outputPath, 'r')
+        rows = list(csv.reader(f))
+        f.close()
+    finally:
+        IrgFileFunctions.removeFolderIfExists(tempFolder)
+
+    if not rows:
+        raise Exception('campt produced no output for cube ' + cubePath)
+
+    # Map each row back to its input point using the Sample and Line columns
+    header  = [h.strip() for h in rows[0]]
+    columns = dict([(name, i) for (i, name) in enumerate(header)])
+    for name in ['Sample', 'Line', 'BodyFixedCoordinateX', 'BodyFixedCoordinateY', 'BodyFixedCoordinateZ',
+                 'PlanetocentricLatitude', 'PositiveEast180Longitude', 'LocalRadius']:
+        if name not in columns:
+            raise Exception('Missing column ' + name + ' in campt output for cube ' + cubePath)
+
+    # The same pixel may be requested more than once, all of its entries get the result
+    indicesOfPoint = dict()
+    for (i, (s, l)) in enumerate(zip(samples, lines)):
+        indicesOfPoint.setdefault((round(s, 3), round(l, 3)), []).append(i)
+
+    values = numpy.full((numPoints, 6), numpy.nan)
+    names  = ['BodyFixedCoordinateX', 'BodyFixedCoordinateY', 'BodyFixedCoordinateZ',
+              'PlanetocentricLatitude', 'PositiveEast180Longitude', 'LocalRadius']
+    for row in rows[1:]:
+        try:
+            indices = indicesOfPoint[(round(float(row[columns['Sample']]), 3), round(float(row[columns['Line']]), 3))]
+        except (ValueError, IndexError, KeyError):
+            continue # Not a point row
+        for (j, name) in enumerate(names):
+            try:
+                values[indices, j] = float(row[columns[name]])
+            except (ValueError, IndexError): # No intersection with the body
+                pass
+
+    pixelInformation = dict()
+    pixelInformation['gcc']    = values[:, 0:3] * 1000.0 # Convert output from kilometers to meters
+    pixelInformation['lat']    = values[:, 3]
+    pixelInformation['lon']    = values[:, 4]
+    pixelInformation['radius'] = values[:, 5]
+    return pixelInformation
 
 
 def getPixelLocInCube(cubePath, sample, line):
@@ -178,97 +681,126 @@ def getPixelLocInCube(cubePath, sample, line):
 
     DEFAULT_MOON_RADIUS = 1737400 # In meters
 
-    # Make sure the input file exists
-    if not os.path.exists(cubePath):
-        raise Exception('Cube file ' + cubePath + ' not found!')
-       
-    # Use subprocess to parse the command output
-    cmd = ['campt', 'from=', cubePath, 'sample=', str(sample), 'line=', str(line)]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    cmdOut, err = p.communicate()
-
+    points = getPixelLocsInCube(cubePath, [sample], [line])
 
-    # Read in the output file to extract the pixel coordinates
-    gccLine       = ''
-    latLine       = ''
-    lonLine       = ''
-    radiusLine    = ''
-    lineAfterBody = False
-    for line in cmdOut.split('\n'):
-        
-        # GCC stuff
-        if lineAfterBody: # BodyFixedCoordinate takes up two lines
-            gccLine       = gccLine + line
-            lineAfterBody = False
-            
-        if (gccLine == ''): # Look for start of the info (this check must come second)
-            if (line.find('BodyFixedCoordinate') >= 0):
-                gccLine     = line
-                lineAfterBody = True
-        
-        # GDC stuff
-        if line.find('PlanetocentricLatitude') >= 0:
-            latLine = line
-            #print line
-        if line.find('PositiveEast180Longitude') >= 0:
-            lonLine = line
-            #print line
-        if line.find('LocalRadius') >= 0:
-            radiusLine = line
-            #print line
-
-    # Make sure we found the desired lines
-    if (gccLine == ''):
+    # Make sure we found the desired values
+    if numpy.isnan(points['gcc'][0]).any():
         raise Exception("Unable to find BodyFixedCoordinate in file " + cubePath)
-    if (latLine == ''):
-        raise Exception("Unable to find PlanetocentricLatitude in file " + cubePath)
-    if (lonLine == ''):
-        raise Exception("Unable to find PositiveEast180Longitude in file " + cubePath)
-    if (radiusLine == ''):
+    if numpy.isnan(points['lat'][0]) or numpy.isnan(points['lon'][0]):
+        raise Exception("Unable to find pixel location in file " + cubePath)
+    if numpy.isnan(points['radius'][0]):
         raise Exception("Unable to find LocalRadius in file " + cubePath)
 
-    # Extract GCC coordinates
-    startParen = gccLine.find('(')
-    stopParen  = gccLine.find(')')
-    numString  = gccLine[startParen+1:stopParen]
-    x,y,z = numString.split(',')
-
-    # Convert output from kilometers to meters
-    pixelLocationGcc = [0, 0, 0]
-    pixelLocationGcc[0] = float(x) * 1000.0
-    pixelLocationGcc[1] = float(y) * 1000.0
-    pixelLocationGcc[2] = float(z) * 1000.0
-    
-    # Extract GDC coordinates
-    latStart     = latLine.find('=')+2
-    lonStart     = lonLine.find('=')+2
-    radiusStart  = radiusLine.find('=')+2
-    radiusEnd    = radiusLine.find('<') - 1
-    latNumStr    = latLine[latStart:]
-    lonNumStr    = lonLine[lonStart:]
-    radiusNumStr = radiusLine[radiusStart:radiusEnd]
-    pixelLocationGdc = [float(lonNumStr), float(latNumStr), float(radiusNumStr)-1737400.0]
-                        
     pixelInformation = dict()
-    pixelInformation['gcc'] = pixelLocationGcc
-    pixelInformation['gdc'] = pixelLocationGdc
+    pixelInformation['gcc'] = [float(v) for v in points['gcc'][0]]
+    pixelInformation['gdc'] = [float(points['lon'][0]), float(points['lat'][0]),
+                               float(points['radius'][0]) - DEFAULT_MOON_RADIUS]
     return pixelInformation
 
 
+def getCubePerimeterPixels(cubeSize, numEdgeSamples):
+    """Returns one-based (sample, line) arrays of points evenly spaced along the edge of a cube"""
 
-def getCubeElevationEstimate(cubePath, workDir=''):
-    """Returns the surface elevation at the center of a cube"""
+    steps   = numpy.linspace(0.0, 1.0, numEdgeSamples)
+    (s, l)  = (float(cubeSize[0]), float(cubeSize[1]))
+    samples = numpy.concatenate([1 + steps*(s-1), numpy.full(numEdgeSamples, s), 1 + steps*(s-1), numpy.ones(numEdgeSamples)])
+    lines   = numpy.concatenate([numpy.ones(numEdgeSamples), 1 + steps*(l-1), numpy.full(numEdgeSamples, l), 1 + steps*(l-1)])
+    return (samples, lines)
 
-    DEFAULT_MOON_RADIUS = 1737400 # In meters
 
-    # TODO: Get these values from the file!
-    sample = 2500
-    line   = 25000
+
+def getDemWindowForFootprint(demTransform, demSize, bounds, maxWindowSize=256):
+    """Returns the (x, y, width, height) DEM pixel window under a lonlat footprint, or None if it is off the DEM.
+
+       Windows larger than maxWindowSize are shrunk around the footprint center."""
+
+    (minLon, maxLon, minLat, maxLat) = bounds
+    centerLon = (minLon + maxLon) / 2.0
+    centerLat = (minLat + maxLat) / 2.0
+
+    # The DEM may use a different longitude convention than the footprint, try all of them.
+    for offset in [0.0, 360.0, -360.0]:
+        lons = numpy.array([minLon, maxLon, minLon, maxLon, centerLon]) + offset
+        lats = numpy.array([minLat, minLat, maxLat, maxLat, centerLat])
+        (cols, rows) = demTransform.lonLatToPixel(lons, lats)
+        if (0 <= cols[4] < demSize[0]) and (0 <= rows[4] < demSize[1]):
+            break
+    else:
+        return None
+
+    # Clip the window to the maximum size around the center, then to the DEM
+    halfSize = maxWindowSize / 2.0
+    x0 = int(math.floor(max(cols.min(), cols[4] - halfSize, 0)))
+    x1 = int(math.ceil (min(cols.max(), cols[4] + halfSize, demSize[0])))
+    y0 = int(math.floor(max(rows.min(), rows[4] - halfSize, 0)))
+    y1 = int(math.ceil (min(rows.max(), rows[4] + halfSize, demSize[1])))
+    return (x0, y0, max(1, x1-x0), max(1, y1-y0))
+
+
+def getCubeElevationEstimates(cubePaths, demPath, maxWindowSize=256, referenceRadius=None):
+    """Returns the median DEM elevation under each cube footprint, None where the DEM has no data.
+
+       The elevations are relative to the DEM datum, or to a sphere of referenceRadius meters if given.
+       The DEM is opened once and all the windows are read in DEM order through a block cache."""
+
+    if (not IrgGdalFunctions.haveGdalBindings()) or (numpy is None):
+        raise Exception('Reading elevations from a DEM requires the GDAL python bindings and numpy!')
+
+    import IrgGeoFunctions # Imported here, IrgGeoFunctions imports this module
+
+    demInfo      = IrgGeoFunctions.getImageGeoInfo(demPath, False)
+    demTransform = IrgGeoFunctions.getGeoTransformFromGeoInfo(demInfo)
+    reader       = IrgGeoFunctions.RasterBlockReader(demPath)
+
+    # Heights above the DEM datum become heights above the reference sphere
+    heightOffset = 0.0
+    if referenceRadius is not None:
+        demRadius    = IrgGeoFunctions.getProj4Ellipsoid(IrgGeoFunctions.parseProj4String(demInfo['proj4']))[0]
+        heightOffset = demRadius - referenceRadius
+
+    # Find the DEM window for each cube first so that the DEM can be read in order
+    windows = []
+    for (i, cubePath) in enumerate(cubePaths):
+        window = getDemWindowForFootprint(demTransform, demInfo['image_size'],
+                                          getIsisBoundingBox(cubePath), maxWindowSize)
+        if window is not None:
+            windows.append((window[1], window[0], i, window))
+
+    elevations = [None] * len(cubePaths)
+    for (y, x, i, window) in sorted(windows):
+        values = reader.readWindow(*window)
+        values = values[~numpy.isnan(values)]
+        if values.size > 0:
+            elevations[i] = float(numpy.median(values)) + heightOffset
+    return elevations
+
+
+def getCubeElevationEstimate(cubePath, workDir='', demPath=None):
+    """Returns the surface elevation at the center of a cube, relative to the mean radius of the Moon.
+
+       If a reference DEM is provided this is the median DEM value under the cube footprint,
+       otherwise campt is used to find the local radius at the cube center."""
+
+    DEFAULT_MOON_RADIUS = 1737400 # In meters
 
     # Make sure the input file exists
     if not os.path.exists(cubePath):
         raise Exception('Cube file ' + cubePath + ' not found!')
 
+    if demPath and not (IrgGdalFunctions.haveGdalBindings() and (numpy is not None)):
+        print 'The GDAL python bindings and numpy are needed to read the DEM, using campt instead.'
+        demPath = None
+    if demPath:
+        elevation = getCubeElevationEstimates([cubePath], demPath, referenceRadius=DEFAULT_MOON_RADIUS)[0]
+        if elevation is None:
+            raise Exception('No valid DEM values found under cube ' + cubePath)
+        return elevation
+
+    # Use the center of the cube
+    cubeSize = getImageSize(cubePath)
+    sample   = (cubeSize[0] + 1) // 2
+    line     = (cubeSize[1] + 1) // 2
+
     # Default working directory is the cubePath folder
     outputFolder = workDir
     if workDir == '':
@@ -317,67 +849,97 @@ def getCubeElevationEstimate(cubePath, workDir=''):
     return localRadius
 
 # TODO: Create a real bounding box class or something
-def getIsisBoundingBox(cubePath):
+@IrgCacheFunctions.cacheFileResult('isis_bounding_box')
+def getIsisBoundingBox(cubePath, numEdgeSamples=32):
     """Returns (minLon, maxLon, minLat, maxLat) for an ISIS compatible object"""
    
-    # Get the cube size, then request the positions of the four corners
+    # Get the cube size, then request positions all around the edge of the image with one campt call.
+    # - Sampling the whole edge is more accurate than using only the four corners.
     cubeSize = getImageSize(cubePath)
-    
-    # Note that the underlying ISIS tool is one-based
-    points  = []
-    firstPt =     getPixelLocInCube(cubePath, 1,           1,         )['gdc']
-    points.append(getPixelLocInCube(cubePath, cubeSize[0], 1,         )['gdc'])
-    points.append(getPixelLocInCube(cubePath, 1,           cubeSize[1])['gdc'])
-    points.append(getPixelLocInCube(cubePath, cubeSize[0], cubeSize[1])['gdc'])
-
-    # Go through the four corners and get the bounding box
-    minLon = firstPt[0]
-    maxLon = firstPt[0]
-    minLat = firstPt[1]
-    maxLat = firstPt[1]
-    
-    for p in points:
-        if p[0] < minLon:
-            minLon = p[0]
-        if p[0] > maxLon:
-            maxLon = p[0]
-        if p[1] < minLat:
-            minLat = p[1]
-        if p[1] > maxLat:
-            maxLat = p[1]
+    (samples, lines) = getCubePerimeterPixels(cubeSize, numEdgeSamples)
+    points = getPixelLocsInCube(cubePath, samples, lines)
 
-    return (minLon, maxLon, minLat, maxLat)
+    # Points off of the planet are NaN, ignore them
+    valid = ~(numpy.isnan(points['lon']) | numpy.isnan(points['lat']))
+    if not valid.any():
+        raise Exception('campt did not find any ground points on the edge of cube ' + cubePath)
+    lon = points['lon'][valid]
+    lat = points['lat'][valid]
+
+    return (float(lon.min()), float(lon.max()), float(lat.min()), float(lat.max()))
 
 
 def getCubeCenterLatitude(cubePath, workDir='tmp'):
+    """Returns the CenterLatitude of a cube, only calling caminfo if it cannot be found faster"""
+
+    # Make sure the requested file is present
+    if not os.path.exists(cubePath):
+        raise Exception('File ' + cubePath + ' does not exist!')
+
+    try:
+        return estimateCubeCenterLatitude(cubePath)
+    except Exception: # Fall back to the slow but reliable method
+        return getCubeCenterLatitudeFromCaminfo(cubePath, workDir)
+
+
+@IrgCacheFunctions.cacheFileResult('cube_center_latitude')
+def estimateCubeCenterLatitude(cubePath):
+    """Finds the center latitude of a cube from its label or with a single campt call"""
+
+    # Map projected cubes have the latitude range in the label
+    label  = readIsisLabel(cubePath)
+    minLat = getPvlValue(label, 'IsisCube/Mapping/MinimumLatitude')
+    maxLat = getPvlValue(label, 'IsisCube/Mapping/MaximumLatitude')
+    if (minLat is not None) and (maxLat is not None):
+        return (float(minLat) + float(maxLat)) / 2.0
+
+    # Otherwise ask the camera model for the center pixel
+    cubeSize = getImageSize(cubePath)
+    points   = getPixelLocsInCube(cubePath, [(cubeSize[0] + 1) / 2.0], [(cubeSize[1] + 1) / 2.0])
+    if not numpy.isnan(points['lat'][0]):
+        return float(points['lat'][0])
+
+    # The center pixel is off the body, use the middle of the footprint
+    (minLon, maxLon, minLat, maxLat) = getIsisBoundingBox(cubePath)
+    return (minLat + maxLat) / 2.0
+
+
+@IrgCacheFunctions.cacheFileResult('caminfo_center_latitude')
+def getCubeCenterLatitudeFromCaminfo(cubePath, workDir='tmp'):
     """Calls caminfo on a cube and returns the CenterLatitude value"""
 
     # Make sure the requested file is present
     if not os.path.exists(cubePath):
         raise Exception('File ' + cubePath + ' does not exist!')
 
-    # Call caminfo (from ISIS) on the input cube to find out the CenterLatitude value
-    camInfoOuputPath = workDir + "/camInfoOutput.txt"
-    cmd = 'caminfo from=' + cubePath + ' to=' + camInfoOuputPath
-    print cmd
-    os.system(cmd)
+    # Each call writes to its own folder so that concurrent calls sharing workDir don't collide
+    IrgFileFunctions.createFolder(workDir)
+    tempFolder = tempfile.mkdtemp(prefix='caminfo_', dir=workDir)
+    try:
+        # Call caminfo (from ISIS) on the input cube to find out the CenterLatitude value
+        camInfoOuputPath = os.path.join(tempFolder, 'camInfoOutput.txt')
+        cmd = 'caminfo from=' + cubePath + ' to=' + camInfoOuputPath
+        print cmd
+        os.system(cmd)
 
-    if not os.path.exists(camInfoOuputPath):
-        raise Exception('Call to caminfo failed on file ' + cubePath)
+        if not os.path.exists(camInfoOuputPath):
+            raise Exception('Call to caminfo failed on file ' + cubePath)
+
+        # Read in the output file to extract the CenterLatitude value
+        centerLatitude = -9999
+        infoFile       = open(camInfoOuputPath, 'r')
+        for line in infoFile:
+            if (line.find('CenterLatitude') >= 0):
+                centerLatitude = IrgStringFunctions.getNumberAfterEqualSign(line, )
+                break
+        infoFile.close()
+    finally:
+        # Clean up temporary files
+        IrgFileFunctions.removeFolderIfExists(tempFolder)
 
-    # Read in the output file to extract the CenterLatitude value
-    centerLatitude = -9999
-    infoFile       = open(camInfoOuputPath, 'r')
-    for line in infoFile:
-        if (line.find('CenterLatitude') >= 0):
-            centerLatitude = IrgStringFunctions.getNumberAfterEqualSign(line, )
-            break
     # Make sure we found the desired value
     if (centerLatitude == -9999) or (isinstance(centerLatitude, basestring)):
         raise Exception("Unable to find CenterLatitude from file " + cubePath)
-
-    # Clean up temporary file
-    os.remove(camInfoOuputPath)
     
     return centerLatitude
     
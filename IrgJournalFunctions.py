@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+"""IrgJournalFunctions.py - Records which tasks of a run have finished so a rerun can resume"""
+
+import sys, os, json, hashlib, fcntl, threading
+
+
+def getTaskHash(parameters):
+    """Returns a hash of everything that determines the output of a task.
+       The parameters can be any JSON compatible value."""
+    return hashlib.md5(json.dumps(parameters, sort_keys=True)).hexdigest()
+
+def getInputFileStamp(path):
+    """Returns (path, size, mtime) for an input file so that changing it invalidates tasks"""
+    fileStat = os.stat(path)
+    return [os.path.abspath(path), fileStat.st_size, fileStat.st_mtime]
+
+
+def updateRecords(records, record):
+    """Makes record the current one for its task, unless it only says that a task
+       which is already done with the same hash was started again"""
+    last = records.get(record['task'])
+    if (record['state'] == 'started') and last and (last['state'] == 'done') and (last['hash'] == record['hash']):
+        return
+    records[record['task']] = record
+
+
+class TaskJournal(object):
+    """A journal of task states kept in a JSONL file.
+
+       Each change appends one line under a file lock, so many processes on many nodes
+       can share a journal and a crash never leaves a partial record.  When the file is
+       read the last record for each task wins, except that a started record does not
+       hide a done record with the same hash (a duplicate copy started after it)."""
+
+    def __init__(self, journalPath, readExisting=True):
+        """Set readExisting to False in processes which only add records"""
+        self.journalPath = os.path.abspath(journalPath)
+        self._lock       = threading.Lock()
+        self._records    = {}
+        if readExisting:
+            self.reload()
+
+    def reload(self):
+        """Reads the journal file again"""
+        records = {}
+        if os.path.exists(self.journalPath):
+            f = open(self.journalPath, 'r')
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError: # Skip a line cut off by a crash
+                    continue
+                updateRecords(records, record)
+            f.close()
+        with self._lock:
+            self._records = records
+
+    def _append(self, record, keepDone=False):
+        """Adds a record to the file and the in-memory copy.  With keepDone the record is not
+           added if the task is already done with the same hash according to the file.
+           Returns True if the record was added."""
+        f = open(self.journalPath, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if keepDone:
+                f.seek(0)
+                records = {}
+                for line in f:
+                    try:
+                        other = json.loads(line)
+                    except ValueError: # Skip a line cut off by a crash
+                        continue
+                    if other['task'] == record['task']:
+                        updateRecords(records, other)
+                last = records.get(record['task'])
+                if last and (last['state'] == 'done') and (last['hash'] == record['hash']):
+                    return False
+            f.seek(0, os.SEEK_END)
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+        with self._lock:
+            updateRecords(self._records, record)
+        return True
+
+    def markStarted(self, task, taskHash, outputPath):
+        self._append({'task': task, 'hash': taskHash, 'output': os.path.abspath(outputPath),
+                      'state': 'started'})
+
+    def markFailed(self, task, taskHash, outputPath):
+        """Records that a task failed, unless another copy of it already finished"""
+        return self._append({'task': task, 'hash': taskHash, 'output': os.path.abspath(outputPath),
+                             'state': 'failed'}, keepDone=True)
+
+    def markDone(self, task, taskHash, outputPath, extra={}):
+        """Records that a task finished, along with the size of its output and any extra values"""
+        record = dict(extra)
+        record.update({'task': task, 'hash': taskHash, 'output': os.path.abspath(outputPath),
+                       'size': os.path.getsize(outputPath), 'state': 'done'})
+        self._append(record)
+
+    def getRecord(self, task):
+        with self._lock:
+            return self._records.get(task)
+
+    def isComplete(self, task, taskHash, outputPath):
+        """Returns True if the task finished with the same parameters and its output is unchanged"""
+        record = self.getRecord(task)
+        if (record is None) or (record['state'] != 'done') or (record['hash'] != taskHash):
+            return False
+        outputPath = os.path.abspath(outputPath)
+        if (record['output'] != outputPath) or not os.path.exists(outputPath):
+            return False
+        return (os.path.getsize(outputPath) == record['size'])
+
+    def compact(self):
+        """Rewrites the journal with only the last record of each task, replacing the file in one step.
+           Only call this while no other process is using the journal."""
+        with self._lock:
+            records = self._records.values()
+        tempPath = self.journalPath + '.tmp'
+        f = open(tempPath, 'w')
+        for record in sorted(records, key=lambda r: r['task']):
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tempPath, self.journalPath)
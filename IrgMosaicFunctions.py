@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+"""IrgMosaicFunctions.py - Writes tiles into a single output image as they are finished"""
+
+import sys, os, math, threading
+
+import IrgGdalFunctions
+
+# NumPy is needed to copy the tiles and compute the overviews in-process
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Overviews are added until the smallest one fits in one of these
+MIN_OVERVIEW_SIZE = 256
+
+
+def canStreamMosaic():
+    """Returns True if the GDAL python bindings and numpy are available"""
+    return IrgGdalFunctions.haveGdalBindings() and (numpy is not None)
+
+
+def getOverviewLevels(width, height, minSize=MIN_OVERVIEW_SIZE):
+    """Returns the overview factors (2, 4, 8...) needed to get an image down to minSize pixels"""
+    levels = []
+    factor = 2
+    while (max(width, height) + factor//2 - 1) // (factor//2) > minSize:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def downsampleByTwo(values, nodata=None):
+    """Averages 2x2 blocks of a 2D array, ignoring nodata pixels.
+       Odd sizes are handled by averaging the last row or column on its own."""
+
+    (height, width) = values.shape
+    outHeight = (height + 1) // 2
+    outWidth  = (width  + 1) // 2
+
+    # Pad to an even size with pixels that don't count
+    data  = numpy.zeros((outHeight*2, outWidth*2), dtype=numpy.float64)
+    valid = numpy.zeros((outHeight*2, outWidth*2), dtype=bool)
+    data[:height, :width]  = values
+    valid[:height, :width] = True
+    if values.dtype.kind == 'f':
+        valid[:height, :width] &= numpy.isfinite(values)
+    if nodata is not None:
+        valid[:height, :width] &= (values != nodata)
+    data[~valid] = 0
+
+    # Sum each 2x2 block
+    counts = valid.reshape(outHeight, 2, outWidth, 2).sum(axis=(1, 3))
+    sums   = data.reshape(outHeight, 2, outWidth, 2).sum(axis=(1, 3))
+
+    output = numpy.zeros((outHeight, outWidth), dtype=numpy.float64)
+    hasData = counts > 0
+    output[hasData] = sums[hasData] / counts[hasData]
+    if nodata is not None:
+        output[~hasData] = nodata
+    if values.dtype.kind in 'iu':
+        output = numpy.round(output)
+    return output.astype(values.dtype)
+
+
+class StreamingMosaicWriter(object):
+    """Writes tiles into a tiled, compressed BigTIFF as soon as each one is finished.
+
+       Tiles may arrive in any order and from several threads.  Each block of the file is
+       written once, when all of its pixels are known, so no compressed block is rewritten
+       and the file has no dead space.  Parts of blocks are kept in memory until the
+       neighboring tiles arrive.  An overview block is computed as soon as all of the blocks
+       under it are finished, so the output is complete once the last tile is added.
+       The output is created from the size, type and georeference of the first tile."""
+
+    def __init__(self, outputPath, fullWidth, fullHeight, compression='LZW', predictor=None, blockSize=512,
+                 numThreads='ALL_CPUS', creationOptions=[]):
+        if not canStreamMosaic():
+            raise Exception('The streaming mosaic writer requires the GDAL python bindings and numpy!')
+        self.outputPath  = outputPath
+        self.fullWidth   = fullWidth
+        self.fullHeight  = fullHeight
+        self.blockSize   = blockSize
+        self.options     = ['TILED=YES', 'BIGTIFF=YES', 'COMPRESS=' + compression,
+                            'BLOCKXSIZE=' + str(blockSize), 'BLOCKYSIZE=' + str(blockSize),
+                            'NUM_THREADS=' + str(numThreads)] + creationOptions # Compress blocks on several threads
+        if predictor:
+            self.options.append('PREDICTOR=' + str(predictor))
+        self.levels      = getOverviewLevels(fullWidth, fullHeight)
+        self.dataset     = None
+        self.nodataValues = []
+        self.numTiles    = 0
+        self._lock       = threading.Lock() # GDAL datasets are not thread safe
+        self._grids      = []  # (width, height, blockWidth, blockHeight) of each level, full resolution first
+        self._done       = []  # Blocks of each level which are written
+        self._claimed    = []  # Overview blocks which are written or being computed
+        self._pending    = {}  # Partly covered full resolution blocks: block -> (band arrays, pixels covered)
+        self._emptyRegions = [] # Regions without tiles added before the output was created
+
+    def _create(self, tileDataset, tileX, tileY):
+        """Creates the output file using the first tile as a template"""
+        gdal = IrgGdalFunctions.gdal
+        numBands = tileDataset.RasterCount
+        dataType = tileDataset.GetRasterBand(1).DataType
+        driver   = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(self.outputPath, self.fullWidth, self.fullHeight, numBands, dataType, self.options)
+        if self.dataset is None:
+            raise Exception('Failed to create mosaic ' + self.outputPath)
+
+        # The georeference of the output is the tile's, moved to the top left corner
+        geoTransform = list(tileDataset.GetGeoTransform())
+        geoTransform[0] -= tileX * geoTransform[1] + tileY * geoTransform[2]
+        geoTransform[3] -= tileX * geoTransform[4] + tileY * geoTransform[5]
+        self.dataset.SetGeoTransform(geoTransform)
+        self.dataset.SetProjection(tileDataset.GetProjectionRef())
+
+        # Areas without tiles are filled with nodata when the file is closed
+        for b in range(1, numBands+1):
+            nodata = tileDataset.GetRasterBand(b).GetNoDataValue()
+            if nodata is not None:
+                self.dataset.GetRasterBand(b).SetNoDataValue(nodata)
+            self.nodataValues.append(nodata)
+
+        # Allocate the overviews now with the same block size, they are filled in as the tiles arrive
+        if self.levels:
+            oldBlockSize = gdal.GetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE')
+            gdal.SetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE', str(self.blockSize))
+            try:
+                self.dataset.BuildOverviews('NONE', self.levels)
+            finally:
+                gdal.SetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE', oldBlockSize)
+
+        band = self.dataset.GetRasterBand(1)
+        self._grids = [(band.XSize, band.YSize) + tuple(band.GetBlockSize())]
+        for i in range(band.GetOverviewCount()):
+            overview = band.GetOverview(i)
+            self._grids.append((overview.XSize, overview.YSize) + tuple(overview.GetBlockSize()))
+        self._done    = [set() for grid in self._grids]
+        self._claimed = [set() for grid in self._grids]
+
+    def _getBand(self, bandIndex, level):
+        """Returns a band of the output at a level, 0 is full resolution"""
+        band = self.dataset.GetRasterBand(bandIndex)
+        if level == 0:
+            return band
+        return band.GetOverview(level-1)
+
+    def _getBlockRegion(self, level, block):
+        """Returns the (startX, startY, stopX, stopY) pixels of a block"""
+        (width, height, blockWidth, blockHeight) = self._grids[level]
+        return (block[0]*blockWidth, block[1]*blockHeight,
+                min((block[0]+1)*blockWidth, width), min((block[1]+1)*blockHeight, height))
+
+    def _getBlocksInRegion(self, level, startX, startY, stopX, stopY):
+        """Returns the blocks of a level which overlap a pixel region"""
+        (width, height, blockWidth, blockHeight) = self._grids[level]
+        stopX = min(stopX, width)
+        stopY = min(stopY, height)
+        if (stopX <= startX) or (stopY <= startY):
+            return []
+        return [(bx, by) for by in range(startY // blockHeight, (stopY-1) // blockHeight + 1)
+                         for bx in range(startX // blockWidth,  (stopX-1) // blockWidth  + 1)]
+
+    def _addRegion(self, startX, startY, stopX, stopY, tileData):
+        """Copies pixels into the full resolution blocks, tileData is None for a region without data.
+           A block is written once all of its pixels are known.  Returns the finished blocks.
+           Must be called with the lock held."""
+
+        finished = []
+        for block in self._getBlocksInRegion(0, startX, startY, stopX, stopY):
+            (x0, y0, x1, y1) = self._getBlockRegion(0, block)
+            (ox0, oy0, ox1, oy1) = (max(x0, startX), max(y0, startY), min(x1, stopX), min(y1, stopY))
+            (arrays, numCovered) = self._pending.pop(block, (None, 0))
+            numCovered += (ox1 - ox0) * (oy1 - oy0)
+
+            if tileData is not None:
+                if (ox0, oy0, ox1, oy1) == (x0, y0, x1, y1): # The whole block is in this tile
+                    arrays = [data[y0-startY:y1-startY, x0-startX:x1-startX] for data in tileData]
+                else:
+                    if arrays is None:
+                        arrays = [numpy.zeros((y1-y0, x1-x0), dtype=data.dtype) for data in tileData]
+                        for (array, nodata) in zip(arrays, self.nodataValues):
+                            if nodata is not None:
+                                array[:] = nodata
+                    for (array, data) in zip(arrays, tileData):
+                        array[oy0-y0:oy1-y0, ox0-x0:ox1-x0] = data[oy0-startY:oy1-startY, ox0-startX:ox1-startX]
+
+            if numCovered < (x1 - x0) * (y1 - y0):
+                self._pending[block] = (arrays, numCovered)
+                continue
+            if arrays is not None: # Blocks without any data are filled with nodata by GDAL
+                for (b, array) in enumerate(arrays):
+                    self.dataset.GetRasterBand(b+1).WriteArray(array, x0, y0)
+            self._done[0].add(block)
+            finished.append(block)
+        return finished
+
+    def addTile(self, tilePath, tileX, tileY):
+        """Copies a finished tile into the mosaic at pixel (tileX, tileY) and updates the overviews"""
+
+        tileDataset = IrgGdalFunctions.openImage(tilePath)
+        finished = []
+        with self._lock:
+            if self.dataset is None:
+                self._create(tileDataset, tileX, tileY)
+                for region in self._emptyRegions:
+                    finished += self._addRegion(region[0], region[1], region[2], region[3], None)
+                self._emptyRegions = []
+
+        # Each call has its own tile dataset, so it is read without the lock
+        tileData = [tileDataset.GetRasterBand(b).ReadAsArray() for b in range(1, tileDataset.RasterCount+1)]
+        (width, height) = (tileDataset.RasterXSize, tileDataset.RasterYSize)
+        tileDataset = None # Close the file
+
+        with self._lock:
+            finished += self._addRegion(tileX, tileY, tileX+width, tileY+height, tileData)
+            self.numTiles += 1
+        self._updateOverviews(finished)
+
+    def addEmptyRegion(self, startX, startY, stopX, stopY):
+        """Marks a region which will not get a tile, such as a culled tile, so the blocks
+           and overviews around it do not wait for it"""
+        with self._lock:
+            if self.dataset is None:
+                self._emptyRegions.append((startX, startY, stopX, stopY))
+                return
+            finished = self._addRegion(startX, startY, stopX, stopY, None)
+        self._updateOverviews(finished)
+
+    def _updateOverviews(self, finishedBlocks):
+        """Computes the overview blocks above some newly finished blocks, if all of their source
+           blocks are finished.  Each overview block is computed once from the level above it.
+           The downsampling is done without the lock so several tiles are processed at once."""
+
+        for level in range(1, len(self._grids)):
+            # Claim the blocks of this level which can now be computed
+            ready = []
+            with self._lock:
+                parents = set()
+                for block in finishedBlocks:
+                    (x0, y0, x1, y1) = self._getBlockRegion(level-1, block)
+                    parents.update(self._getBlocksInRegion(level, x0//2, y0//2, (x1+1)//2, (y1+1)//2))
+                for parent in parents:
+                    if parent in self._claimed[level]:
+                        continue
+                    (x0, y0, x1, y1) = self._getBlockRegion(level, parent)
+                    children = self._getBlocksInRegion(level-1, x0*2, y0*2, x1*2, y1*2)
+                    if all([child in self._done[level-1] for child in children]):
+                        self._claimed[level].add(parent)
+                        ready.append(parent)
+
+            for block in ready:
+                (x0, y0, x1, y1) = self._getBlockRegion(level, block)
+                (sourceWidth, sourceHeight) = self._grids[level-1][0:2]
+                with self._lock:
+                    values = [self._getBand(b, level-1).ReadAsArray(x0*2, y0*2, min(x1*2, sourceWidth) - x0*2,
+                                                                    min(y1*2, sourceHeight) - y0*2)
+                              for b in range(1, len(self.nodataValues)+1)]
+                output = [downsampleByTwo(v, nodata) for (v, nodata) in zip(values, self.nodataValues)]
+                with self._lock:
+                    for (b, array) in enumerate(output):
+                        self._getBand(b+1, level).WriteArray(array, x0, y0)
+                    self._done[level].add(block)
+            finishedBlocks = ready
+
+    def close(self):
+        """Writes the blocks still waiting for tiles and the overviews above them, then writes
+           everything to disk.  Returns the number of tiles in the mosaic."""
+        if self.dataset is None:
+            return self.numTiles
+
+        # Only happens if some tiles are missing, their pixels are left as nodata
+        with self._lock:
+            finished = []
+            for (block, (arrays, numCovered)) in self._pending.items():
+                if arrays is not None:
+                    (x0, y0, x1, y1) = self._getBlockRegion(0, block)
+                    for (b, array) in enumerate(arrays):
+                        self.dataset.GetRasterBand(b+1).WriteArray(array, x0, y0)
+            self._pending = {}
+            (width, height) = self._grids[0][0:2]
+            for block in self._getBlocksInRegion(0, 0, 0, width, height):
+                if block not in self._done[0]:
+                    self._done[0].add(block)
+                    finished.append(block)
+        self._updateOverviews(finished)
+
+        with self._lock:
+            self.dataset.FlushCache()
+            self.dataset = None
+        return self.numTiles
+
+
+#==================================================
+# Cloud optimized GeoTIFF output
+
+# The COG driver names the TIFF predictor values
+COG_PREDICTORS = {'1': 'NO', '2': 'STANDARD', '3': 'FLOATING_POINT'}
+
+def getCogCreationOptions(compression, predictor=None, blockSize=512, numThreads='ALL_CPUS'):
+    """Returns the GDAL COG driver creation options.  Without a predictor the driver
+       picks one that suits the data type."""
+    options = ['COMPRESS=' + compression, 'BLOCKSIZE=' + str(blockSize), 'BIGTIFF=IF_SAFER',
+               'NUM_THREADS=' + str(numThreads)]
+    if predictor:
+        options.append('PREDICTOR=' + COG_PREDICTORS[str(predictor)])
+    else:
+        options.append('PREDICTOR=YES')
+    return options
+
+def getGtiffCogCreationOptions(compression, predictor=None, blockSize=512, numThreads='ALL_CPUS'):
+    """Returns GTiff driver creation options giving the COG layout, for GDAL versions without the COG driver.
+       The source must already have its overviews."""
+    options = ['TILED=YES', 'COPY_SRC_OVERVIEWS=YES', 'COMPRESS=' + compression, 'BIGTIFF=IF_SAFER',
+               'BLOCKXSIZE=' + str(blockSize), 'BLOCKYSIZE=' + str(blockSize), 'NUM_THREADS=' + str(numThreads)]
+    if predictor:
+        options.append('PREDICTOR=' + str(predictor))
+    return options
+
+def convertToCog(inputPath, outputPath, compression='DEFLATE', predictor=None, blockSize=512):
+    """Rewrites a tiled image which already has overviews (such as a StreamingMosaicWriter output)
+       as a cloud optimized GeoTIFF, keeping the existing overviews"""
+
+    gdal = IrgGdalFunctions.gdal
+    if gdal.GetDriverByName('COG') is not None:
+        driverName = 'COG'
+        options    = getCogCreationOptions(compression, predictor, blockSize) + ['OVERVIEWS=FORCE_USE_EXISTING']
+    else:
+        driverName = 'GTiff'
+        options    = getGtiffCogCreationOptions(compression, predictor, blockSize)
+
+    source  = IrgGdalFunctions.openImage(inputPath)
+    output  = gdal.GetDriverByName(driverName).CreateCopy(outputPath, source, 0, options)
+    if output is None:
+        raise Exception('Failed to write cloud optimized GeoTIFF ' + outputPath)
+    output = None # Close the files
+    source = None
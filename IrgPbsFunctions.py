@@ -19,9 +19,9 @@
 
 """IrgPbsFunctions.py - Functions for working with the Pleiades PBS system"""
 
-import sys, os, re, shutil, subprocess, string, time, errno
+import sys, os, re, shutil, subprocess, string, time, errno, json, socket, pipes, threading, Queue
 
-import IrgFileFunctions
+import IrgFileFunctions, IrgTraceFunctions
 
 def getNumNodesInList(nodesListPath):
     """Get number of Pleiades nodes listed in a file"""
@@ -52,7 +52,8 @@ def getNumNodesInList(nodesListPath):
 
 
 def runInGnuParallel(numParallelProcesses, commandString, argumentFilePath, parallelArgs=[], nodeListPath=None, verbose=False):
-    """Use GNU Parallel to spread task across multiple computers and processes"""
+    """Use GNU Parallel to spread task across multiple computers and processes.
+       numParallelProcesses is the number of processes on each computer."""
 
     # Make sure GNU parallel is installed
     if not IrgFileFunctions.checkIfToolExists('parallel'):
@@ -73,17 +74,345 @@ def runInGnuParallel(numParallelProcesses, commandString, argumentFilePath, para
     # Append any additional arguments to parallel
     cmd += parallelArgs
 
+    # When tracing, each job is wrapped so that it writes its own record
+    if IrgTraceFunctions.isTracingEnabled():
+        tracerPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traceCommand.py')
+        cmd += ['python', tracerPath, '--trace-file', IrgTraceFunctions.getTraceFile(),
+                '--stage', IrgTraceFunctions.getTraceStage() or 'parallel', '--']
+
     # Append the actual command we want to call to the GNU Parallel call    
     cmd += [commandString]
 
     if verbose: # Echo the command line call we are about to make
         print(" ".join(cmd))
 
+    if IrgTraceFunctions.isTracingEnabled():
+        return IrgTraceFunctions.callTraced(cmd)
     returnCode = subprocess.call(cmd)
     return returnCode
 
 
 
+#==================================================
+# A task executor written in Python which can be used instead of GNU parallel
+
+class TaskResult(object):
+    """The outcome of one task run by a TaskExecutor"""
+
+    def __init__(self, index, cmd):
+        self.index      = index # Position in the argument file
+        self.cmd        = cmd
+        self.host       = None
+        self.returnCode = None
+        self.startTime  = None
+        self.endTime    = None
+        self.attempts   = 0     # Number of times the task was started
+        self.speculated = False # Set if a duplicate was started because the task was slow
+        self.winner     = None  # Number of the attempt which produced the result
+
+    def succeeded(self):
+        return (self.returnCode == 0)
+
+    def getWallTime(self):
+        if (self.startTime is None) or (self.endTime is None):
+            return 0.0
+        return self.endTime - self.startTime
+
+
+def readNodesList(nodesListPath):
+    """Returns the unique host names in a nodes list file, in order"""
+    hosts = []
+    fileHandle = open(nodesListPath, 'r')
+    for line in fileHandle:
+        matches = re.match('^\s*([^\s]+)', line)
+        if matches and (matches.group(1) not in hosts):
+            hosts.append(matches.group(1))
+    fileHandle.close()
+    if not hosts:
+        raise Exception('The list of computing nodes is empty')
+    return hosts
+
+def isLocalHost(host):
+    """Returns True if a host name refers to this machine"""
+    return host in [':', 'localhost', '127.0.0.1', socket.gethostname(), socket.getfqdn()]
+
+def buildTaskCommands(commandString, argumentFilePath, columnSeparator=None):
+    """Fills in the command for each line of an argument file the way GNU parallel does.
+       {} is replaced by the whole line and {1}, {2}... by the columns,
+       if there are no replacement strings the line is appended to the command."""
+
+    commands = []
+    argFile  = open(argumentFilePath, 'r')
+    for line in argFile:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        if columnSeparator:
+            columns = re.split(columnSeparator, line)
+        else:
+            columns = [line]
+        hasReplacement = ('{}' in commandString) or re.search('\{[0-9]+\}', commandString)
+        if not hasReplacement:
+            commands.append(commandString + ' ' + line)
+            continue
+        cmd = commandString.replace('{}', line)
+        cmd = re.sub('\{([0-9]+)\}', lambda m: columns[int(m.group(1))-1], cmd)
+        commands.append(cmd)
+    argFile.close()
+    return commands
+
+
+class TaskExecutor(object):
+    """Runs shell commands on a set of hosts with one long lived taskAgent.py process per host.
+
+       Tasks wait in a central queue and are handed to whichever agent has a free slot, so
+       fast hosts take more work.  If an agent dies its unfinished tasks go back in the queue.
+
+       With speculative set, once the queue is empty a task which has been running for more
+       than speculationFactor times the median task time is started again on a free slot.
+       The first attempt to succeed is kept and the other one is killed, so this should only
+       be used with tasks that can safely run twice at the same time."""
+
+    def __init__(self, hosts=['localhost'], slotsPerHost=None, envNames=[], verbose=False,
+                 speculative=False, speculationFactor=2.0, minSamples=3, agentArgs=[]):
+        if not slotsPerHost:
+            import IrgSystemFunctions
+            slotsPerHost = IrgSystemFunctions.get_num_cpus()
+        self.hosts        = hosts
+        self.slotsPerHost = slotsPerHost
+        self.envNames     = envNames # Environment variables copied to remote agents
+        self.verbose      = verbose
+        self.speculative       = speculative
+        self.speculationFactor = speculationFactor
+        self.minSamples        = minSamples # Completed tasks needed before the median is trusted
+        self.agentPath    = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taskAgent.py')
+        self.agentArgs    = agentArgs # Extra arguments for taskAgent.py, such as a handler module
+
+    def _getAgentCommand(self, host):
+        """Returns the command which starts an agent on a host"""
+        agentArgs = [self.agentPath, '--slots', str(self.slotsPerHost)] + self.agentArgs
+        if isLocalHost(host):
+            return [sys.executable] + agentArgs
+        remoteCmd = 'cd ' + pipes.quote(os.getcwd()) + ' && env'
+        for name in self.envNames:
+            if name in os.environ:
+                remoteCmd += ' ' + name + '=' + pipes.quote(os.environ[name])
+        remoteCmd += ' python ' + ' '.join([pipes.quote(a) for a in agentArgs])
+        return ['ssh', '-o', 'BatchMode=yes', host, remoteCmd]
+
+    def _readAgent(self, agentIndex, process, events):
+        """Thread which forwards the messages from one agent to the events queue"""
+        for line in iter(process.stdout.readline, ''):
+            try:
+                events.put(('result', agentIndex, json.loads(line)))
+            except ValueError: # Not a message from the agent
+                sys.stderr.write(line)
+        events.put(('exit', agentIndex, None))
+
+    def _send(self, agent, message):
+        """Sends a message to an agent, returns False if the agent is gone"""
+        try:
+            agent['process'].stdin.write(json.dumps(message) + '\n')
+            agent['process'].stdin.flush()
+            return True
+        except IOError: # The agent died, the exit event will clean up
+            agent['alive'] = False
+            return False
+
+    def run(self, commands):
+        """Runs all the commands and returns a list of TaskResults in the same order"""
+
+        results = [TaskResult(i, cmd) for (i, cmd) in enumerate(commands)]
+        done    = [False] * len(results)
+        pending = range(len(results))
+        pending.reverse() # Pop from the end
+
+        # Start one agent per host
+        events   = Queue.Queue()
+        agents   = []
+        for (i, host) in enumerate(self.hosts):
+            process = subprocess.Popen(self._getAgentCommand(host), stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, close_fds=True)
+            thread  = threading.Thread(target=self._readAgent, args=(i, process, events))
+            thread.daemon = True
+            thread.start()
+            # running maps (task index, attempt) -> time the attempt was sent
+            agents.append({'host': host, 'process': process, 'running': {}, 'alive': True})
+
+        def getRunningAttempts(index):
+            """Returns a list of (agent, attempt) for the attempts of a task still running"""
+            return [(a, key[1]) for a in agents for key in a['running'].keys() if key[0] == index]
+
+        def start(agent, index):
+            """Starts a new attempt of a task on an agent"""
+            result = results[index]
+            result.attempts += 1
+            if not self._send(agent, {'id': index, 'attempt': result.attempts, 'cmd': result.cmd}):
+                return False
+            agent['running'][(index, result.attempts)] = time.time()
+            return True
+
+        def dispatch():
+            """Hands out tasks until there are no free slots"""
+            for agent in agents:
+                while agent['alive'] and pending and (len(agent['running']) < self.slotsPerHost):
+                    index = pending.pop()
+                    if not start(agent, index):
+                        pending.append(index)
+
+        durations = []
+        def speculate():
+            """Starts a second attempt of slow tasks once nothing is left in the queue"""
+            if pending or (len(durations) < self.minSamples):
+                return
+            threshold = self.speculationFactor * sorted(durations)[len(durations) / 2]
+            now = time.time()
+            for agent in agents:
+                for ((index, attempt), sendTime) in agent['running'].items():
+                    if results[index].speculated or (now - sendTime < threshold):
+                        continue
+                    # Prefer a free slot on another host in case this host is the slow part
+                    freeAgents = [a for a in agents
+                                  if a['alive'] and (len(a['running']) < self.slotsPerHost)]
+                    freeAgents.sort(key=lambda a: (a is agent))
+                    if freeAgents and start(freeAgents[0], index):
+                        results[index].speculated = True
+                        print ('Task %d has run for %.1f s on %s, starting a second attempt on %s'
+                               % (index, now - sendTime, agent['host'], freeAgents[0]['host']))
+
+        dispatch()
+        numDone = 0
+        while numDone < len(results):
+            if not any([a['alive'] for a in agents]):
+                break # Nothing left to run the remaining tasks
+            try:
+                (kind, agentIndex, message) = events.get(timeout=1.0)
+            except Queue.Empty:
+                if self.speculative:
+                    speculate()
+                continue
+            agent = agents[agentIndex]
+            if kind == 'exit':
+                agent['alive'] = False
+                lost = [key[0] for key in agent['running'].keys()]
+                agent['running'] = {}
+                # Only requeue tasks which are not finished or running somewhere else
+                lost = [i for i in lost if not done[i] and not getRunningAttempts(i)]
+                if lost:
+                    print >>sys.stderr, ('Lost the agent on ' + agent['host'] + ', requeueing '
+                                         + str(len(lost)) + ' task(s).')
+                pending.extend(lost)
+                dispatch()
+                continue
+
+            index   = message['id']
+            attempt = message['attempt']
+            agent['running'].pop((index, attempt), None)
+            others  = getRunningAttempts(index)
+
+            # Keep the first successful attempt, a failure only counts if no other attempt is running
+            if not done[index] and ((message['return_code'] == 0) or not others):
+                result = results[index]
+                result.host       = message['host']
+                result.returnCode = message['return_code']
+                result.startTime  = message['start']
+                result.endTime    = message['end']
+                result.winner     = attempt
+                done[index] = True
+                numDone    += 1
+                durations.append(result.getWallTime())
+                for (otherAgent, otherAttempt) in others: # Stop the attempts that lost
+                    self._send(otherAgent, {'kill': index, 'attempt': otherAttempt})
+                if self.verbose:
+                    print ('Task %d/%d finished on %s in %.1f s with code %d'
+                           % (numDone, len(results), result.host, result.getWallTime(), result.returnCode))
+            dispatch()
+            if self.speculative:
+                speculate()
+
+        # Closing stdin tells the agents to exit
+        for agent in agents:
+            try:
+                agent['process'].stdin.close()
+            except IOError:
+                pass
+            agent['process'].wait()
+
+        return results
+
+
+def writeJobLog(jobLogPath, results):
+    """Writes task results in the format of the GNU parallel --joblog file"""
+    f = open(jobLogPath, 'w')
+    f.write('Seq\tHost\tStarttime\tJobRuntime\tSend\tReceive\tExitval\tSignal\tCommand\n')
+    for r in results:
+        returnCode = r.returnCode
+        if returnCode is None:
+            returnCode = -1
+        exitVal = max(returnCode, 0)
+        signal  = max(-returnCode, 0)
+        f.write('%d\t%s\t%.3f\t%.3f\t0\t0\t%d\t%d\t%s\n'
+                % (r.index+1, r.host or ':', r.startTime or 0.0, r.getWallTime(), exitVal, signal, r.cmd))
+    f.close()
+
+def readJobLog(jobLogPath):
+    """Reads a GNU parallel --joblog file, returns a dictionary of sequence number -> job dictionary"""
+    jobs = {}
+    f = open(jobLogPath, 'r')
+    f.readline() # Header
+    for line in f:
+        parts = line.rstrip('\n').split('\t', 8)
+        if len(parts) < 9:
+            continue
+        jobs[int(parts[0])] = {'host': parts[1], 'start': float(parts[2]), 'runtime': float(parts[3]),
+                               'exitval': int(parts[6]), 'signal': int(parts[7]), 'command': parts[8]}
+    f.close()
+    return jobs
+
+
+def runInTaskExecutor(numParallelProcesses, commandString, argumentFilePath, parallelArgs=[], nodeListPath=None, verbose=False,
+                      speculative=False, agentArgs=[]):
+    """Drop in replacement for runInGnuParallel using TaskExecutor.
+       numParallelProcesses is the number of processes on each host, like the -P option of GNU parallel.
+       Returns the number of failed tasks, like GNU parallel."""
+
+    # Interpret the GNU parallel arguments we know about
+    columnSeparator = None
+    jobLogPath      = None
+    envNames        = []
+    i = 0
+    while i < len(parallelArgs):
+        if (parallelArgs[i] == '--colsep') and (i+1 < len(parallelArgs)):
+            columnSeparator = parallelArgs[i+1].replace('\\t', '\t')
+            i += 2
+        elif (parallelArgs[i] == '--joblog') and (i+1 < len(parallelArgs)):
+            jobLogPath = parallelArgs[i+1]
+            i += 2
+        elif (parallelArgs[i] == '--env') and (i+1 < len(parallelArgs)):
+            envNames.append(parallelArgs[i+1])
+            i += 2
+        else:
+            print 'Ignoring GNU parallel argument ' + parallelArgs[i]
+            i += 1
 
+    hosts = ['localhost']
+    if nodeListPath is not None:
+        hosts = readNodesList(nodeListPath)
 
+    commands = buildTaskCommands(commandString, argumentFilePath, columnSeparator)
+    executor = TaskExecutor(hosts, numParallelProcesses, envNames, verbose, speculative, agentArgs=agentArgs)
+    results  = executor.run(commands)
+    if jobLogPath:
+        writeJobLog(jobLogPath, results)
 
+    failed = [r for r in results if not r.succeeded()]
+    if verbose:
+        print ('Finished %d tasks on %d host(s), %d failed.'
+               % (len(results), len(hosts), len(failed)))
+    for r in results:
+        if r.speculated:
+            print ('Task %d was run twice, attempt %s finished first: %s'
+                   % (r.index, str(r.winner), r.cmd))
+    for r in failed:
+        print 'Failed task (' + str(r.returnCode) + '): ' + r.cmd
+    return len(failed)
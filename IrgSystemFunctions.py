@@ -19,20 +19,181 @@
 
 """IrgSystemFunctions.py - General systems related utilities"""
 
-import sys, os, re, shutil, subprocess, string, time, errno, multiprocessing
+import sys, os, re, shutil, subprocess, string, time, errno, math, multiprocessing, threading, collections, signal, Queue
 
 
-def get_num_cpus():
-    """Return the number of CPUs on the current machine."""
-    
-    import sys
-    if sys.version_info < (2, 6, 0):
-        num_cpus = 8
+def parseCpuList(text):
+    """Returns the number of CPUs in a list such as '0-3,8,10-11'"""
+    count = 0
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            (start, stop) = part.split('-')
+            count += int(stop) - int(start) + 1
+        else:
+            count += 1
+    return count
+
+def getAffinityCpuCount():
+    """Returns the number of CPUs this process is allowed to run on, or None if unknown"""
+    try:
+        f = open('/proc/self/status', 'r')
+        for line in f:
+            if line.startswith('Cpus_allowed_list:'):
+                f.close()
+                return parseCpuList(line.split(':')[1])
+        f.close()
+    except IOError:
+        pass
+    return None
+
+def readCgroupFile(controller, fileName):
+    """Returns the contents of a file for the cgroup this process is in, or None.
+       Handles both cgroup v1 (one folder per controller) and v2 (controller '')."""
+
+    # Find the cgroup path of this process for the controller
+    relPath = None
+    try:
+        f = open('/proc/self/cgroup', 'r')
+        for line in f:
+            parts = line.strip().split(':', 2)
+            if (len(parts) == 3) and (controller in parts[1].split(',')):
+                relPath = parts[2].lstrip('/')
+        f.close()
+    except IOError:
+        return None
+    if relPath is None:
+        return None
+
+    # Find the folders where the controller is mounted
+    cgroupRoot = '/sys/fs/cgroup'
+    if controller:
+        try:
+            roots = [os.path.join(cgroupRoot, d) for d in os.listdir(cgroupRoot)
+                     if controller in d.split(',')]
+        except OSError: # cgroup filesystem not mounted
+            return None
     else:
-        from multiprocessing import cpu_count
-        num_cpus = cpu_count()
+        roots = [cgroupRoot, os.path.join(cgroupRoot, 'unified')]
+
+    # Inside a container the cgroup path may not exist, then the root folder is the limit
+    for root in roots:
+        for folder in [os.path.join(root, relPath), root]:
+            path = os.path.join(folder, fileName)
+            if os.path.exists(path):
+                try:
+                    f = open(path, 'r')
+                    text = f.read().strip()
+                    f.close()
+                except IOError:
+                    return None
+                return text
+    return None
+
+def getCgroupCpuLimit():
+    """Returns the CPU quota of our cgroup rounded up to whole CPUs, or None if there is no quota"""
+
+    text = readCgroupFile('', 'cpu.max') # v2, "<quota> <period>" or "max <period>"
+    if text:
+        parts = text.split()
+        if parts[0] == 'max':
+            return None
+        return int(math.ceil(float(parts[0]) / float(parts[1])))
+
+    quota  = readCgroupFile('cpu', 'cpu.cfs_quota_us') # v1, -1 means no quota
+    period = readCgroupFile('cpu', 'cpu.cfs_period_us')
+    if quota and period and (int(quota) > 0):
+        return int(math.ceil(float(quota) / float(period)))
+    return None
+
+def getCgroupMemoryLimit():
+    """Returns the memory limit of our cgroup in bytes, or None if there is no limit"""
+
+    text = readCgroupFile('', 'memory.max') # v2
+    if text is None:
+        text = readCgroupFile('memory', 'memory.limit_in_bytes') # v1
+    if (text is None) or (text == 'max'):
+        return None
+    limit = int(text)
+    if limit >= 2**60: # v1 reports no limit as a very large number
+        return None
+    return limit
+
+def getPbsCpuCount():
+    """Returns the number of CPUs granted to the current PBS job on this node, or None"""
+    if 'PBS_JOBID' not in os.environ:
+        return None
+    for name in ['NCPUS', 'PBS_NUM_PPN']: # PBS Pro, Torque
+        if os.environ.get(name, '').isdigit():
+            return int(os.environ[name])
+    return None
+
+def readMemInfo(name):
+    """Returns a value from /proc/meminfo in bytes, or None"""
+    try:
+        f = open('/proc/meminfo', 'r')
+        for line in f:
+            if line.startswith(name + ':'):
+                f.close()
+                return int(line.split()[1]) * 1024
+        f.close()
+    except IOError:
+        pass
+    return None
+
+def getPhysicalMemory():
+    """Returns the total memory of the machine in bytes"""
+    total = readMemInfo('MemTotal')
+    if total is None:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return total
+
+def getAvailableMemory():
+    """Returns the memory that can currently be used without swapping, in bytes"""
+    available = readMemInfo('MemAvailable')
+    if available is None:
+        available = getPhysicalMemory()
+    limit = getCgroupMemoryLimit()
+    if limit is not None:
+        available = min(available, limit)
+    return available
+
+
+_resourceLimits = None
+
+def getResourceLimits():
+    """Returns a dictionary with the CPUs and memory this process was actually granted.
+       Takes the smallest of the machine size, CPU affinity, cgroup limits and the PBS allocation."""
+
+    global _resourceLimits
+    if _resourceLimits is not None:
+        return dict(_resourceLimits)
 
-    return num_cpus
+    cpus      = multiprocessing.cpu_count()
+    cpuSource = 'cpu_count'
+    for (source, count) in [('affinity', getAffinityCpuCount()),
+                            ('cgroup',   getCgroupCpuLimit()),
+                            ('pbs',      getPbsCpuCount())]:
+        if count and (count < cpus):
+            cpus      = count
+            cpuSource = source
+
+    memory       = getPhysicalMemory()
+    memorySource = 'physical'
+    limit        = getCgroupMemoryLimit()
+    if (limit is not None) and (limit < memory):
+        memory       = limit
+        memorySource = 'cgroup'
+
+    _resourceLimits = {'cpus': cpus, 'cpu_source': cpuSource,
+                       'memory': memory, 'memory_source': memorySource}
+    return dict(_resourceLimits)
+
+
+def get_num_cpus():
+    """Return the number of CPUs this process can use on the current machine."""
+    return getResourceLimits()['cpus']
 
 
 def isCmdOption(arg):
@@ -73,7 +234,7 @@ def stringToArgList(string):
 
 #TODO: Make sure this works for commands with wildcards
 def executeCommand(cmd, suppressOutput=False, echoCmd=False):
-    """Executes a command line"""
+    """Executes a command line and returns the exit code"""
     
     if echoCmd:
         print cmd
@@ -83,11 +244,364 @@ def executeCommand(cmd, suppressOutput=False, echoCmd=False):
         cmd = stringToArgList(cmd)
         print cmd
     
+    # Imported here, IrgTraceFunctions imports this module
+    import IrgTraceFunctions
+    call = subprocess.call
+    if IrgTraceFunctions.isTracingEnabled():
+        call = IrgTraceFunctions.callTraced
+
     if suppressOutput: # Process silently
         FNULL = open(os.devnull, 'w')
-        subprocess.call(cmd, stdout=FNULL, stderr=subprocess.STDOUT)
+        return call(cmd, stdout=FNULL, stderr=subprocess.STDOUT)
     else: # Display output
-        subprocess.call(cmd)
+        return call(cmd)
+
+
+def executeCommandForOutput(cmd, outputPath=None, suppressOutput=False, redo=False):
+    """Runs a command like asp_system_utils.executeCommand, with a trace record when tracing is on.
+       The command is skipped if outputPath already exists unless redo is set, and an exception
+       is raised if it does not create outputPath.  String commands go through the shell."""
+
+    if outputPath and (not redo) and os.path.exists(outputPath):
+        print 'Skipping command, output already exists: ' + outputPath
+        return 0
+    print cmd
+
+    # Imported here, IrgTraceFunctions imports this module
+    import IrgTraceFunctions
+    stdout = None
+    stderr = None
+    if suppressOutput:
+        stdout = open(os.devnull, 'w')
+        stderr = subprocess.STDOUT
+    try:
+        if IrgTraceFunctions.isTracingEnabled():
+            returnCode = IrgTraceFunctions.callTraced(cmd, stdout=stdout, stderr=stderr)
+        else:
+            returnCode = subprocess.call(cmd, shell=not isNotString(cmd), stdout=stdout, stderr=stderr)
+    finally:
+        if stdout:
+            stdout.close()
+
+    if outputPath and not os.path.exists(outputPath):
+        raise Exception('Command failed (' + str(returnCode) + ') to create ' + outputPath + ': ' + str(cmd))
+    return returnCode
+
+
+
+#==================================================
+# Concurrent execution of external tools
+
+class CommandResult(object):
+    """The outcome of one command run by a CommandRunner"""
+
+    def __init__(self, cmd, name, logPath=None):
+        self.cmd        = cmd
+        self.name       = name
+        self.logPath    = logPath
+        self.returnCode = None
+        self.wallTime   = 0.0
+        self.tail       = [] # The last lines of output
+        self.skipped    = False # Set if the command it depended on failed
+
+    def succeeded(self):
+        return (self.returnCode == 0)
+
+
+class CommandFuture(object):
+    """Handle to a command submitted to a CommandRunner"""
+
+    def __init__(self, result):
+        self._result    = result
+        self._event     = threading.Event()
+        self._lock      = threading.Lock()
+        self._callbacks = []
+        self._finished  = False
+
+    def _finish(self):
+        """Calls the callbacks and then wakes up anyone waiting on the command"""
+        with self._lock:
+            self._finished  = True
+            callbacks       = self._callbacks
+            self._callbacks = []
+        try:
+            for callback in callbacks:
+                callback(self._result)
+        finally:
+            self._event.set()
+
+    def addDoneCallback(self, callback):
+        """Calls callback(result) from the runner thread when the command finishes,
+           or immediately if it has already finished"""
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        callback(self._result)
+
+    def done(self):
+        """Returns True if the command has finished"""
+        return self._event.isSet()
+
+    def wait(self, timeout=None):
+        """Waits for the command to finish, returns False on timeout"""
+        self._event.wait(timeout)
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """Waits for the command and returns its CommandResult"""
+        if not self.wait(timeout):
+            raise Exception('Timed out waiting for command: ' + self._result.name)
+        return self._result
+
+
+# Programs which run another program, the tool name is taken from the next argument
+TOOL_LAUNCHERS = ['python', 'python2', 'python3', 'sh', 'bash', 'time', 'nice']
+
+# Shell commands which only set up for the next command in a shell command line
+SHELL_SETUP_COMMANDS = ['cd', 'export', 'source', '.', 'set', 'ulimit', 'umask']
+
+def getToolName(cmd):
+    """Returns the name of the program a command line calls"""
+    if isNotString(cmd):
+        commands = [[str(a) for a in cmd]]
+    else: # Look at each command in a shell command line like "cd folder && tool"
+        commands = [c.split() for c in re.split('&&|\|\||;|\|', cmd)]
+    for args in commands:
+        for arg in args:
+            # Skip launcher options and environment settings
+            if isCmdOption(arg) or re.match('^[0-9.]+$', arg) or re.match('^\w+=', arg):
+                continue
+            if os.path.basename(arg) in SHELL_SETUP_COMMANDS:
+                break
+            if os.path.basename(arg) not in TOOL_LAUNCHERS:
+                return os.path.basename(arg)
+    return os.path.basename(commands[0][0])
+
+
+class CommandRunner(object):
+    """Runs external commands on a fixed pool of maxProcesses worker threads with a per-tool
+       limit on how many run at once.  Output from each command goes to its own log file.
+
+       - toolLimits is a dictionary of tool name -> maximum concurrent processes.
+       - String commands go through the shell like os.system, lists are run directly.
+       - Each command runs in its own process group so cancel() also stops what it started.
+
+       Commands can also have a memory estimate in bytes, passed to submit() or looked up
+       by tool name in memoryEstimates.  A command only starts when the estimates of all the
+       running commands fit in memoryBudget, smaller commands are started in the meantime.
+       A command larger than the budget runs when nothing else is running."""
+
+    def __init__(self, maxProcesses=None, toolLimits={}, logFolder=None, tailLines=20,
+                 memoryBudget=None, memoryEstimates={}):
+        if not maxProcesses:
+            maxProcesses = get_num_cpus()
+        if not memoryBudget:
+            memoryBudget = getAvailableMemory()
+        self.maxProcesses    = maxProcesses
+        self.memoryBudget    = memoryBudget
+        self.memoryEstimates = dict(memoryEstimates)
+        self.logFolder  = logFolder
+        self.tailLines  = tailLines
+        self._toolLimits  = dict(toolLimits)
+        self._toolRunning = collections.defaultdict(int)
+        self._lock        = threading.Lock()
+        self._queue       = Queue.Queue() # Commands which are ready to start
+        self._waiting     = [] # Ready commands which did not fit the tool or memory limits
+        self._numWorkers  = 0
+        self._numRunning  = 0
+        self._memoryInUse = 0
+        self._processes   = set() # Running subprocess.Popen objects
+        self._cancelled   = False
+        self._futures   = []
+        self._count     = 0
+
+        if logFolder and not os.path.exists(logFolder):
+            os.makedirs(logFolder)
+
+    def submit(self, cmd, name=None, after=None, echoCmd=True, memory=None,
+               outputPath=None, redo=False, suppressOutput=True):
+        """Queues a command to run in the background and returns a CommandFuture.
+           If after is a CommandFuture the command waits for it and is skipped if it failed.
+           memory is the expected peak memory use of the command in bytes.
+           Like asp_system_utils.executeCommand, the command is not run if outputPath already
+           exists unless redo is set, and its output is also printed if suppressOutput is False."""
+
+        tool = getToolName(cmd)
+        if memory is None:
+            memory = self.memoryEstimates.get(tool, 0)
+        with self._lock:
+            self._count += 1
+            if not name:
+                name = '%04d_%s' % (self._count, tool)
+        logPath = None
+        if self.logFolder:
+            logPath = os.path.join(self.logFolder, name + '.log')
+
+        future = CommandFuture(CommandResult(cmd, name, logPath))
+        with self._lock:
+            self._futures.append(future)
+
+        # An earlier run already made the output, count it as a success
+        if outputPath and (not redo) and os.path.exists(outputPath):
+            if echoCmd:
+                print 'Skipping command, output already exists: ' + outputPath
+            future._result.returnCode = 0
+            future._result.tail       = ['Output already exists: ' + outputPath]
+            future._finish()
+            return future
+
+        job = (future, tool, after, echoCmd, memory, suppressOutput)
+        if after: # Queued once the command it depends on has finished, so no worker waits for it
+            after.addDoneCallback(lambda afterResult: self._enqueue(job))
+        else:
+            self._enqueue(job)
+        return future
+
+    def _enqueue(self, job):
+        """Queues a command which is ready to start, adding a worker if there are fewer than maxProcesses"""
+        with self._lock:
+            self._queue.put(job)
+            if self._numWorkers >= self.maxProcesses:
+                return
+            self._numWorkers += 1
+        worker = threading.Thread(target=self._workerLoop)
+        worker.daemon = True
+        worker.start()
+
+    def _workerLoop(self):
+        """Thread body for one worker, runs queued commands until the queue is empty"""
+        while True:
+            with self._lock: # Checked under the lock so _enqueue can't miss a worker leaving
+                if self._queue.empty():
+                    self._numWorkers -= 1
+                    return
+                job = self._queue.get_nowait()
+            (future, tool, after, echoCmd, memory, suppressOutput) = job
+            result = future._result
+            try:
+                if after and not after.result().succeeded():
+                    result.skipped = True
+                    result.tail    = ['Skipped because a previous command failed: ' + after.result().name]
+                elif self._cancelled:
+                    result.skipped = True
+                    result.tail    = ['Skipped because the runner was cancelled']
+                elif not self._admit(job):
+                    continue # Put aside until a running command finishes
+                else:
+                    try:
+                        self._execute(result, echoCmd, suppressOutput)
+                    finally:
+                        self._release(tool, memory)
+            except Exception, e:
+                result.tail.append('Failed to run command: ' + str(e))
+            future._finish()
+
+    def _admit(self, job):
+        """Takes a tool slot and memory for a command if they are free, otherwise puts it aside
+           and returns False"""
+        (future, tool, after, echoCmd, memory, suppressOutput) = job
+        with self._lock:
+            toolIsFull   = (tool in self._toolLimits) and (self._toolRunning[tool] >= self._toolLimits[tool])
+            memoryIsFull = (self._numRunning > 0) and (self._memoryInUse + memory > self.memoryBudget)
+            if toolIsFull or memoryIsFull:
+                self._waiting.append(job)
+                return False
+            self._toolRunning[tool] += 1
+            self._numRunning        += 1
+            self._memoryInUse       += memory
+            return True
+
+    def _release(self, tool, memory):
+        """Frees the tool slot and memory taken by _admit and retries the commands put aside"""
+        with self._lock:
+            self._toolRunning[tool] -= 1
+            self._numRunning        -= 1
+            self._memoryInUse       -= memory
+            waiting       = self._waiting
+            self._waiting = []
+        for job in waiting:
+            self._enqueue(job)
+
+    def _execute(self, result, echoCmd, suppressOutput=True):
+        """Runs the command, copying output to the log file and keeping the tail"""
+        if echoCmd:
+            print result.cmd
+        logFile = None
+        if result.logPath:
+            logFile = open(result.logPath, 'w')
+        tail = collections.deque(maxlen=self.tailLines)
+        import IrgTraceFunctions # Imported here, IrgTraceFunctions imports this module
+        startTime = time.time()
+        p = None
+        try:
+            with self._lock:
+                if self._cancelled:
+                    raise Exception('The runner was cancelled')
+                p = subprocess.Popen(result.cmd, shell=not isNotString(result.cmd), preexec_fn=os.setsid,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                self._processes.add(p)
+            for line in iter(p.stdout.readline, ''):
+                tail.append(line.rstrip('\n'))
+                if logFile:
+                    logFile.write(line)
+                    logFile.flush()
+                if not suppressOutput:
+                    sys.stdout.write(line)
+            if IrgTraceFunctions.isTracingEnabled():
+                result.returnCode = IrgTraceFunctions.waitForTracedProcess(p, result.cmd, startTime)
+            else:
+                result.returnCode = p.wait()
+        finally:
+            with self._lock:
+                self._processes.discard(p)
+            result.wallTime = time.time() - startTime
+            result.tail     = list(tail)
+            if logFile:
+                logFile.close()
+
+    def getNumUnfinished(self):
+        """Returns the number of submitted commands which have not finished"""
+        with self._lock:
+            return len([f for f in self._futures if not f.done()])
+
+    def cancel(self):
+        """Skips all commands which have not started and kills the running ones,
+           along with everything they started"""
+        with self._lock:
+            self._cancelled = True
+            waiting       = self._waiting
+            self._waiting = []
+            for p in self._processes:
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError: # Already finished
+                    pass
+        for job in waiting: # The workers skip them
+            self._enqueue(job)
+
+    def waitAll(self):
+        """Waits for every submitted command and returns their results in submission order"""
+        with self._lock:
+            futures = list(self._futures)
+        return [f.result() for f in futures]
+
+
+def runCommandsInParallel(cmdList, maxProcesses=None, toolLimits={}, logFolder=None):
+    """Runs independent commands concurrently and returns a list of CommandResults"""
+
+    runner = CommandRunner(maxProcesses, toolLimits, logFolder)
+    for cmd in cmdList:
+        runner.submit(cmd)
+    return runner.waitAll()
+
+
+def checkCommandResults(results):
+    """Raises an exception describing the first command that did not succeed"""
+    for result in results:
+        if not result.succeeded():
+            raise Exception('Command failed (' + str(result.returnCode) + '): ' + str(result.cmd)
+                            + '\n' + '\n'.join(result.tail))
 
 
 #==================================================
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+"""IrgTraceFunctions.py - Records the resources used by each external tool call"""
+
+import sys, os, time, json, socket, fcntl, errno, subprocess, collections
+
+import IrgSystemFunctions
+
+# Tracing is turned on by setting IRG_TRACE_FILE.  Both variables are inherited by
+#  spawned scripts so their tool calls end up in the same trace.
+TRACE_FILE_ENV  = 'IRG_TRACE_FILE'
+TRACE_STAGE_ENV = 'IRG_TRACE_STAGE'
+
+
+def getTraceFile():
+    """Returns the path of the trace file, or None if tracing is off"""
+    return os.environ.get(TRACE_FILE_ENV) or None
+
+def setTraceFile(tracePath):
+    """Turns on tracing to a JSONL file, None turns it off"""
+    if tracePath:
+        os.environ[TRACE_FILE_ENV] = os.path.abspath(tracePath)
+    else:
+        os.environ.pop(TRACE_FILE_ENV, None)
+
+def isTracingEnabled():
+    return (getTraceFile() is not None)
+
+def getTraceStage():
+    """Returns the name of the processing stage recorded with each command"""
+    return os.environ.get(TRACE_STAGE_ENV, '')
+
+def setTraceStage(stage):
+    """Sets the processing stage recorded with the following commands"""
+    os.environ[TRACE_STAGE_ENV] = stage
+
+
+def readProcIo(pid):
+    """Returns the counters in /proc/<pid>/io as a dictionary, or None if they are not available"""
+    try:
+        f = open('/proc/' + str(pid) + '/io', 'r')
+        text = f.read()
+        f.close()
+    except IOError:
+        return None
+    counters = {}
+    for line in text.splitlines():
+        (name, sep, value) = line.partition(':')
+        if sep:
+            counters[name.strip()] = int(value)
+    return counters
+
+
+def waitForTracedProcess(p, cmd, startTime):
+    """Waits for a subprocess.Popen object and writes its trace record, returns the exit code.
+       The IO counters can only be read until the process is reaped so they are sampled while waiting."""
+
+    io = None
+    while True:
+        io = readProcIo(p.pid) or io
+        try:
+            (pid, status, rusage) = os.wait4(p.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid != 0:
+            break
+        # Check less often for long running tools while keeping the error in the end time small
+        time.sleep(min(max(0.01, (time.time() - startTime) * 0.05), 0.5))
+    endTime = time.time()
+
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+
+    record = {'cmd'        : IrgSystemFunctions.argListToString(cmd).strip()
+                             if IrgSystemFunctions.isNotString(cmd) else cmd,
+              'tool'       : IrgSystemFunctions.getToolName(cmd),
+              'stage'      : getTraceStage(),
+              'host'       : socket.gethostname(),
+              'pid'        : p.pid,
+              'start'      : startTime,
+              'end'        : endTime,
+              'wall'       : endTime - startTime,
+              'user'       : rusage.ru_utime,
+              'sys'        : rusage.ru_stime,
+              'max_rss_kb' : rusage.ru_maxrss,
+              'read_bytes' : None,
+              'write_bytes': None,
+              'return_code': p.returncode}
+    if io:
+        record['read_bytes']  = io.get('read_bytes')
+        record['write_bytes'] = io.get('write_bytes')
+    writeTraceRecord(record)
+    return p.returncode
+
+
+def writeTraceRecord(record):
+    """Appends one record to the trace file, the lock lets many processes share the file"""
+    tracePath = getTraceFile()
+    if not tracePath:
+        return
+    f = open(tracePath, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def callTraced(cmd, stdout=None, stderr=None):
+    """Like subprocess.call but writes a trace record.  String commands go through the shell."""
+    startTime = time.time()
+    p = subprocess.Popen(cmd, shell=not IrgSystemFunctions.isNotString(cmd), stdout=stdout, stderr=stderr)
+    return waitForTracedProcess(p, cmd, startTime)
+
+
+#==================================================
+# Reading trace files
+
+def loadTrace(tracePath):
+    """Reads all the records in a trace file"""
+    records = []
+    f = open(tracePath, 'r')
+    for line in f:
+        line = line.strip()
+        if line:
+            records.append(json.loads(line))
+    f.close()
+    return records
+
+def summarizeTrace(records, key):
+    """Totals the records grouped by one of their fields, such as 'tool' or 'stage'.
+       Returns a list of (name, summary dictionary) sorted by total wall time."""
+
+    summaries = collections.OrderedDict()
+    for record in records:
+        name = record.get(key) or '(none)'
+        if name not in summaries:
+            summaries[name] = {'count': 0, 'failures': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_kb': 0,
+                               'read_bytes': 0, 'write_bytes': 0}
+        s = summaries[name]
+        s['count']      += 1
+        s['wall']       += record['wall']
+        s['cpu']        += record['user'] + record['sys']
+        s['max_rss_kb']  = max(s['max_rss_kb'], record['max_rss_kb'])
+        s['read_bytes'] += record['read_bytes']  or 0
+        s['write_bytes']+= record['write_bytes'] or 0
+        if record['return_code'] != 0:
+            s['failures'] += 1
+    return sorted(summaries.items(), key=lambda item: -item[1]['wall'])
+
+def getToolMemoryEstimates(records, margin=1.2):
+    """Returns a dictionary of tool name -> expected peak memory in bytes, from the largest
+       peak of the successful runs of each tool in a trace.  Use with a CommandRunner."""
+    estimates = {}
+    for record in records:
+        if record['return_code'] != 0:
+            continue
+        peak = int(record['max_rss_kb'] * 1024 * margin)
+        estimates[record['tool']] = max(estimates.get(record['tool'], 0), peak)
+    return estimates
+
+def fitToolCost(records, tool, getWorkSize, minSamples=3):
+    """Fits wall time = fixed + perUnit * work size to the successful runs of a tool in a trace.
+       getWorkSize(record) returns the amount of work done by a call or None to skip it.
+       Returns (fixedSeconds, secondsPerUnit, numSamples) or None if there is not enough data."""
+
+    samples = []
+    for record in records:
+        if (record['tool'] != tool) or (record['return_code'] != 0):
+            continue
+        size = getWorkSize(record)
+        if size:
+            samples.append((float(size), record['wall']))
+    if len(samples) < minSamples:
+        return None
+
+    # Least squares line through the samples
+    n     = float(len(samples))
+    meanX = sum([s[0] for s in samples]) / n
+    meanY = sum([s[1] for s in samples]) / n
+    varX  = sum([(s[0] - meanX)**2 for s in samples])
+    if varX <= 0: # All calls did the same amount of work, the fixed cost can't be separated
+        return None
+    perUnit = sum([(s[0] - meanX) * (s[1] - meanY) for s in samples]) / varX
+    if perUnit <= 0:
+        return None
+    fixed = max(0.0, meanY - perUnit * meanX)
+    return (fixed, perUnit, len(samples))
+
+def getChromeTraceEvents(records):
+    """Converts trace records to the Chrome trace event format, with one row per host and process"""
+
+    hostIds = {}
+    events  = []
+    for record in records:
+        host = record['host']
+        if host not in hostIds:
+            hostIds[host] = len(hostIds) + 1
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': hostIds[host],
+                           'args': {'name': host}})
+        args = dict((k, record[k]) for k in ['cmd', 'user', 'sys', 'max_rss_kb',
+                                             'read_bytes', 'write_bytes', 'return_code'])
+        events.append({'name': record['tool'],
+                       'cat' : record['stage'] or 'none',
+                       'ph'  : 'X',
+                       'ts'  : record['start'] * 1000000.0,
+                       'dur' : record['wall']  * 1000000.0,
+                       'pid' : hostIds[host],
+                       'tid' : record['pid'],
+                       'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+import sys, os, optparse, time
+
+import IrgGeoFunctions, IrgGdalFunctions, IrgCacheFunctions
+
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Measures the per-file latency of reading image metadata with each backend.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def timeBackend(backend, imagePaths, numIterations, getStats):
+    """Returns the mean time in seconds of getImageGeoInfo for each image"""
+
+    IrgGdalFunctions.setMetadataBackend(backend)
+
+    times = []
+    for path in imagePaths:
+        startTime = time.time()
+        for i in range(0, numIterations):
+            IrgGeoFunctions.getImageGeoInfo(path, getStats)
+        times.append((time.time() - startTime) / numIterations)
+    return times
+
+
+def main(argsIn):
+
+    try:
+        usage = 'usage: benchmarkGeoInfo.py [options] <image> [<image> ...]'
+        parser = optparse.OptionParser(usage=usage)
+
+        parser.add_option('--iterations', dest='numIterations', default=5, type='int',
+                          help='Number of times to read the metadata of each file.')
+        parser.add_option('--stats', action='store_true', default=False, dest='getStats',
+                          help='Also request statistics from getImageGeoInfo.')
+        parser.add_option("--manual", action="callback", callback=man,
+                          help="Read the manual.")
+
+        (options, args) = parser.parse_args(argsIn)
+
+        if len(args) < 1:
+            print usage
+            return 0
+
+    except optparse.OptionError, msg:
+        raise Usage(msg)
+
+    # Time the actual reads, not the cached results
+    IrgCacheFunctions.setCacheEnabled(False)
+
+    # Only compare against the in-process backend if we have it
+    backends = ['gdalinfo']
+    if IrgGdalFunctions.haveGdalBindings():
+        backends.append('gdal')
+    else:
+        print 'GDAL python bindings not found, only timing the gdalinfo backend.'
+
+    results = {}
+    for backend in backends:
+        results[backend] = timeBackend(backend, args, options.numIterations, options.getStats)
+
+    # Print one line per file with the latency of each backend in milliseconds
+    print 'File' + ''.join(['\t' + b + ' (ms)' for b in backends])
+    for i in range(0, len(args)):
+        line = os.path.basename(args[i])
+        for backend in backends:
+            line += '\t%.3f' % (results[backend][i] * 1000.0)
+        print line
+
+    for backend in backends:
+        meanTime = sum(results[backend]) / len(results[backend])
+        print 'Mean latency for ' + backend + ': %.3f ms' % (meanTime * 1000.0)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+import sys, os, optparse, time, subprocess
+
+import IrgFileFunctions, IrgGdalFunctions
+
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Compares the end-to-end time and output size of the parallel_mapproject.py output modes.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+# Name -> parallel_mapproject.py arguments for each output mode
+# - original is the path before the mosaic changes: every tile is computed, then gdalbuildvrt
+#   and a single threaded, untiled gdal_translate rewrite.  The other modes are compared to it.
+MOSAIC_MODES = [('original',     ['--legacy-mosaic', '--no-tile-culling']),
+                ('vrt-gtiff',    ['--vrt-mosaic']),
+                ('stream-gtiff', []),
+                ('vrt-cog',      ['--vrt-mosaic', '--output-format', 'cog']),
+                ('stream-cog',   ['--output-format', 'cog'])]
+
+
+def countOverviews(imagePath):
+    """Returns the number of overview levels of the first band of an image"""
+    for line in IrgGdalFunctions.callGdalInfo(imagePath).split('\n'):
+        if line.strip().startswith('Overviews:'):
+            return len(line.split(':', 1)[1].split(','))
+    return 0
+
+def runMode(name, modeArgs, demPath, imagePath, outputFolder, extraArgs):
+    """Runs parallel_mapproject.py once, returns (seconds, output size in bytes, number of overviews)"""
+
+    outputPath = os.path.join(outputFolder, name + '.tif')
+    IrgFileFunctions.removeIfExists(outputPath)
+    scriptPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parallel_mapproject.py')
+    # Without --force-tiles non-ISIS inputs on one machine skip the tiles and the mosaic entirely
+    cmd = ([sys.executable, scriptPath, '--suppress-output', '--force-tiles'] + modeArgs + extraArgs
+           + [demPath, imagePath, outputPath])
+    print ' '.join(cmd)
+
+    startTime = time.time()
+    if subprocess.call(cmd) != 0:
+        raise Exception('parallel_mapproject.py failed in mode ' + name)
+    seconds = time.time() - startTime
+    if not os.path.exists(outputPath):
+        raise Exception('parallel_mapproject.py did not write ' + outputPath)
+    return (seconds, os.path.getsize(outputPath), countOverviews(outputPath))
+
+
+def main(argsIn):
+
+    try:
+        usage = 'usage: benchmarkMosaic.py [options] <dem> <camera-image> <output folder> [-- <parallel_mapproject options>]'
+        parser = optparse.OptionParser(usage=usage)
+
+        parser.add_option('--modes', dest='modes', default=','.join([m[0] for m in MOSAIC_MODES]),
+                          help='Comma separated list of the modes to run, from ' +
+                               ', '.join([m[0] for m in MOSAIC_MODES]) + '.')
+        parser.add_option('--iterations', dest='numIterations', default=1, type='int',
+                          help='Number of times to run each mode, the fastest run is reported.')
+        parser.add_option("--manual", action="callback", callback=man,
+                          help="Read the manual.")
+
+        (options, args) = parser.parse_args(argsIn)
+
+        if len(args) < 3:
+            print usage
+            return 0
+
+    except optparse.OptionError, msg:
+        raise Usage(msg)
+
+    (demPath, imagePath, outputFolder) = args[0:3]
+    extraArgs = args[3:]
+    IrgFileFunctions.createFolder(outputFolder)
+
+    modeArgs = dict(MOSAIC_MODES)
+    modes    = options.modes.split(',')
+    for name in modes:
+        if name not in modeArgs:
+            raise Exception('Unknown mode: ' + name)
+
+    results = {}
+    for name in modes:
+        runs = [runMode(name, modeArgs[name], demPath, imagePath, outputFolder, extraArgs)
+                for i in range(0, options.numIterations)]
+        results[name] = min(runs)
+
+    # Print one line per mode, relative to the first one
+    (baseSeconds, baseSize, baseOverviews) = results[modes[0]]
+    print 'Mode\tTime (s)\tSize (MB)\tOverviews\tTime vs ' + modes[0] + '\tSize vs ' + modes[0]
+    for name in modes:
+        (seconds, size, numOverviews) = results[name]
+        print ('%s\t%.2f\t%.2f\t%d\t%.2fx\t%.2fx'
+               % (name, seconds, size / 1024.0**2, numOverviews, seconds / baseSeconds, size / float(max(baseSize, 1))))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+import sys, os, optparse, time
+
+import IrgCatalogFunctions
+
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Builds or updates a footprint catalog of all the images in a folder tree,
+then optionally finds the images overlapping a region or each other.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def main(argsIn):
+
+    try:
+        usage = 'usage: buildFootprintCatalog.py [options] <input folder> <catalog path>'
+        parser = optparse.OptionParser(usage=usage)
+
+        parser.add_option('--num-processes', dest='numProcesses', default=None, type='int',
+                          help='Number of processes used to compute footprints.')
+        parser.add_option('--region', dest='region', default=None, type='float', nargs=4,
+                          help='Print the images overlapping this region: minLon maxLon minLat maxLat')
+        parser.add_option('--pairs', dest='pairsPath', default=None,
+                          help='Write all pairs of overlapping images to this file.')
+        parser.add_option("--manual", action="callback", callback=man,
+                          help="Read the manual.")
+
+        (options, args) = parser.parse_args(argsIn)
+
+        if len(args) < 2:
+            print usage
+            return 0
+
+        inputFolder = args[0]
+        catalogPath = args[1]
+
+    except optparse.OptionError, msg:
+        raise Usage(msg)
+
+    startTime = time.time()
+
+    catalog = IrgCatalogFunctions.buildFootprintCatalog(inputFolder, catalogPath, options.numProcesses)
+    print 'Catalog contains ' + str(len(catalog.entries)) + ' images.'
+
+    if options.region:
+        for path in catalog.queryRegion(options.region):
+            print path
+
+    if options.pairsPath:
+        pairs = catalog.findOverlappingPairs()
+        f = open(options.pairsPath, 'w')
+        for (a, b) in pairs:
+            f.write(a + '\t' + b + '\n')
+        f.close()
+        print 'Wrote ' + str(len(pairs)) + ' overlapping pairs to ' + options.pairsPath
+
+    endTime = time.time()
+    print "Finished in " + str(endTime - startTime) + " seconds."
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -18,8 +18,10 @@
 # __END_LICENSE__
 
 import sys
-import os, glob, re, shutil, subprocess, string, time, errno, optparse, math
-import IrgFileFunctions, IrgIsisFunctions, IrgPbsFunctions, IrgSystemFunctions
+import os, glob, re, shutil, subprocess, string, time, errno, optparse, math, copy, tempfile, json, threading
+import multiprocessing.pool, signal
+import IrgFileFunctions, IrgGeoFunctions, IrgIsisFunctions, IrgPbsFunctions, IrgSystemFunctions, IrgTraceFunctions, IrgJournalFunctions, IrgMosaicFunctions
+import IrgCacheFunctions
 
 if sys.version_info < (2, 6, 0):
     print('\nERROR: Must use Python 2.6 or greater.')
@@ -117,112 +119,537 @@ def handleArguments(args):
     # Return the two lists
     return (requiredList, optionsList)
 
-def writeSingleTile(options):
-    """Writes a single tile according to the options"""
+# mapproject arguments which take four values instead of one
+FOUR_VALUE_ARGUMENTS = ['--t_projwin', '--t_pixelwin']
+
+def removeArguments(argList, names):
+    """Returns a copy of a mapproject argument list without the named options and their values"""
+    (requiredList, optionsList) = handleArguments(argList)
+    output = []
+    i = 0
+    while i < len(optionsList):
+        numValues = 0
+        if (i+1 < len(optionsList)) and not IrgSystemFunctions.isCmdOption(optionsList[i+1]):
+            numValues = 1
+            if optionsList[i] in FOUR_VALUE_ARGUMENTS:
+                numValues = 4
+        if optionsList[i] not in names:
+            output += optionsList[i:i+1+numValues]
+        i += 1 + numValues
+    return output
+
+# Size in pixels of the long side of the low resolution footprint image
+FOOTPRINT_SIZE = 512
+
+def getProjectedBoundingBox(projectionInfo):
+    """Returns (minX, minY, maxX, maxY) of the output in projected units from the
+       mapproject --query-projection output, or None if it is not listed"""
+    match = re.search('Projected space bounding box:\s*\(Origin:\s*\(([^,]+),\s*([^)]+)\)\s*' +
+                      'width:\s*([^\s]+)\s*height:\s*([^)\s]+)\)', projectionInfo)
+    if not match:
+        return None
+    (x, y, width, height) = [float(v) for v in match.groups()]
+    return (x, y, x + width, y + height)
+
+def getTileFootprint(options, projectedBox, fullWidth, fullHeight, tempFolder):
+    """Projects the image once at low resolution to find where the output has data.
+       Returns (mask, factor) where mask[row][col] covers factor by factor output pixels,
+       or None if the footprint could not be computed."""
+
+    factor = int(math.ceil(max(fullWidth, fullHeight) / float(FOOTPRINT_SIZE)))
+    if (projectedBox is None) or (factor < 2):
+        return None
+    resolution = (projectedBox[2] - projectedBox[0]) / fullWidth
+
+    # Reuse the footprint of an interrupted run
+    footprintPath = os.path.join(tempFolder, 'footprint.tif')
+    if not os.path.exists(footprintPath):
+        cmd = ['mapproject', '--tr', repr(resolution * factor),
+               '--t_projwin', repr(projectedBox[0]), repr(projectedBox[1]), repr(projectedBox[2]), repr(projectedBox[3]),
+               options.demPath, options.imagePath, footprintPath]
+        cmd = cmd + removeArguments(options.extraArgs, ['--tr', '--mpp', '--ppd', '--t_projwin', '--t_pixelwin'])
+        if IrgSystemFunctions.executeCommand(cmd, options.suppressOutput) != 0:
+            IrgFileFunctions.removeIfExists(footprintPath)
+            return None
+
+    try:
+        mask = IrgGeoFunctions.readValidPixelMask(footprintPath)
+    except Exception, e:
+        print 'Could not read the image footprint: ' + str(e)
+        return None
+    if not any([any(row) for row in mask]): # Something went wrong, it is safer to compute every tile
+        return None
+    return (mask, factor)
+
+def cullTiles(tileList, mask, factor):
+    """Returns the tiles which overlap valid pixels of a footprint mask from getTileFootprint.
+       A margin of one footprint pixel allows for the coarser pixel grid."""
+
+    numRows = len(mask)
+    numCols = len(mask[0])
+    keptTiles = []
+    for tile in tileList:
+        colStart = max(0,       tile[0] // factor - 1)
+        rowStart = max(0,       tile[1] // factor - 1)
+        colStop  = min(numCols, (tile[2] + factor - 1) // factor + 1)
+        rowStop  = min(numRows, (tile[3] + factor - 1) // factor + 1)
+        if any([any(mask[r][colStart:colStop]) for r in range(rowStart, rowStop)]):
+            keptTiles.append(tile)
+    return keptTiles
+
+def getMosaicExtent(tilePath, tile, fullWidth, fullHeight):
+    """Returns the (minX, minY, maxX, maxY) projected extent of the full output from one finished tile"""
+    geoInfo = IrgGeoFunctions.getImageGeoInfo(tilePath, False)
+    (pixelSizeX, pixelSizeY) = geoInfo['pixel_size']
+    originX = geoInfo['origin'][0] - tile[0] * pixelSizeX
+    originY = geoInfo['origin'][1] - tile[1] * pixelSizeY
+    return (originX, originY + fullHeight * pixelSizeY, originX + fullWidth * pixelSizeX, originY)
+
+class MosaicStreamer(threading.Thread):
+    """Watches the journal and adds each tile to a StreamingMosaicWriter as soon as it is finished.
+       Tiles which finish at the same time are added on several threads."""
+
+    def __init__(self, writer, journalPath, tileList, tileHashes, tempFolder, pollSeconds=1.0, numThreads=4):
+        threading.Thread.__init__(self)
+        self.daemon      = True
+        self.writer      = writer
+        self.journal     = IrgJournalFunctions.TaskJournal(journalPath, readExisting=False) # Our own copy
+        self.tileList    = tileList
+        self.tileHashes  = tileHashes
+        self.tempFolder  = tempFolder
+        self.pollSeconds = pollSeconds
+        self.numThreads  = numThreads
+        self.added       = set()
+        self.error       = None
+        self._stopEvent  = threading.Event()
+
+    def _addFinishedTiles(self, pool):
+        self.journal.reload()
+        newTiles = []
+        for (tile, tileHash) in zip(self.tileList, self.tileHashes):
+            tilePath = os.path.join(self.tempFolder, tile[4])
+            if (tile[4] not in self.added) and self.journal.isComplete(tile[4], tileHash, tilePath):
+                newTiles.append((tilePath, tile))
+        pool.map(lambda item: self.writer.addTile(item[0], item[1][0], item[1][1]), newTiles)
+        self.added.update([tile[4] for (tilePath, tile) in newTiles])
+
+    def run(self):
+        pool = multiprocessing.pool.ThreadPool(self.numThreads)
+        try:
+            while True:
+                stopping = self._stopEvent.is_set()
+                self._addFinishedTiles(pool)
+                if stopping:
+                    return
+                self._stopEvent.wait(self.pollSeconds)
+        except Exception, e:
+            self.error = e
+        finally:
+            pool.close()
+            pool.join()
+
+    def finish(self):
+        """Adds the remaining finished tiles and waits for the thread, returns the number of tiles added"""
+        self._stopEvent.set()
+        self.join()
+        if self.error:
+            raise self.error
+        return len(self.added)
+
+# The journal in the work directory records which tiles are finished
+JOURNAL_NAME = 'journal.jsonl'
+
+def getTileHash(options, tile):
+    """Returns a hash of everything that determines the contents of a tile"""
+    return IrgJournalFunctions.getTaskHash([IrgJournalFunctions.getInputFileStamp(options.demPath),
+                                            IrgJournalFunctions.getInputFileStamp(options.imagePath),
+                                            tile[0:4], options.extraArgs, bool(options.convertTiles)])
+
+def writeSingleTile(options, runCommand=None):
+    """Writes a single tile according to the options.
+       runCommand(cmd) is used to call the tools if provided, it must return the exit code."""
+
+    if runCommand is None:
+        runCommand = lambda cmd: IrgSystemFunctions.executeCommand(cmd, options.suppressOutput)
 
     # Determine the name of the tile we need to write
     tileName = generateTileName(options.pixelStartX, options.pixelStartY, options.pixelStopX, options.pixelStopY)
     tilePath = os.path.join(options.workDir, tileName)
        
+    # Write to a temporary file and rename it when finished, this way a tile can safely
+    #  be run twice at the same time and an interrupted call never leaves a partial tile.
+    # - A resident tile worker can run two copies of a tile itself so the process ID is not enough.
+    (handle, partPath) = tempfile.mkstemp(suffix='.part.tif', prefix=os.path.splitext(tileName)[0] + '.',
+                                          dir=options.workDir)
+    os.close(handle)
+       
     # Just call the command for a single tile!
     cmd = ['mapproject',  '--t_pixelwin', str(options.pixelStartX), str(options.pixelStartY), str(options.pixelStopX), str(options.pixelStopY),
-                               options.demPath, options.imagePath, tilePath]
+                               options.demPath, options.imagePath, partPath]
     cmd = cmd + options.extraArgs # Append other options
-    IrgSystemFunctions.executeCommand(cmd, options.suppressOutput)
+
+    journal = None
+    if options.taskHash:
+        journal = IrgJournalFunctions.TaskJournal(os.path.join(options.workDir, JOURNAL_NAME), readExisting=False)
+        journal.markStarted(tileName, options.taskHash, tilePath)
+
+    # The time spent in the tools is recorded so the overhead of each tile can be measured
+    # - The part file is also removed if this copy is stopped, e.g. as the loser of a speculative run.
+    toolStartTime = time.time()
+    try:
+        returnCode = runCommand(cmd)
+        if (returnCode == 0) and os.path.exists(partPath):
+            os.rename(partPath, tilePath)
+    finally:
+        IrgFileFunctions.removeIfExists(partPath)
       
-    if options.convertTiles: # Make uint8 version of the tile for debugging
+    if options.convertTiles and (returnCode == 0): # Make uint8 version of the tile for debugging
         
         tilePathU8 = os.path.splitext(tilePath)[0] + 'U8.tif'
         cmd = ['gdal_translate', '-ot', 'byte', '-scale', tilePath, tilePathU8]
-        IrgSystemFunctions.executeCommand(cmd, options.suppressOutput)
-
-    return 0
+        returnCode = runCommand(cmd)
+    toolSeconds = time.time() - toolStartTime
+
+    # A negative code means this copy was killed or cancelled, usually because a
+    #  duplicate copy of the tile finished first, so it must not touch the journal.
+    if journal and (returnCode >= 0):
+        if (returnCode == 0) and os.path.exists(tilePath):
+            journal.markDone(tileName, options.taskHash, tilePath, {'tool_seconds': toolSeconds})
+        else:
+            journal.markFailed(tileName, options.taskHash, tilePath)
+
+    return returnCode
+
+def createTaskHandler(argsIn):
+    """Called once by each resident tile worker (taskAgent.py --handler-module parallel_mapproject).
+       Returns a function which writes the tile described by one line of the argument file."""
+
+    options = parseArguments(argsIn)
+    if options.tracePath:
+        IrgTraceFunctions.setTraceFile(options.tracePath)
+
+    def handler(taskString, runCommand):
+        parts = taskString.split('\t')
+        tileOptions = copy.copy(options)
+        (tileOptions.pixelStartX, tileOptions.pixelStartY,
+         tileOptions.pixelStopX,  tileOptions.pixelStopY) = [int(p) for p in parts[0:4]]
+        tileOptions.taskHash = parts[4].strip()
+        return writeSingleTile(tileOptions, runCommand)
+    return handler
+
+def reportTileOverhead(jobLogPath, tileNames, journal, mode):
+    """Prints the time each tile spent outside of the tools, from the job log and the journal.
+       tileNames lists the tiles in the order they were written to the argument file."""
+
+    if not os.path.exists(jobLogPath):
+        return
+    overheads = []
+    for (seq, job) in IrgPbsFunctions.readJobLog(jobLogPath).items():
+        if (seq < 1) or (seq > len(tileNames)):
+            continue
+        record = journal.getRecord(tileNames[seq-1])
+        if (job['exitval'] == 0) and record and ('tool_seconds' in record):
+            overheads.append(max(0.0, job['runtime'] - record['tool_seconds']))
+    if not overheads:
+        return
+    overheads.sort()
+    print ('Per tile overhead with %s: median %.3f s, mean %.3f s, total %.1f s over %d tiles.'
+           % (mode, overheads[len(overheads)/2], sum(overheads) / len(overheads), sum(overheads), len(overheads)))
+
+# Parameters of the automatic tile size plan
+AUTO_MIN_TILE_SIZE       = 256
+AUTO_MAX_TILE_SIZE       = 8192
+AUTO_TILE_SIZE_STEP      = 256  # Keep tiles a multiple of the output block size
+AUTO_TILES_PER_PROCESS   = 4    # Enough tiles per process that slow tiles don't leave CPUs idle
+AUTO_MAX_OVERHEAD        = 0.10 # Largest share of a tile's time that may be fixed cost
+AUTO_BYTES_PER_PIXEL     = 32   # Rough memory per output pixel of a mapproject tile
+DEFAULT_TILE_FIXED_SECONDS     = 1.0 # Used without a trace, mapproject has to load the camera and DEM for each tile
+DEFAULT_SECONDS_PER_MEGAPIXEL  = 1.0
+PLAN_NAME = 'plan.json'
+
+def getTilePixels(record):
+    """Returns the number of pixels written by a traced mapproject tile call, or None"""
+    match = re.search('--t_pixelwin\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)', record['cmd'])
+    if not match:
+        return None
+    (x0, y0, x1, y1) = [int(v) for v in match.groups()]
+    return (x1 - x0) * (y1 - y0)
+
+def measureLaunchSeconds():
+    """Returns the time needed to start a copy of this script, the fixed cost of a spawned tile"""
+    scriptPath = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    devNull    = open(os.devnull, 'w')
+    startTime  = time.time()
+    subprocess.call([sys.executable, scriptPath, '--help'], stdout=devNull, stderr=devNull)
+    devNull.close()
+    return time.time() - startTime
+
+def getTileCostModel(options, reasons):
+    """Returns (fixed seconds per tile, seconds per pixel) for the tile calls, adding how they were found to reasons"""
+
+    model = None
+    if IrgTraceFunctions.isTracingEnabled() and os.path.exists(IrgTraceFunctions.getTraceFile()):
+        model = IrgTraceFunctions.fitToolCost(IrgTraceFunctions.loadTrace(IrgTraceFunctions.getTraceFile()),
+                                              'mapproject', getTilePixels)
+    if model:
+        (toolSeconds, secondsPerPixel, numSamples) = model
+        reasons.append('mapproject costs %.2f s per call plus %.2f s per megapixel (fit to %d traced tiles)'
+                       % (toolSeconds, secondsPerPixel * 1e6, numSamples))
+    else:
+        toolSeconds     = DEFAULT_TILE_FIXED_SECONDS
+        secondsPerPixel = DEFAULT_SECONDS_PER_MEGAPIXEL / 1e6
+        reasons.append('mapproject assumed to cost %.2f s per call plus %.2f s per megapixel '
+                       '(no traced tiles of different sizes, use --trace-file to measure it)'
+                       % (toolSeconds, secondsPerPixel * 1e6))
+
+    if options.tileWorkers:
+        launchSeconds = 0.0
+        reasons.append('tile workers are already running so starting a tile costs nothing extra')
+    else:
+        launchSeconds = measureLaunchSeconds()
+        reasons.append('starting parallel_mapproject.py for a tile takes %.2f s (measured)' % launchSeconds)
+
+    return (toolSeconds + launchSeconds, secondsPerPixel)
+
+def planTileSize(fullWidth, fullHeight, numProcesses, fixedSeconds, secondsPerPixel, memoryPerProcess, reasons):
+    """Returns the tile size which keeps all processes busy while keeping the fixed cost
+       of each tile small, adding the reasoning to reasons"""
+
+    # Small tiles balance the load, there should be several for each process
+    totalPixels = fullWidth * fullHeight
+    balanceSize = int(math.sqrt(totalPixels / float(numProcesses * AUTO_TILES_PER_PROCESS)))
+    reasons.append('%d tiles per process for %d processes means tiles of at most %d pixels'
+                   % (AUTO_TILES_PER_PROCESS, numProcesses, balanceSize))
+    tileSize = balanceSize
+
+    # Large tiles hide the fixed cost
+    overheadSize = int(math.ceil(math.sqrt(fixedSeconds * (1.0 - AUTO_MAX_OVERHEAD)
+                                           / (AUTO_MAX_OVERHEAD * secondsPerPixel))))
+    reasons.append('keeping the fixed cost of %.2f s under %d%% of each tile needs tiles of at least %d pixels'
+                   % (fixedSeconds, int(AUTO_MAX_OVERHEAD * 100), overheadSize))
+    if overheadSize > tileSize:
+        reasons.append('the fixed cost wins, using fewer tiles than the load balancing target')
+        tileSize = overheadSize
+
+    # Each process must be able to hold its tile
+    memorySize = int(math.sqrt(memoryPerProcess / float(AUTO_BYTES_PER_PIXEL)))
+    if memorySize < tileSize:
+        reasons.append('%d MB of memory per process limits tiles to %d pixels'
+                       % (memoryPerProcess / 1024**2, memorySize))
+        tileSize = memorySize
+
+    # Round to the block size and stay in a sane range
+    tileSize = int(round(tileSize / float(AUTO_TILE_SIZE_STEP))) * AUTO_TILE_SIZE_STEP
+    tileSize = min(max(tileSize, AUTO_MIN_TILE_SIZE), AUTO_MAX_TILE_SIZE)
+    tileSize = min(tileSize, int(math.ceil(max(fullWidth, fullHeight) / float(AUTO_TILE_SIZE_STEP))) * AUTO_TILE_SIZE_STEP)
+    return tileSize
+
+def loadTilePlan(planPath):
+    """Returns the tile size saved by an earlier run, None if there is no plan"""
+    if not os.path.exists(planPath):
+        return None
+    f = open(planPath, 'r')
+    plan = json.load(f)
+    f.close()
+    return plan['tile_size']
+
+def saveTilePlan(planPath, tileSize, reasons):
+    """Saves the tile size so that a rerun computes the same tiles"""
+    f = open(planPath, 'w')
+    json.dump({'tile_size': tileSize, 'reasons': reasons}, f)
+    f.close()
 
 #------------------------------------------------------------------------------
 
-def main(argsIn):
+def parseArguments(argsIn):
+    """Parses the command line, the parallel_mapproject options and the forwarded mapproject options"""
 
-    try:
-        usage      = "usage: parallel_mapproject.py [options] <dem> <camera-image> <output>"
-        epilogText = "This also accepts all 'mapproject' arguments though the 'threads' argument will typically be ignored."
-        parser     = IrgSystemFunctions.PassThroughOptionParser(usage=usage, epilog=epilogText) # Use parser that ignores unknown options
+    usage      = "usage: parallel_mapproject.py [options] <dem> <camera-image> <output>"
+    epilogText = "This also accepts all 'mapproject' arguments though the 'threads' argument will typically be ignored."
+    parser     = IrgSystemFunctions.PassThroughOptionParser(usage=usage, epilog=epilogText) # Use parser that ignores unknown options
 
 
-        parser.add_option("--num-processes",  dest="numProcesses", type='int', default=None,
-                                              help="Number of processes to use (default program tries to choose best)")
+    parser.add_option("--num-processes",  dest="numProcesses", type='int', default=None,
+                                          help="Number of processes to use (default program tries to choose best)")
 
-        parser.add_option('--nodes-list',  dest='nodesListPath', default=None,
-                                           help='The list of computing nodes, one per line. ' + \
-                                                'If not provided, run on the local machine.')
+    parser.add_option('--nodes-list',  dest='nodesListPath', default=None,
+                                       help='The list of computing nodes, one per line. ' + \
+                                            'If not provided, run on the local machine.')
 
-        parser.add_option('--tile-size',  dest='tileSize', default=1000, type='int',
-                                           help='Size of square tiles to break up processing in to.')
+    parser.add_option('--tile-size',  dest='tileSize', default='1000',
+                                       help='Size of square tiles to break up processing in to. ' + \
+                                            'Use "auto" to choose the tile size from the image size, the CPUs and ' + \
+                                            'memory and the measured cost of a tile.')
 
 
-        # Directory where the job is running
-        parser.add_option('--work-dir',  dest='workDir', default=None,
-                                         help='Working directory to assemble the tiles in')
+    # Directory where the job is running
+    parser.add_option('--work-dir',  dest='workDir', default=None,
+                                     help='Working directory to assemble the tiles in')
 
-        parser.add_option("--suppress-output", action="store_true", default=False,
-                                               dest="suppressOutput",  help="Suppress output of sub-calls.")
+    parser.add_option("--suppress-output", action="store_true", default=False,
+                                           dest="suppressOutput",  help="Suppress output of sub-calls.")
 
-        parser.add_option("--manual", action="callback", callback=man,
-                                       help="Read the manual.")
-               
-        # DEBUG options
-        parser.add_option("--keep", action="store_true", dest="keep", default=False,
-                                    help="Do not delete the temporary files.")
-        parser.add_option("--convert-tiles",  action="store_true", dest="convertTiles",
-                                              help="Generate a uint8 version of each tile")
+    parser.add_option('--python-executor', action='store_true', default=False, dest='pythonExecutor',
+                                           help='Distribute the tiles with the built in task executor instead of GNU parallel. ' + \
+                                                'It also runs a second copy of tiles that take much longer than the others.')
 
+    parser.add_option('--tile-workers', action='store_true', default=False, dest='tileWorkers',
+                                        help='Process the tiles in one resident worker per node instead of starting ' + \
+                                             'parallel_mapproject.py for every tile. Uses the built in task executor.')
+
+    parser.add_option('--tile-memory',  dest='tileMemory', default=None, type='float',
+                                       help='Expected peak memory of one tile in MB, limits the number of processes per node. ' + \
+                                            'Defaults to the largest mapproject call seen in the trace file, if there is one.')
+
+    parser.add_option('--no-tile-culling', action='store_false', default=True, dest='cullTiles',
+                                           help='Compute every tile, even the ones outside the image footprint.')
+
+    parser.add_option('--vrt-mosaic', action='store_true', default=False, dest='vrtMosaic',
+                                      help='Build the output with gdalbuildvrt and gdal_translate after all tiles are ' + \
+                                           'finished instead of writing each tile into it as soon as it is done.')
+
+    parser.add_option('--legacy-mosaic', action='store_true', default=False, dest='legacyMosaic',
+                                         help='Build the output like earlier versions did, with gdalbuildvrt and a ' + \
+                                              'single threaded, untiled gdal_translate rewrite.  Used for benchmarks.')
+
+    parser.add_option('--force-tiles', action='store_true', default=False, dest='forceTiles',
+                                       help='Split the work into tiles even when a single mapproject call could be used.')
+
+    parser.add_option('--output-format', dest='outputFormat', default='gtiff', type='choice', choices=['gtiff', 'cog'],
+                                         help='Write a tiled BigTIFF (gtiff) or a cloud optimized GeoTIFF with ' + \
+                                              'internal overviews (cog).')
+
+    parser.add_option('--compress', dest='compression', default=None,
+                                    help='GDAL compression of the output, default LZW for gtiff and DEFLATE for cog.')
+
+    parser.add_option('--predictor', dest='predictor', default=None, type='choice', choices=['1', '2', '3'],
+                                     help='TIFF predictor of the output: 1 = none, 2 = horizontal differencing, ' + \
+                                          '3 = floating point.  Chosen from the data type for cog.')
+
+    parser.add_option('--trace-file',  dest='tracePath', default=None,
+                                       help='Append a record of the resources used by each tool call to this JSONL file.')
+
+    parser.add_option("--manual", action="callback", callback=man,
+                                   help="Read the manual.")
+           
+    # DEBUG options
+    parser.add_option("--keep", action="store_true", dest="keep", default=False,
+                                help="Do not delete the temporary files.")
+    parser.add_option("--convert-tiles",  action="store_true", dest="convertTiles",
+                                          help="Generate a uint8 version of each tile")
 
 
-        ## Debug options
-        #p.add_option('--dry-run',   dest='dryrun', default=False, action='store_true',
-        #                            help=optparse.SUPPRESS_HELP)
-        #p.add_option('--verbose',   dest='verbose', default=False, action='store_true',
-        #                            help=optparse.SUPPRESS_HELP)        
-    
-    
-        # PRIVATE options
-        # These specify the tile location to request, bypassing the need to query mapproject.
-        parser.add_option('--pixelStartX', dest='pixelStartX', default=None, type='int',
-                                           help=optparse.SUPPRESS_HELP)
-        parser.add_option('--pixelStartY', dest='pixelStartY', default=None, type='int',
-                                           help=optparse.SUPPRESS_HELP)
-        parser.add_option('--pixelStopX',  dest='pixelStopX', default=None, type='int',
-                                           help=optparse.SUPPRESS_HELP)
-        parser.add_option('--pixelStopY',  dest='pixelStopY', default=None, type='int',
-                                           help=optparse.SUPPRESS_HELP)
 
+    ## Debug options
+    #p.add_option('--dry-run',   dest='dryrun', default=False, action='store_true',
+    #                            help=optparse.SUPPRESS_HELP)
+    #p.add_option('--verbose',   dest='verbose', default=False, action='store_true',
+    #                            help=optparse.SUPPRESS_HELP)        
 
 
-        # This call handles all the parallel_mapproject specific options.
-        (options, args) = parser.parse_args(argsIn)
+    # PRIVATE options
+    # These specify the tile location to request, bypassing the need to query mapproject.
+    parser.add_option('--pixelStartX', dest='pixelStartX', default=None, type='int',
+                                       help=optparse.SUPPRESS_HELP)
+    parser.add_option('--pixelStartY', dest='pixelStartY', default=None, type='int',
+                                       help=optparse.SUPPRESS_HELP)
+    parser.add_option('--pixelStopX',  dest='pixelStopX', default=None, type='int',
+                                       help=optparse.SUPPRESS_HELP)
+    parser.add_option('--pixelStopY',  dest='pixelStopY', default=None, type='int',
+                                       help=optparse.SUPPRESS_HELP)
+    parser.add_option('--task-hash',   dest='taskHash', default=None,
+                                       help=optparse.SUPPRESS_HELP)
 
-        # This will parse all the mapproject options.
-        requiredList, optionsList = handleArguments(args)
 
-        # Check the required positional arguments.
-        if len(requiredList) < 1:
-            parser.error("Need path to DEM")
-        if len(requiredList) < 2:
-            parser.error("Need path to input image")
-        if len(requiredList) < 3:
-            parser.error("Need output path")
 
-        # Make sure we have absolute paths here
-        options.demPath    = os.path.abspath(requiredList[0])
-        options.imagePath  = os.path.abspath(requiredList[1])
-        options.outputPath = os.path.abspath(requiredList[2])
+    # This call handles all the parallel_mapproject specific options.
+    (options, args) = parser.parse_args(argsIn)
 
-        # Any additional arguments need to be forwarded to the mapproject function
-        options.extraArgs = optionsList
+    # This will parse all the mapproject options.
+    requiredList, optionsList = handleArguments(args)
+
+    # Check the required positional arguments.
+    if len(requiredList) < 1:
+        parser.error("Need path to DEM")
+    if len(requiredList) < 2:
+        parser.error("Need path to input image")
+    if len(requiredList) < 3:
+        parser.error("Need output path")
+
+    if options.tileSize != 'auto':
+        try:
+            options.tileSize = int(options.tileSize)
+        except ValueError:
+            parser.error('--tile-size must be a number of pixels or "auto"')
+
+    # Make sure we have absolute paths here
+    options.demPath    = os.path.abspath(requiredList[0])
+    options.imagePath  = os.path.abspath(requiredList[1])
+    options.outputPath = os.path.abspath(requiredList[2])
+
+    if options.legacyMosaic:
+        if options.outputFormat != 'gtiff':
+            parser.error('--legacy-mosaic only writes gtiff output')
+        options.vrtMosaic = True
+
+    if not options.compression:
+        if options.outputFormat == 'cog':
+            options.compression = 'DEFLATE'
+        else:
+            options.compression = 'LZW'
+
+    # Any additional arguments need to be forwarded to the mapproject function
+    options.extraArgs = optionsList
+
+    return options
+
+
+def buildVrtMosaic(options, tempFolder, tileList, numCulled, fullWidth, fullHeight):
+    """Builds the output from all the finished tiles at once with gdalbuildvrt and gdal_translate"""
+
+    # Build a gdal VRT file which is composed of all the processed tiles
+    vrtPath = os.path.join(tempFolder, 'mosaic.vrt')
+    IrgTraceFunctions.setTraceStage('mosaic')
+    cmd = "gdalbuildvrt -resolution highest "
+    if numCulled > 0: # Make the mosaic cover the whole output even if tiles on the edge were culled
+        extent = getMosaicExtent(os.path.join(tempFolder, tileList[0][4]), tileList[0], fullWidth, fullHeight)
+        cmd += "-te %r %r %r %r " % extent
+    cmd += vrtPath + " " + tempFolder + "*_.tif";
+    print cmd
+    IrgTraceFunctions.callTraced(cmd)
+    
+    # Convert VRT file to final output file
+    # - The COG driver computes the overviews on all CPUs, they are built from the tiles through the VRT.
+    if options.legacyMosaic:
+        creationOptions = ['compress=lzw', 'bigtiff=yes']
+        cmd = "gdal_translate "
+    elif options.outputFormat == 'cog':
+        creationOptions = IrgMosaicFunctions.getCogCreationOptions(options.compression, options.predictor)
+        cmd = "gdal_translate -of COG --config GDAL_NUM_THREADS ALL_CPUS "
+    else:
+        creationOptions = ['compress=' + options.compression.lower(), 'bigtiff=yes', 'tiled=yes', 'num_threads=ALL_CPUS']
+        if options.predictor:
+            creationOptions.append('predictor=' + options.predictor)
+        cmd = "gdal_translate "
+    cmd += ''.join(['-co ' + o + ' ' for o in creationOptions]) + vrtPath + " " + options.outputPath
+    print cmd
+    IrgTraceFunctions.callTraced(cmd)
+    #IrgSystemFunctions.executeCommand(cmd, False, True)
+
+
+def main(argsIn):
+
+    try:
+        options = parseArguments(argsIn)
 
     except optparse.OptionError, msg:
         raise Usage(msg)
 
     startTime = time.time()
+
+    # Spawned copies inherit the trace file through the environment
+    if options.tracePath:
+        IrgTraceFunctions.setTraceFile(options.tracePath)
     
     # Determine if this is a main copy or a spawned copy
     spawnedCopy = ( (options.pixelStartX is not None) and (options.pixelStartY is not None) and
@@ -230,11 +657,15 @@ def main(argsIn):
     
     if spawnedCopy: # This copy was spawned to process a single tile
         
+        # The task agent stops a duplicate copy with SIGTERM, exit through the cleanup code
+        signal.signal(signal.SIGTERM, lambda signalNumber, frame: sys.exit(-signalNumber))
         return writeSingleTile(options) # Just call a function to handle this and then we are done!   
 
     # If the input image is NOT an ISIS image AND we are running on a single machine we can
     #  just use the multi-threading capability of the ordinary mapproject call.
-    if (not IrgIsisFunctions.isIsisFile(options.imagePath)) and (not options.nodesListPath):
+    # - A cloud optimized output always goes through the tiles.
+    if (not IrgIsisFunctions.isIsisFile(options.imagePath)) and (not options.nodesListPath) and \
+       (options.outputFormat == 'gtiff') and (not options.forceTiles):
         cmd = ['mapproject',  options.imagePath, options.demPath, options.outputPath]    
         cmd = cmd + options.extraArgs
         subprocess.call(cmd)
@@ -262,12 +693,6 @@ def main(argsIn):
     fullHeight  = int(projectionInfo[heightStart+8 : heightEnd])
     print 'Output image size is ' + str(fullWidth) + ' by ' + str(fullHeight) + ' pixels.'
 
-    # For now we just break up the image into a user-specified tile size (default 1000x1000)
-    numTilesX, numTilesY, tileList = generateTileList(fullWidth, fullHeight, options.tileSize)
-    numTiles = numTilesX * numTilesY
-
-    print 'Splitting into ' + str(numTilesX) + ' by ' + str(numTilesY) + ' tiles.'
-
     # Set up output folder
     outputFolder = os.path.dirname(options.outputPath)
     if outputFolder == '':
@@ -282,15 +707,10 @@ def main(argsIn):
         tempFolder = os.path.join(outputFolder, outputName.replace('.', '_') + '_tiles/')
     IrgFileFunctions.createFolder(tempFolder)
 
-    
-    # Generate a text file that contains the boundaries for each tile
-    argumentFilePath = os.path.join(tempFolder, 'argumentList.txt')
-    argumentFile     = file(argumentFilePath, 'w')
-    for tile in tileList:
-        argumentFile.write(str(tile[0]) + '\t' + str(tile[1]) + '\t' + str(tile[2]) + '\t' + str(tile[3]) + '\n')
-    argumentFile.close()
-    
+    # The tile processes and a rerun after a failure share the file query results
+    IrgCacheFunctions.setDefaultCacheDatabase(os.path.join(tempFolder, 'file_cache.sqlite'))
 
+    
     # Indicate to GNU Parallel that there are multiple tab-seperated variables in the text file we just wrote
     parallelArgs = ['--colsep', "\\t"]
 
@@ -298,62 +718,213 @@ def main(argsIn):
     # If using multiple computers, need to make sure the same program paths are available
     if options.nodesListPath:
         parallelArgs = parallelArgs + ['--env', 'PATH', '--env', 'PYTHONPATH', '--env', 'ISISROOT', '--env', 'ISIS3DATA']
+        if IrgTraceFunctions.isTracingEnabled():
+            parallelArgs = parallelArgs + ['--env', IrgTraceFunctions.TRACE_FILE_ENV, '--env', IrgTraceFunctions.TRACE_STAGE_ENV]
     
     # Get the number of available nodes and CPUs per node
     numNodes = IrgPbsFunctions.getNumNodesInList(options.nodesListPath)
     
     # We assume all machines have the same number of CPUs (cores)
+    # - This respects the CPUs granted to us by PBS, cpusets and cgroup quotas.
     cpusPerNode = IrgSystemFunctions.get_num_cpus()
     
-    # We don't actually know the best number here!
-    threadsPerCpu = 2
+    # Each tile is a single threaded mapproject call so there is one process per granted CPU.
+    # Running more than that only helps if the tools spend a lot of time waiting on IO.
+    threadsPerCpu = 1
     
     # Set the optimal number of processes if the user did not specify
     if not options.numProcesses:
         options.numProcesses = numNodes * cpusPerNode * threadsPerCpu
+
+    # numProcesses is the total over all nodes and is used to plan the tiles,
+    #  GNU parallel and the task executor are given the number of processes on each node.
+    processesPerNode = int(math.ceil(options.numProcesses / float(numNodes)))
+
+    # Don't run more tiles on each node than fit in its memory, if we know how much a tile needs
+    tileMemory = 0
+    if options.tileMemory:
+        tileMemory = int(options.tileMemory * 1024**2)
+    elif IrgTraceFunctions.isTracingEnabled() and os.path.exists(IrgTraceFunctions.getTraceFile()):
+        estimates  = IrgTraceFunctions.getToolMemoryEstimates(IrgTraceFunctions.loadTrace(IrgTraceFunctions.getTraceFile()))
+        tileMemory = estimates.get('mapproject', 0)
+    if tileMemory > 0:
+        tilesPerNode = max(1, IrgSystemFunctions.getAvailableMemory() // tileMemory)
+        if processesPerNode > tilesPerNode:
+            print 'Limiting to ' + str(tilesPerNode) + ' tiles per node to fit in memory.'
+            processesPerNode     = tilesPerNode
+            options.numProcesses = numNodes * tilesPerNode
         
+    # Pick the tile size, a rerun reuses the tile size of the run it continues so the finished tiles match
+    if options.tileSize == 'auto':
+        planPath = os.path.join(tempFolder, PLAN_NAME)
+        tileSize = loadTilePlan(planPath)
+        if tileSize:
+            print 'Using the tile size of ' + str(tileSize) + ' pixels planned by the earlier run.'
+        else:
+            availableMemory = IrgSystemFunctions.getAvailableMemory()
+            reasons = ['%d nodes with %d CPUs and %d MB of available memory each run %d processes'
+                       % (numNodes, cpusPerNode, availableMemory / 1024**2, options.numProcesses)]
+            (fixedSeconds, secondsPerPixel) = getTileCostModel(options, reasons)
+            tileSize = planTileSize(fullWidth, fullHeight, options.numProcesses, fixedSeconds, secondsPerPixel,
+                                    availableMemory * numNodes / options.numProcesses, reasons)
+            numPlanned = int(math.ceil(fullWidth / float(tileSize))) * int(math.ceil(fullHeight / float(tileSize)))
+            reasons.append('%d tiles of %d pixels, about %d%% of the time of a tile is fixed cost'
+                           % (numPlanned, tileSize,
+                              int(round(100 * fixedSeconds / (fixedSeconds + secondsPerPixel * tileSize**2)))))
+            print 'Tile plan:'
+            for reason in reasons:
+                print '  - ' + reason
+            saveTilePlan(planPath, tileSize, reasons)
+    else:
+        tileSize = options.tileSize
+
+    # Break up the image into square tiles
+    numTilesX, numTilesY, tileList = generateTileList(fullWidth, fullHeight, tileSize)
+    numTiles = numTilesX * numTilesY
+
+    print 'Splitting into ' + str(numTilesX) + ' by ' + str(numTilesY) + ' tiles.'
+
+    # Skip the tiles outside the footprint of the image, they are left as nodata in the output
+    numCulled   = 0
+    culledTiles = []
+    if options.cullTiles and (numTiles > 1):
+        IrgTraceFunctions.setTraceStage('footprint')
+        footprint = getTileFootprint(options, getProjectedBoundingBox(projectionInfo), fullWidth, fullHeight, tempFolder)
+        if footprint:
+            keptTiles   = cullTiles(tileList, footprint[0], footprint[1])
+            culledTiles = [tile for tile in tileList if tile not in keptTiles]
+            tileList    = keptTiles
+            numCulled   = numTiles - len(tileList)
+            numTiles  = len(tileList)
+            print 'Culled ' + str(numCulled) + ' tiles outside the image footprint, ' + str(numTiles) + ' tiles left.'
+        else:
+            print 'Could not compute the image footprint, no tiles were culled.'
+
+    # Tiles finished by an earlier run with the same inputs and options are not computed again
+    journal     = IrgJournalFunctions.TaskJournal(os.path.join(tempFolder, JOURNAL_NAME))
+    journal.compact()
+    tileHashes  = [getTileHash(options, tile) for tile in tileList]
+    tileNames   = [tile[4] for tile in tileList]
+    tileIsDone  = [journal.isComplete(name, h, os.path.join(tempFolder, name))
+                   for (name, h) in zip(tileNames, tileHashes)]
+    numTilesLeft = tileIsDone.count(False)
+    if numTilesLeft < numTiles:
+        print 'Resuming, ' + str(numTiles - numTilesLeft) + ' of ' + str(numTiles) + ' tiles are already finished.'
+
+    # Generate a text file that contains the boundaries and hash for each tile we still need
+    argumentFilePath = os.path.join(tempFolder, 'argumentList.txt')
+    argumentFile     = file(argumentFilePath, 'w')
+    for (tile, tileHash, isDone) in zip(tileList, tileHashes, tileIsDone):
+        if not isDone:
+            argumentFile.write(str(tile[0]) + '\t' + str(tile[1]) + '\t' + str(tile[2]) + '\t' + str(tile[3])
+                               + '\t' + tileHash + '\n')
+    argumentFile.close()
+    
+
     # Note: mapproject can run with multiple threads on non-ISIS data but we don't use that
     #       functionality here since we call mapproject with one tile at a time.
         
     # No need for more processes than their are tiles!
-    if options.numProcesses > numTiles:
-        options.numProcesses = numTiles
+    if options.numProcesses > numTilesLeft:
+        options.numProcesses = max(1, numTilesLeft)
+        processesPerNode     = min(processesPerNode, options.numProcesses)
     
+    # Arguments shared by the spawned copies and the resident tile workers
+    # - The output path used here does not matter since spawned copies compute the correct tile path.
+    baseArgs = ['--threads', '1', # Only use on thread internally, parallel will handle things.
+                '--work-dir', tempFolder,
+                options.demPath, options.imagePath, options.outputPath]
+    if options.convertTiles:
+        baseArgs = baseArgs + ['--convert-tiles']
+    if options.suppressOutput:
+        baseArgs = baseArgs + ['--suppress-output']
+    baseArgs = baseArgs + options.extraArgs # Append other options
+
     # Build the command line that will be passed to GNU parallel
     # - The numbers in braces will receive the values from the text file we wrote earlier
-    # - The output path used here does not matter since spawned copies compute the correct tile path.
     commandList   = ['parallel_mapproject.py',  '--pixelStartX', '{1}',
                                                 '--pixelStartY', '{2}',
                                                 '--pixelStopX',  '{3}',
                                                 '--pixelStopY',  '{4}',
-                                                '--threads', '1', # Only use on thread internally, parallel will handle things.
-                                                '--work-dir', tempFolder,
-                                                options.demPath, options.imagePath, options.outputPath]
-    if options.convertTiles:
-        commandList = commandList + ['--convert-tiles']
-    if options.suppressOutput:
-        commandList = commandList + ['--suppress-output']
-    commandList   = commandList + options.extraArgs # Append other options
+                                                '--task-hash',   '{5}'] + baseArgs
     commandString = IrgSystemFunctions.argListToString(commandList)
-   
+
+    # The job log has the run time of each tile, it is used to measure the overhead per tile
+    jobLogPath   = os.path.join(tempFolder, 'jobLog.txt')
+    parallelArgs = parallelArgs + ['--joblog', jobLogPath]
+    IrgFileFunctions.removeIfExists(jobLogPath)
     
     # Use GNU parallel call to distribute the work across computers
     # - This call will wait until all processes are finished
-    IrgPbsFunctions.runInGnuParallel(options.numProcesses, commandString, argumentFilePath, parallelArgs, options.nodesListPath, True)#not options.suppressOutput)
-
-
-    # Build a gdal VRT file which is composed of all the processed tiles
-    vrtPath = os.path.join(tempFolder, 'mosaic.vrt')
-    cmd = "gdalbuildvrt -resolution highest " + vrtPath + " " + tempFolder + "*_.tif";
-    print cmd
-    os.system(cmd)
-    
-    # Convert VRT file to final output file
-    cmd = "gdal_translate -co compress=lzw -co bigtiff=yes " + vrtPath + " " + options.outputPath;
-    print cmd
-    os.system(cmd)
-    #IrgSystemFunctions.executeCommand(cmd, False, True)
+    # - The Python executor also starts a second copy of very slow tiles once all tiles have started
+    # - Tile workers load this script once per node and are then sent one line of the argument file per tile
+    IrgTraceFunctions.setTraceStage('tiles')
+
+    # Write the tiles into the output while the others are being computed
+    # - This needs the GDAL python bindings, otherwise the output is built from a VRT at the end.
+    streamer = None
+    if not options.vrtMosaic:
+        if IrgMosaicFunctions.canStreamMosaic():
+            mosaicPartPath = os.path.splitext(options.outputPath)[0] + '.part.tif'
+            writer   = IrgMosaicFunctions.StreamingMosaicWriter(mosaicPartPath, fullWidth, fullHeight,
+                                                                options.compression, options.predictor)
+            for tile in culledTiles: # The blocks next to culled tiles should not wait for them
+                writer.addEmptyRegion(tile[0], tile[1], tile[2], tile[3])
+            streamer = MosaicStreamer(writer, os.path.join(tempFolder, JOURNAL_NAME), tileList, tileHashes, tempFolder)
+            streamer.start()
+        else:
+            print 'The GDAL python bindings and numpy are needed to write the output while the tiles are computed.'
+
+    if numTilesLeft > 0:
+        if options.tileWorkers:
+            mode = 'resident tile workers'
+            workerArgs = ['--handler-module', 'parallel_mapproject', '--'] + baseArgs
+            IrgPbsFunctions.runInTaskExecutor(processesPerNode, '{}', argumentFilePath, parallelArgs,
+                                              options.nodesListPath, True, speculative=True, agentArgs=workerArgs)
+        elif options.pythonExecutor:
+            mode = 'spawned copies'
+            IrgPbsFunctions.runInTaskExecutor(processesPerNode, commandString, argumentFilePath, parallelArgs,
+                                              options.nodesListPath, True, speculative=True)
+        else:
+            mode = 'spawned copies'
+            IrgPbsFunctions.runInGnuParallel(processesPerNode, commandString, argumentFilePath, parallelArgs,
+                                             options.nodesListPath, True)#not options.suppressOutput)
+        lastTileTime = time.time()
+        journal.reload()
+        reportTileOverhead(jobLogPath, [name for (name, isDone) in zip(tileNames, tileIsDone) if not isDone],
+                           journal, mode)
+
+    if streamer:
+        IrgTraceFunctions.setTraceStage('mosaic')
+        numAdded = streamer.finish()
+        writer.close()
+
+    # Don't build the output from an incomplete set of tiles, the work directory lets a rerun finish the job
+    numMissing = len([name for (name, h) in zip(tileNames, tileHashes)
+                      if not journal.isComplete(name, h, os.path.join(tempFolder, name))])
+    if numMissing > 0:
+        print (str(numMissing) + ' tiles failed, rerun the same command to compute only those tiles. '
+               + 'Finished tiles are kept in ' + tempFolder)
+        if streamer:
+            IrgFileFunctions.removeIfExists(mosaicPartPath)
+        IrgCacheFunctions.printCacheStats()
+        return 1
+
+    if streamer:
+        # The streamed file already has all of its overviews, a COG only needs them moved in front of the data
+        if options.outputFormat == 'cog':
+            IrgMosaicFunctions.convertToCog(mosaicPartPath, options.outputPath, options.compression, options.predictor)
+            os.remove(mosaicPartPath)
+        else:
+            os.rename(mosaicPartPath, options.outputPath)
+        if numTilesLeft > 0:
+            print ('Wrote %d tiles to %s, finished %.1f seconds after the last tile.'
+                   % (numAdded, options.outputPath, time.time() - lastTileTime))
+    else:
+        buildVrtMosaic(options, tempFolder, tileList, numCulled, fullWidth, fullHeight)
     
+    IrgCacheFunctions.printCacheStats()
+
     # Clean up temporary files
     if not options.keep:
         IrgFileFunctions.removeFolderIfExists(tempFolder)
@@ -19,6 +19,8 @@
 
 import sys, os, glob, optparse, re, shutil, subprocess, string, time
 
+import IrgSystemFunctions, IrgIsisFunctions
+
 
 def man(option, opt, value, parser):
     print >>sys.stderr, parser.usage
@@ -38,30 +40,47 @@ def replaceExtensionAndFolder(inputPath, outputFolder, newExtension):
     return os.path.join(outputFolder, os.path.basename(newExt))
 
 
-def prepareImage(inputPath, workDir, keep):
-    """Prepare a single CTX image for processing"""
+def initImage(inputPath, workDir, runner):
+    """Starts converting a single CTX image to ISIS and loading its SPICE data.
+       Returns the cube path."""
 
-    # Set up paths
     cubPath = replaceExtensionAndFolder(inputPath, workDir, '.cub')
-    calPath = replaceExtensionAndFolder(inputPath, workDir, '.cal.cub')
 
     # Convert to ISIS format
     cmd = 'mroctx2isis from=' + inputPath  + ' to=' + cubPath
-    os.system(cmd)
+    future = runner.submit(cmd)
     
     # Init Spice data
     cmd = 'spiceinit from=' + cubPath
-    os.system(cmd)
-    
+    future = runner.submit(cmd, after=future)
+
+    return cubPath
+
+def stageCubeKernels(cubePaths, scratchFolder, runner):
+    """Copies the kernels the cubes use to a local folder once and points the cubes at the copies.
+       Returns a dictionary of cube path -> CommandFuture of its new spiceinit call."""
+
+    kernelSet = IrgIsisFunctions.getKernelSetForCubes(cubePaths)
+    pathMap   = IrgIsisFunctions.stageKernels([path for (path, size) in kernelSet], scratchFolder)
+
+    futures = dict()
+    for cubePath in cubePaths:
+        kernels = IrgIsisFunctions.rewriteKernelPaths(IrgIsisFunctions.getKernelsFromCube(cubePath), pathMap)
+        cmd = ['spiceinit', 'from=' + cubePath] + IrgIsisFunctions.getSpiceinitKernelArgs(kernels)
+        futures[cubePath] = runner.submit(cmd)
+    return futures
+
+def calibrateImage(inputPath, cubPath, workDir, runner, after=None):
+    """Starts the radiometric calibration of a cube, returns the output path"""
+
+    calPath = replaceExtensionAndFolder(inputPath, workDir, '.cal.cub')
+
     # Apply image correction
     cmd = 'ctxcal from='+cubPath+' to='+calPath
-    os.system(cmd)
+    runner.submit(cmd, after=after)
 
     #you can also optionally run} ctxevenodd \textnormal{on the} cal.cub \textnormal{files, if needed}
 
-    if not keep:
-        os.remove(cubPath)
-    
     return calPath
 
 def main():
@@ -71,12 +90,14 @@ def main():
 
     try:
         try:
-            usage = "usage: processCtxPair.py <left image> <right image> <output prefix> [--workDir <folder>][--keep][--manual]\n  "
+            usage = "usage: processCtxPair.py <left image> <right image> <output prefix> [--workDir <folder>][--kernel-scratch <folder>][--keep][--manual]\n  "
             parser = optparse.OptionParser(usage=usage)
 
             parser.set_defaults(keep=False)
 
             parser.add_option("--workDir",  dest="workDir",  help="Folder to place intermediate files in")
+            parser.add_option("--kernel-scratch", dest="kernelScratch", default=None,
+                              help="Node-local folder to copy the SPICE kernels to, so they are read from shared storage once.")
 
             parser.add_option("--manual", action="callback", callback=man,
                               help="Read the manual.")
@@ -98,15 +119,31 @@ def main():
 
         startTime = time.time()
 
-        # Do individual input image preparations
-        leftCalPath  = prepareImage(options.leftPath,  options.workDir, options.keep)
-        rightCalPath = prepareImage(options.rightPath, options.workDir, options.keep)
+        # Do individual input image preparations, the left and right images are processed at the same time
+        runner = IrgSystemFunctions.CommandRunner(logFolder=os.path.join(options.workDir, 'logs'))
+        leftCubPath  = initImage(options.leftPath,  options.workDir, runner)
+        rightCubPath = initImage(options.rightPath, options.workDir, runner)
+        IrgSystemFunctions.checkCommandResults(runner.waitAll())
+
+        # The kernels are known once spiceinit has filled in the labels
+        spiceFutures = dict()
+        if options.kernelScratch:
+            spiceFutures = stageCubeKernels([leftCubPath, rightCubPath], options.kernelScratch, runner)
+
+        leftCalPath  = calibrateImage(options.leftPath,  leftCubPath,  options.workDir, runner,
+                                      spiceFutures.get(leftCubPath))
+        rightCalPath = calibrateImage(options.rightPath, rightCubPath, options.workDir, runner,
+                                      spiceFutures.get(rightCubPath))
+        IrgSystemFunctions.checkCommandResults(runner.waitAll())
+        if not options.keep:
+            os.remove(leftCubPath)
+            os.remove(rightCubPath)
         
         # Do joint prepration
         cmd = 'cam2map4stereo.py ' + leftCalPath + ' ' + rightCalPath
         os.system(cmd)
-        leftMapPath  = replaceExtensionAndFolder(options.leftPath,  workDir, '.map.cub')
-        rightMapPath = replaceExtensionAndFolder(options.rightPath, workDir, '.map.cub')
+        leftMapPath  = replaceExtensionAndFolder(options.leftPath,  options.workDir, '.map.cub')
+        rightMapPath = replaceExtensionAndFolder(options.rightPath, options.workDir, '.map.cub')
   
         # Final stereo call
         cmd = ('parallel_stereo.py ' + leftMapPath + ' ' + rightMapPath + ' ' + options.outputPrefix
@@ -13,6 +13,8 @@ os.environ["ASP_PYTHON_MODULES_PATH"] = os.environ['HOME'] + '/projects/BinaryBu
 
 import asp_system_utils, asp_alg_utils, asp_geo_utils
 
+import IrgSystemFunctions, IrgTraceFunctions
+
 
 def parseDateTimeStrings(dateString, timeString):
     '''Parse strings in the format 20110323_17433900'''
@@ -161,27 +163,30 @@ def main(argsIn):
     if options.numThreads:
         threadText = ' --threads ' + str(options.numThreads) +' '
     
+    # Each step is a stage in the trace, if tracing was turned on by process_icebridge_run.py
+
     # BUNDLE_ADJUST
     if options.bundleAdjust:
+        IrgTraceFunctions.setTraceStage('bundle_adjust')
         # TODO: Solve for intrinsics?
         bundlePrefix = os.path.join(outputFolder, 'bundle/out')
         cmd = ('bundle_adjust %s %s %s %s -o %s %s -t nadirpinhole --local-pinhole' 
                      % (imageA, imageB, cameraA, cameraB, bundlePrefix, threadText))
-        print(cmd)
         # Point to the new camera models
         cameraA = bundlePrefix +'-'+ os.path.basename(cameraA)
         cameraB = bundlePrefix +'-'+ os.path.basename(cameraB)
-        asp_system_utils.executeCommand(cmd, cameraA, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, cameraA, suppressOutput, redo)
 
         # Update the baseArgString
         baseArgString = ('%s %s %s %s %s -t nadirpinhole --alignment-method epipolar' 
                          % (imageA, imageB, cameraA, cameraB, outputPrefix))
     
+    IrgTraceFunctions.setTraceStage('stereo')
     if options.use_sgm:
         # PPRC
         cmd = ('stereo_pprc %s %s' % (baseArgString, threadText))
         pprcOutput = outputPrefix + '-L.tif'
-        asp_system_utils.executeCommand(cmd, pprcOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, pprcOutput, suppressOutput, redo)
 
         # CORR
         # - This should be single threaded to use the SGM processing.
@@ -192,26 +197,26 @@ def main(argsIn):
                                #+ ' --corr-blob-filter 100 --compute-low-res-disparity-only')
         cmd = ('stereo_corr %s %s ' % (correlationArgString, baseArgString))
         corrOutput = outputPrefix + '-D.tif'
-        asp_system_utils.executeCommand(cmd, corrOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, corrOutput, suppressOutput, redo)
 
         #raise Exception('DEBUG')
 
         # RFNE
         cmd = ('stereo_rfne --subpixel-mode 0 %s %s' % (baseArgString, threadText))
         rfneOutput = outputPrefix + '-RD.tif'
-        asp_system_utils.executeCommand(cmd, rfneOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, rfneOutput, suppressOutput, redo)
 
         # FLTR
         filterArgString = '--rm-cleanup-passes 0 --median-filter-size 5 ' + \
                           '--texture-smooth-size 17 --texture-smooth-scale 0.14'
         cmd = ('stereo_fltr %s %s %s' % (filterArgString, baseArgString, threadText))
         fltrOutput = outputPrefix + '-F.tif'
-        asp_system_utils.executeCommand(cmd, fltrOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, fltrOutput, suppressOutput, redo)
 
         # TRI
         cmd = ('stereo_tri %s %s' % (baseArgString, threadText))
         triOutput = outputPrefix + '-PC.tif'
-        asp_system_utils.executeCommand(cmd, triOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, triOutput, suppressOutput, redo)
 
         #raise Exception('DEBUG')
     else: # No SGM
@@ -234,16 +239,18 @@ def main(argsIn):
         #cmd = ('stereo -e 2 --skip-low-res-disparity-comp --corr-blob-filter 0 %s %s --corr-max-levels 2 --corr-seed-mode 3 --subpixel-mode 3' % (baseArgString, threadText))
         
         triOutput = outputPrefix + '-PC.tif'
-        asp_system_utils.executeCommand(cmd, triOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, triOutput, suppressOutput, redo)
 
     # point2dem on the result of ASP
+    IrgTraceFunctions.setTraceStage('point2dem')
     cmd = ('point2dem --tr %lf --t_srs %s %s %s --errorimage' 
            % (options.demResolution, projString, triOutput, threadText))
     p2dOutput = outputPrefix + '-DEM.tif'
-    asp_system_utils.executeCommand(cmd, p2dOutput, suppressOutput, redo)
+    IrgSystemFunctions.executeCommandForOutput(cmd, p2dOutput, suppressOutput, redo)
 
     if options.pc_align:
         # PC_ALIGN
+        IrgTraceFunctions.setTraceStage('pc_align')
         alignPrefix = os.path.join(outputFolder, 'align/out')
         alignOptions = ( ('--max-displacement %f --csv-format %s ' +   \
                           '--save-inv-transformed-reference-points') % \
@@ -251,28 +258,32 @@ def main(argsIn):
         cmd = ('pc_align %s %s %s -o %s %s' %
                (alignOptions, triOutput, lidarFile, alignPrefix, threadText))
         alignOutput = alignPrefix+'-trans_reference.tif'
-        asp_system_utils.executeCommand(cmd, alignOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, alignOutput, suppressOutput, redo)
         
         # POINT2DEM on the aligned PC file
         cmd = ('point2dem --tr %lf --t_srs %s %s %s --errorimage' 
                % (options.demResolution, projString, alignOutput, threadText))
         p2dOutput = alignPrefix+'-trans_reference-DEM.tif'
-        asp_system_utils.executeCommand(cmd, p2dOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, p2dOutput, suppressOutput, redo)
        
     # Create a symlink to the DEM in the main directory
     demSymlinkPath = os.path.join(outputFolder, 'DEM.tif')
     print("ln -s " + os.path.abspath(p2dOutput) + " " + demSymlinkPath)
     os.symlink(os.path.abspath(p2dOutput), demSymlinkPath)
 
+    IrgTraceFunctions.setTraceStage('geodiff')
     cmd = ('geodiff --absolute --csv-format %s %s %s -o %s' % \
            (csvFormatString, p2dOutput, lidarFile, outputPrefix))
-    print(cmd)
-    asp_system_utils.executeCommand(cmd, outputPrefix + "-diff.csv", suppressOutput, redo)
+    IrgSystemFunctions.executeCommandForOutput(cmd, outputPrefix + "-diff.csv", suppressOutput, redo)
+
+    # The hillshade and colormap steps only read the DEM so they can run at the same time
+    IrgTraceFunctions.setTraceStage('render')
+    runner = IrgSystemFunctions.CommandRunner(logFolder=os.path.join(outputFolder, 'logs'))
 
     # HILLSHADE
     hillOutput = outputPrefix+'-DEM_HILLSHADE.tif'
     cmd = 'hillshade ' + p2dOutput +' -o ' + hillOutput
-    asp_system_utils.executeCommand(cmd, hillOutput, suppressOutput, redo)
+    runner.submit(cmd, outputPath=hillOutput, redo=redo, suppressOutput=suppressOutput)
     
     # COLORMAP
     colormapMin = -10
@@ -280,9 +291,11 @@ def main(argsIn):
     colorOutput = outputPrefix+'-DEM_CMAP.tif'
     cmd = ('colormap --min %f --max %f %s -o %s' 
            % (colormapMin, colormapMax, p2dOutput, colorOutput))
-    asp_system_utils.executeCommand(cmd, colorOutput, suppressOutput, redo)
+    runner.submit(cmd, outputPath=colorOutput, redo=redo, suppressOutput=suppressOutput)
+    IrgSystemFunctions.checkCommandResults(runner.waitAll())
 
     if options.lidarOverlay:
+        IrgTraceFunctions.setTraceStage('lidar_overlay')
         LIDAR_DEM_RESOLUTION     = 5
         LIDAR_PROJ_BUFFER_METERS = 100
     
@@ -301,12 +314,12 @@ def main(argsIn):
                   LIDAR_DEM_RESOLUTION, projString, lidarFile, threadText, 
                   csvFormatString, lidarDemPrefix))
         lidarDemOutput = lidarDemPrefix+'-DEM.tif'
-        asp_system_utils.executeCommand(cmd, lidarDemOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, lidarDemOutput, suppressOutput, redo)
             
         colorOutput = lidarDemPrefix+'-DEM_CMAP.tif'
         cmd = ('colormap --min %f --max %f %s -o %s' 
                % (colormapMin, colormapMax, lidarDemOutput, colorOutput))
-        asp_system_utils.executeCommand(cmd, colorOutput, suppressOutput, redo)
+        IrgSystemFunctions.executeCommandForOutput(cmd, colorOutput, suppressOutput, redo)
 
     print 'Finished!'
 
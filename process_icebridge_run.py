@@ -11,6 +11,8 @@ sys.path.insert(0,  os.environ['HOME'] + '/projects/StereoPipeline/src/asp/Pytho
 
 import asp_system_utils, asp_alg_utils, asp_geo_utils
 
+import IrgSystemFunctions, IrgTraceFunctions, IrgJournalFunctions, IrgCacheFunctions
+
 # This block of code is just to get a non-blocking keyboard check!
 import signal
 class AlarmException(Exception):
@@ -30,18 +32,37 @@ def nonBlockingRawInput(prompt='', timeout=20):
     return ''
     
 
-def processPair(imageA, imageB, cameraA, cameraB, lidarFolder,
-                outputFolder, options):
-    '''Processes a single image pair'''
+def executeCommand(cmd, outputPath, suppressOutput, redo):
+    '''Calls asp_system_utils.executeCommand, or our own traced call if a trace file was requested'''
 
-    suppressOutput = False
-    redo           = False
+    if not IrgTraceFunctions.isTracingEnabled():
+        return asp_system_utils.executeCommand(cmd, outputPath, suppressOutput, redo)
+
+    if outputPath and os.path.exists(outputPath) and not redo:
+        print 'Skipping existing output file: ' + outputPath
+        return
+    print cmd
+    stdout = None
+    if suppressOutput:
+        stdout = open(os.devnull, 'w')
+    IrgTraceFunctions.callTraced(cmd, stdout=stdout, stderr=stdout)
+
+def getPairCommand(imageA, imageB, cameraA, cameraB, lidarFolder,
+                   outputFolder, options):
+    '''Returns the command which processes a single image pair'''
 
     # Just set the options and call the pair python tool.
     # We can try out bundle adjustment for intrinsic parameters here.
     cmd = ('python process_icebridge_pair.py --lidar-overlay --align-max-displacement 100 %s %s %s %s %s %s %s' 
            % (imageA, imageB, cameraA, cameraB, lidarFolder, outputFolder, options))
-    asp_system_utils.executeCommand(cmd, None, suppressOutput, redo)
+    return cmd
+
+def recordPairResult(journal, result, taskName, taskHash, demFile):
+    '''Writes the outcome of a pair to the journal'''
+    if result.succeeded() and os.path.exists(demFile):
+        journal.markDone(taskName, taskHash, demFile)
+    else:
+        journal.markFailed(taskName, taskHash, demFile)
 
 def getFrameNumberFromFilename(f):
     '''Return the frame number of an image or camera file'''
@@ -87,6 +108,13 @@ def main(argsIn):
                           dest='pcAlign',  
                           help='Run pc_align after stereo.')
 
+        parser.add_option('--task-memory', dest='taskMemory', default=None, type='float',
+                          help='Expected peak memory of one pair in GB, pairs are only started while they fit '
+                               + 'in memory. Defaults to the largest seen in the trace file, if there is one.')
+
+        parser.add_option('--trace-file', dest='tracePath', default=None,
+                          help='Append a record of the resources used by each tool call to this JSONL file.')
+
         #parser.add_option('--num-threads', dest='numThreads', default=None,
         #                  type='int', help='The number of threads to use for processing.')
 
@@ -123,6 +151,12 @@ def main(argsIn):
     suppressOutput = False
     redo           = False
 
+    if options.tracePath: # Also picked up by the pair processing scripts
+        IrgTraceFunctions.setTraceFile(options.tracePath)
+
+    # File query results are shared by the pair processes and kept for reruns
+    IrgCacheFunctions.setDefaultCacheDatabase(os.path.join(outputFolder, 'file_cache.sqlite'))
+
     print '\nStarting processing...'
     
     # Get a list of all the input files
@@ -158,8 +192,9 @@ def main(argsIn):
     vizString  = ''
     for (image, camera) in zip(imageFiles, cameraFiles): 
         vizString += image +' ' + camera+' '
+    IrgTraceFunctions.setTraceStage('orbitviz')
     cmd = 'orbitviz --hide-labels -t nadirpinhole -r wgs84 -o '+ orbitvizBefore +' '+ vizString
-    asp_system_utils.executeCommand(cmd, orbitvizBefore, suppressOutput, redo)
+    executeCommand(cmd, orbitvizBefore, suppressOutput, redo)
 
     if options.globalBundleAdjust:
         # TODO: Intrinsics???
@@ -167,6 +202,7 @@ def main(argsIn):
         # - Could use an overlap of 4 but there is very little overlap at that point.
         # - If we start dealing with crossover paths we can use the KML overlap method.
         print 'Setting up bundle adjustment...'
+        IrgTraceFunctions.setTraceStage('bundle_adjust')
         baFolder = os.path.join(outputFolder, 'group_bundle')
         baPrefix = os.path.join(baFolder,     'out')
         cmd = ('bundle_adjust '+ imageString + cameraString 
@@ -174,7 +210,7 @@ def main(argsIn):
         suppressOutput = False
         redo           = False
         baOutFile = baPrefix +'-'+ os.path.basename(cameraFiles[-1])
-        asp_system_utils.executeCommand(cmd, baOutFile, suppressOutput, redo)
+        executeCommand(cmd, baOutFile, suppressOutput, redo)
         print 'Bundle adjustment finished!'
     
         # Update the list of camera files to the ba files
@@ -188,12 +224,25 @@ def main(argsIn):
         for (image, camera) in zip(imageFiles, cameraFiles): 
             vizString += image +' ' + camera+' '
         cmd = 'orbitviz --hide-labels -t nadirpinhole -r wgs84 -o '+ orbitvizAfter +' '+ vizString
-        asp_system_utils.executeCommand(cmd, orbitvizAfter, suppressOutput, redo)
+        executeCommand(cmd, orbitvizAfter, suppressOutput, redo)
     
-    print 'Starting processing pool with ' + str(options.numProcesses) +' processes.'
-    pool = multiprocessing.Pool(options.numProcesses)
+    # Find out how much memory each pair needs so we don't start more than will fit
+    memoryEstimates = {}
+    if options.taskMemory:
+        memoryEstimates['process_icebridge_pair.py'] = int(options.taskMemory * 1024**3)
+    elif options.tracePath and os.path.exists(options.tracePath):
+        memoryEstimates = IrgTraceFunctions.getToolMemoryEstimates(IrgTraceFunctions.loadTrace(options.tracePath))
+
+    IrgTraceFunctions.setTraceStage('pair')
+    print 'Starting processing with up to ' + str(options.numProcesses) +' processes.'
+    runner = IrgSystemFunctions.CommandRunner(options.numProcesses, logFolder=os.path.join(outputFolder, 'logs'),
+                                              memoryEstimates=memoryEstimates)
     
     MAX_COUNT = 2 # DEBUG
+
+    # The journal records which pairs finished so that a rerun only processes the others
+    journal = IrgJournalFunctions.TaskJournal(os.path.join(outputFolder, 'journal.jsonl'))
+    journal.compact()
     
     # Call process_icebridge_pair on each pair of images.
     taskHandles = []
@@ -227,54 +276,63 @@ def main(argsIn):
         if options.bundleAdjust:
             extraOptions += ' --pc-align'
 
-        # Check if the output file already exists.
-        thisDemFile      = os.path.join(thisOutputFolder, 'DEM.tif')
-        if os.path.exists(thisDemFile):
-            print("Skipping frame as file exists: " + thisDemFile)
+        # Generate the command call, the output goes to logs/pair_<frame>.log
+        cmd = getPairCommand(imageA, imageB, cameraA, cameraB, lidarFolder, thisOutputFolder, extraOptions)
+
+        # Check if this pair was already finished with the same inputs and options
+        taskName    = os.path.basename(thisOutputFolder)
+        taskHash    = IrgJournalFunctions.getTaskHash([cmd] + [IrgJournalFunctions.getInputFileStamp(f)
+                                                               for f in [imageA, imageB, cameraA, cameraB]])
+        thisDemFile = os.path.join(thisOutputFolder, 'DEM.tif')
+        if (journal.getRecord(taskName) is None) and os.path.exists(thisDemFile):
+            # Finished before the journal existed, record it so later runs can check it
+            journal.markDone(taskName, taskHash, thisDemFile)
+        if journal.isComplete(taskName, taskHash, thisDemFile):
+            print("Skipping frame which was already processed: " + thisDemFile)
             continue
-          
-        # Generate the command call
-        cmd = ('python process_icebridge_pair.py --lidar-overlay --align-max-displacement ' + \
-               '20 %s %s %s %s %s %s %s' 
-                   % (imageA, imageB, cameraA, cameraB, lidarFolder, thisOutputFolder, extraOptions))
-        print(cmd)
-        taskHandles.append(pool.apply_async(processPair, 
-            (imageA, imageB, cameraA, cameraB, lidarFolder, thisOutputFolder, extraOptions)))
+
+        journal.markStarted(taskName, taskHash, thisDemFile)
+        future = runner.submit(cmd, name='pair_' + str(frameNumber))
+        future.addDoneCallback(lambda result, taskName=taskName, taskHash=taskHash, demFile=thisDemFile:
+                               recordPairResult(journal, result, taskName, taskHash, demFile))
+        taskHandles.append(future)
             
         #if len(taskHandles) >= MAX_COUNT:
         #    break # DEBUG
             
     # End of loop through input file pairs
     notReady = len(taskHandles)
-    print 'Finished adding ' + str(notReady) + ' tasks to the pool.'
+    print 'Finished adding ' + str(notReady) + ' tasks to the runner.'
     
     # Wait for all the tasks to complete
-    while notReady > 0:
+    # - The commands run in their own process groups so Ctrl-C has to stop them through the runner
+    try:
+        while notReady > 0:
         
-        if options.interactive:
-            # Wait and see if the user presses a key
-            msg = 'Waiting on ' + str(notReady) + ' process(es), press q<Enter> to abort...\n'
-            keypress = nonBlockingRawInput(prompt=msg, timeout=20)
-            if keypress == 'q':
-                print 'Recieved quit command!'
-                break
-        else:
-            print("Waiting on " + str(notReady) + ' process(es).')
-            time.sleep(5)
+            if options.interactive:
+                # Wait and see if the user presses a key
+                msg = 'Waiting on ' + str(notReady) + ' process(es), press q<Enter> to abort...\n'
+                keypress = nonBlockingRawInput(prompt=msg, timeout=20)
+                if keypress == 'q':
+                    print 'Recieved quit command!'
+                    runner.cancel()
+                    break
+            else:
+                print("Waiting on " + str(notReady) + ' process(es).')
+                time.sleep(5)
             
-        # Otherwise count up the tasks we are still waiting on.
-        notReady = 0
-        for task in taskHandles:
-            if not task.ready():
-                notReady += 1
+            # Otherwise count up the tasks we are still waiting on.
+            notReady = runner.getNumUnfinished()
+    except KeyboardInterrupt:
+        print 'Interrupted, stopping the running commands.'
+        runner.cancel()
     
     # Either all the tasks are finished or the user requested a cancel.
-    # Clean up the processing pool
-    PROCESS_POOL_KILL_TIMEOUT = 3
-    pool.close()
-    time.sleep(PROCESS_POOL_KILL_TIMEOUT)
-    pool.terminate()
-    pool.join()
+    results = runner.waitAll()
+    numFailed = len([r for r in results if not r.succeeded()])
+    if numFailed > 0:
+        print str(numFailed) + ' pair(s) did not finish, see the logs in ' + os.path.join(outputFolder, 'logs')
+    IrgCacheFunctions.printCacheStats()
     
     # BUNDLE_ADJUST
 
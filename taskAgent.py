@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+import sys, os, optparse, json, socket, time, threading, signal, subprocess
+
+import IrgTraceFunctions
+
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Worker process started by IrgPbsFunctions.TaskExecutor on each node.
+Reads one JSON task per line from stdin and writes one JSON result per line to stdout.
+The output of the tasks goes to stderr.
+A {"kill": <id>, "attempt": <attempt>} message stops a running task with SIGTERM so it can
+remove its partial output, followed by SIGKILL if it is still running after a few seconds.
+Exits once stdin is closed and the running tasks are finished.
+
+By default each task is a shell command.  With --handler-module the named module is
+imported once and module.createTaskHandler(<arguments after -->) must return a function
+handler(taskString, runCommand) which returns an exit code.  The handler should start
+its programs with runCommand(cmd) so they can be killed.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+# Seconds a killed task gets to clean up after SIGTERM before it gets SIGKILL
+KILL_GRACE_SECONDS = 5
+
+class TaskAgent(object):
+    """Runs the tasks sent by a TaskExecutor"""
+
+    def __init__(self, numSlots, protocolOut, handler=None):
+        # The executor never sends more than numSlots tasks at once, the semaphore is a safety check
+        self.slots       = threading.BoundedSemaphore(numSlots)
+        self.protocolOut = protocolOut
+        self.handler     = handler
+        self.lock        = threading.Lock()
+        self.processes   = {}    # (id, attempt) -> running subprocess.Popen
+        self.activeTasks = set() # (id, attempt) of started tasks which have not reported yet
+        self.cancelled   = set() # (id, attempt) of killed active tasks
+        self.killTimers  = {}    # (id, attempt) -> threading.Timer which sends SIGKILL
+
+    def runCommand(self, cmd, key):
+        """Runs one program for a task in its own process group, so that killing the task
+           also stops everything the program started.  Returns the exit code."""
+        startTime = time.time()
+        with self.lock:
+            if key in self.cancelled:
+                return -signal.SIGKILL
+            p = subprocess.Popen(cmd, shell=isinstance(cmd, basestring), preexec_fn=os.setsid)
+            self.processes[key] = p
+        try:
+            if IrgTraceFunctions.isTracingEnabled():
+                return IrgTraceFunctions.waitForTracedProcess(p, cmd, startTime)
+            return p.wait()
+        finally:
+            with self.lock:
+                self.processes.pop(key, None)
+                timer = self.killTimers.pop(key, None)
+            if timer:
+                timer.cancel()
+
+    def runTask(self, task):
+        """Thread body which runs one task and reports the result"""
+        key = (task['id'], task['attempt'])
+        try:
+            startTime = time.time()
+            try:
+                if self.handler:
+                    returnCode = self.handler(task['cmd'], lambda cmd: self.runCommand(cmd, key))
+                else:
+                    returnCode = self.runCommand(task['cmd'], key)
+            except Exception, e:
+                print >>sys.stderr, 'Task ' + str(task['id']) + ' failed: ' + str(e)
+                returnCode = 127
+            message = {'id': task['id'], 'attempt': task['attempt'], 'host': socket.gethostname(),
+                       'return_code': returnCode, 'start': startTime, 'end': time.time()}
+            with self.lock:
+                self.activeTasks.discard(key)
+                self.cancelled.discard(key)
+                self.protocolOut.write(json.dumps(message) + '\n')
+                self.protocolOut.flush()
+        finally:
+            self.slots.release()
+
+    def signalProcess(self, key, p, signalNumber):
+        """Sends a signal to the process group of a task if the process is still running"""
+        with self.lock:
+            if self.processes.get(key) is not p:
+                return
+            try:
+                os.killpg(p.pid, signalNumber)
+            except OSError: # Already finished
+                pass
+
+    def killTask(self, message):
+        """Kills a running task and everything it started"""
+        key = (message['kill'], message['attempt'])
+        with self.lock:
+            if key not in self.activeTasks: # Already finished or never started
+                return
+            self.cancelled.add(key)
+            p = self.processes.get(key)
+            if p is None:
+                return
+            timer = threading.Timer(KILL_GRACE_SECONDS, self.signalProcess, args=(key, p, signal.SIGKILL))
+            self.killTimers[key] = timer
+        self.signalProcess(key, p, signal.SIGTERM)
+        timer.start()
+
+    def run(self, inputFile):
+        """Reads tasks until the input is closed, then waits for the running ones"""
+        threads = []
+        for line in iter(inputFile.readline, ''):
+            if not line.strip():
+                continue
+            task = json.loads(line)
+            if 'kill' in task:
+                self.killTask(task)
+                continue
+            self.slots.acquire()
+            with self.lock:
+                self.activeTasks.add((task['id'], task['attempt']))
+            thread = threading.Thread(target=self.runTask, args=(task,))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+
+def main(argsIn):
+
+    try:
+        usage = 'usage: taskAgent.py [--slots <number>] [--handler-module <name> -- <handler arguments>]'
+        parser = optparse.OptionParser(usage=usage)
+        parser.disable_interspersed_args() # Leave the handler arguments alone
+
+        parser.add_option('--slots', dest='numSlots', default=1, type='int',
+                          help='Number of tasks to run at the same time.')
+        parser.add_option('--handler-module', dest='handlerModule', default=None,
+                          help='Python module which handles the tasks instead of the shell.')
+        parser.add_option("--manual", action="callback", callback=man,
+                          help="Read the manual.")
+
+        (options, args) = parser.parse_args(argsIn)
+
+    except optparse.OptionError, msg:
+        raise Usage(msg)
+
+    # Keep stdout for messages to the executor, anything else printed goes to stderr
+    protocolOut = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    handler = None
+    if options.handlerModule:
+        module  = __import__(options.handlerModule)
+        handler = module.createTaskHandler(args)
+
+    TaskAgent(options.numSlots, protocolOut, handler).run(sys.stdin)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+"""Tests for the ISIS label and cube functions in IrgIsisFunctions, run with: python -m unittest discover tests"""
+
+import sys, os, struct, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import IrgIsisFunctions
+
+# Bit patterns of the ISIS 32 bit special pixels and the smallest valid value
+VALID_MIN4 = 0xFF7FFFFA
+NULL4      = 0xFF7FFFFB
+LOW_REPR_SAT4   = 0xFF7FFFFC
+LOW_INSTR_SAT4  = 0xFF7FFFFD
+HIGH_INSTR_SAT4 = 0xFF7FFFFE
+HIGH_REPR_SAT4  = 0xFF7FFFFF
+
+LABEL_SIZE = 1024
+
+def writeRealCube(cubePath, numSamples, numLines, words):
+    """Writes a single band BandSequential Real cube with the pixels given as 32 bit patterns"""
+    label = ('Object = IsisCube\n'
+             '  Object = Core\n'
+             '    StartByte = %d\n'
+             '    Format    = BandSequential\n'
+             '    Group = Dimensions\n'
+             '      Samples = %d\n'
+             '      Lines   = %d\n'
+             '      Bands   = 1\n'
+             '    End_Group\n'
+             '    Group = Pixels\n'
+             '      Type       = Real\n'
+             '      ByteOrder  = Lsb\n'
+             '      Base       = 0.0\n'
+             '      Multiplier = 1.0\n'
+             '    End_Group\n'
+             '  End_Object\n'
+             'End_Object\n'
+             'End\n') % (LABEL_SIZE+1, numSamples, numLines)
+    f = open(cubePath, 'wb')
+    f.write(label + ' ' * (LABEL_SIZE - len(label)))
+    f.write(struct.pack('<%dI' % len(words), *words))
+    f.close()
+
+def floatBits(value):
+    return struct.unpack('<I', struct.pack('<f', value))[0]
+
+
+@unittest.skipIf(IrgIsisFunctions.numpy is None, 'IsisCube requires numpy')
+class IsisCubeSpecialPixelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testRealSpecialPixelsAreNan(self):
+        cubePath = os.path.join(self.folder, 'special.cub')
+        writeRealCube(cubePath, 4, 2, [floatBits(1.5), NULL4, LOW_REPR_SAT4, LOW_INSTR_SAT4,
+                                       HIGH_INSTR_SAT4, HIGH_REPR_SAT4, VALID_MIN4, floatBits(-2.0)])
+        values = IrgIsisFunctions.IsisCube(cubePath).readBand()
+
+        self.assertEqual(values.shape, (2, 4))
+        self.assertEqual(values[0, 0], 1.5)
+        for (line, sample) in [(0, 1), (0, 2), (0, 3), (1, 0), (1, 1)]:
+            self.assertTrue(IrgIsisFunctions.numpy.isnan(values[line, sample]),
+                            'Special pixel at %d, %d was not masked' % (sample, line))
+        self.assertFalse(IrgIsisFunctions.numpy.isnan(values[1, 2])) # VALID_MIN4 is a valid value
+        self.assertEqual(values[1, 3], -2.0)
+
+    def testNullPixelInWindow(self):
+        cubePath = os.path.join(self.folder, 'null.cub')
+        writeRealCube(cubePath, 2, 2, [floatBits(3.0), floatBits(4.0), NULL4, floatBits(5.0)])
+        values = IrgIsisFunctions.IsisCube(cubePath).readWindow(0, 1, 2, 1)
+        self.assertTrue(IrgIsisFunctions.numpy.isnan(values[0, 0]))
+        self.assertEqual(values[0, 1], 5.0)
+
+
+class IsisLabelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testEndGroupAtChunkBoundary(self):
+        # The first chunk ends right after "\nEnd", the "_Group" is in the next one
+        label = ('Group = Instrument\n'
+                 '  Samples = 7\n'
+                 'End')
+        rest  = ('_Group\n'
+                 'Object = IsisCube\n'
+                 '  Object = Core\n'
+                 '    Group = Dimensions\n'
+                 '      Samples = 4\n'
+                 '      Lines   = 2\n'
+                 '    End_Group\n'
+                 '  End_Object\n'
+                 'End_Object\n'
+                 'End\n')
+        labelPath = os.path.join(self.folder, 'label.lbl')
+        f = open(labelPath, 'wb')
+        f.write(label + rest + 'binary data')
+        f.close()
+        text = IrgIsisFunctions.readIsisLabelText(labelPath, chunkSize=len(label))
+        self.assertEqual(text, label + rest)
+
+        # Samples is in two groups, the path picks the right one
+        parsed = IrgIsisFunctions.parsePvlLabel(text)
+        self.assertEqual(IrgIsisFunctions.getPvlValue(parsed, 'IsisCube/Core/Dimensions/Samples'), 4)
+        self.assertEqual(IrgIsisFunctions.getPvlValue(parsed, 'Instrument/Samples'), 7)
+        self.assertEqual(IrgIsisFunctions.getPvlValue(parsed, 'IsisCube/Mapping/Samples', 'none'), 'none')
+
+
+if __name__ == '__main__':
+    unittest.main()
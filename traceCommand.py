@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+import sys, os, optparse
+
+import IrgTraceFunctions
+
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Runs a command and appends a record of the resources it used to a trace file.
+Everything after -- is the command, its arguments are passed on as they are.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def main(argsIn):
+
+    try:
+        usage = 'usage: traceCommand.py --trace-file <path> [--stage <name>] -- <command> [<args> ...]'
+        parser = optparse.OptionParser(usage=usage)
+        parser.disable_interspersed_args() # Leave the options of the command alone
+
+        parser.add_option('--trace-file', dest='tracePath', default=None,
+                          help='JSONL file the record is appended to.')
+        parser.add_option('--stage', dest='stage', default=None,
+                          help='Processing stage recorded with the command.')
+        parser.add_option("--manual", action="callback", callback=man,
+                          help="Read the manual.")
+
+        (options, args) = parser.parse_args(argsIn)
+
+        if (len(args) < 1) or not options.tracePath:
+            print usage
+            return 0
+
+    except optparse.OptionError, msg:
+        raise Usage(msg)
+
+    IrgTraceFunctions.setTraceFile(options.tracePath)
+    if options.stage:
+        IrgTraceFunctions.setTraceStage(options.stage)
+
+    # Pass the list so arguments with spaces or shell characters are not re-split
+    return IrgTraceFunctions.callTraced(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+
+import sys, os, optparse, json
+
+import IrgTraceFunctions
+
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Summarizes a trace file written with IRG_TRACE_FILE set, grouped by tool and by stage.
+Can also convert the trace to a JSON file for the chrome://tracing timeline viewer.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def printSummary(title, summary):
+    """Prints one table of totals"""
+    print title
+    print '%-30s %6s %6s %12s %12s %12s %12s %12s' % ('Name', 'Count', 'Failed', 'Wall (s)', 'CPU (s)',
+                                                     'Max RSS (MB)', 'Read (MB)', 'Written (MB)')
+    for (name, s) in summary:
+        print '%-30s %6d %6d %12.1f %12.1f %12.1f %12.1f %12.1f' % (name, s['count'], s['failures'],
+                  s['wall'], s['cpu'], s['max_rss_kb'] / 1024.0,
+                  s['read_bytes'] / 1048576.0, s['write_bytes'] / 1048576.0)
+    print
+
+
+def main(argsIn):
+
+    try:
+        usage = 'usage: traceReport.py [options] <trace file>'
+        parser = optparse.OptionParser(usage=usage)
+
+        parser.add_option('--chrome-trace', dest='chromePath', default=None,
+                          help='Also write the trace in Chrome trace event format to this file.')
+        parser.add_option("--manual", action="callback", callback=man,
+                          help="Read the manual.")
+
+        (options, args) = parser.parse_args(argsIn)
+
+        if len(args) < 1:
+            print usage
+            return 0
+
+    except optparse.OptionError, msg:
+        raise Usage(msg)
+
+    records = IrgTraceFunctions.loadTrace(args[0])
+    if not records:
+        print 'No records in ' + args[0]
+        return 0
+
+    startTime = min([r['start'] for r in records])
+    endTime   = max([r['end'  ] for r in records])
+    print 'Read %d records covering %.1f seconds.\n' % (len(records), endTime - startTime)
+
+    printSummary('By tool:',  IrgTraceFunctions.summarizeTrace(records, 'tool' ))
+    printSummary('By stage:', IrgTraceFunctions.summarizeTrace(records, 'stage'))
+
+    if options.chromePath:
+        f = open(options.chromePath, 'w')
+        json.dump(IrgTraceFunctions.getChromeTraceEvents(records), f)
+        f.close()
+        print 'Wrote timeline to ' + options.chromePath
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))